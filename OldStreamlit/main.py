@@ -1,12 +1,12 @@
 # main.py
 import streamlit as st
 from OldStreamlit.ui import display_patient_management_page, display_treatment_plan_page, display_pt_schedule_page
-from OldStreamlit.utils import load_patients, save_patients
+from OldStreamlit.session import load_patients
 
 def main():
     st.title("PT Exercise Planner")
 
-    # Load patient data 
+    # Patient data is cached across reruns and only re-read when the file changes
     patients = load_patients()
 
     # Sidebar navigation
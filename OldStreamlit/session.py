@@ -0,0 +1,88 @@
+# session.py
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+import streamlit as st
+from OldStreamlit import utils
+from OldStreamlit.models import PTExercisePlanner
+
+
+@st.cache_resource(show_spinner=False)
+def get_planner() -> PTExercisePlanner:
+    """One planner, and so one Anthropic client and connection pool, for the whole process."""
+    return PTExercisePlanner()
+
+
+def _file_stamp(path) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class PatientData:
+    """
+    Process-wide copy of the patient database. load() parses the files
+    only when patients.json or its change log differ (mtime/size) from
+    what was last read or written here, so a rerun costs two stat calls.
+    Every write goes through save()/save_all(), which update the disk and
+    keep the in-memory copy current. `version` changes whenever the data
+    may have, and keys caches derived from it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._patients: Optional[Dict] = None
+        self._stamp = None
+        self.version = 0
+
+    def _files_stamp(self):
+        return _file_stamp(utils.PATIENTS_FILE), _file_stamp(utils.LOG_FILE)
+
+    def load(self) -> Dict:
+        with self._lock:
+            stamp = self._files_stamp()
+            if self._patients is None or stamp != self._stamp:
+                self._patients = utils.load_patients()
+                self._stamp = stamp
+                self.version += 1
+            return self._patients
+
+    def save(self, patients: Dict, name: str):
+        """Persists one patient's change (or removal) made to the loaded dict."""
+        with self._lock:
+            utils.save_patient(patients, name)
+            self._written(patients)
+
+    def save_all(self, patients: Dict):
+        with self._lock:
+            utils.save_patients(patients)
+            self._written(patients)
+
+    def _written(self, patients: Dict):
+        self._patients = patients
+        self._stamp = self._files_stamp()
+        self.version += 1
+
+
+@st.cache_resource(show_spinner=False)
+def patient_data() -> PatientData:
+    return PatientData()
+
+
+def load_patients() -> Dict:
+    return patient_data().load()
+
+
+def save_patient(patients: Dict, name: str):
+    patient_data().save(patients, name)
+
+
+def save_patients(patients: Dict):
+    patient_data().save_all(patients)
+
+
+def patients_version() -> int:
+    return patient_data().version
@@ -1,11 +1,15 @@
 import streamlit as st
 from st_aggrid import AgGrid, GridOptionsBuilder, GridUpdateMode, DataReturnMode
-from OldStreamlit.models import PTExercisePlanner
-from OldStreamlit.utils import save_patients, create_weekly_schedule
+from OldStreamlit.session import get_planner, save_patient, patients_version
+from OldStreamlit.utils import create_weekly_schedule, generate_pt_weekly_schedule
 import pandas as pd
 from typing import Dict
 from datetime import datetime
 import base64
+import hashlib
+import json
+
+DAYS_ORDER = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
 
 def display_injury_detection_page():
     st.header("Detect Injury Location from Image")
@@ -18,7 +22,7 @@ def display_injury_detection_page():
         base64_image = base64.b64encode(uploaded_file.read()).decode("utf-8")
 
         if st.button("Identify Body Part"):
-            planner = PTExercisePlanner()
+            planner = get_planner()
             with st.spinner("Analyzing the image..."):
                 location_description = planner.detect_injury_location(base64_image, media_type=uploaded_file.type)
                 st.write(f"**Injury Location Detected:** {location_description}")
@@ -58,7 +62,7 @@ def display_patient_management_page(patients):
                     "goals": goals,
                     "weekly_schedule": create_weekly_schedule()
                 }
-                save_patients(patients)
+                save_patient(patients, patient_name)
                 st.success(f"Patient {patient_name} added successfully!")
                 st.rerun()
     else:
@@ -94,7 +98,9 @@ def display_patient_management_page(patients):
                     "goals": goals,
                     "weekly_schedule": patient_data["weekly_schedule"]
                 }
-                save_patients(patients)
+                if new_patient_name != selected_patient:
+                    save_patient(patients, selected_patient)  # records the removal of the old name
+                save_patient(patients, new_patient_name)
                 st.success(f"Patient {new_patient_name} updated successfully!")
                 st.rerun()
 
@@ -119,12 +125,12 @@ def display_treatment_plan_page(patients):
 
     # Button to generate exercise plan
     if st.button("Generate Exercise Plan"):
-        planner = PTExercisePlanner()
+        planner = get_planner()
         with st.spinner("Generating exercise recommendations..."):
             recommendations = planner.generate_exercises(patient_data, num_exercises)
             if recommendations:
                 patient_data["recommendations"] = recommendations  # Store in patient_data
-                save_patients(patients)  # Save updated patient data
+                save_patient(patients, selected_patient)  # Save updated patient data
                 st.session_state.recommendations = recommendations
                 st.success("Exercise recommendations generated!")
 
@@ -142,7 +148,7 @@ def display_treatment_plan_page(patients):
                 selected_day = st.selectbox("Select Day", list(patient_data["weekly_schedule"].keys()), key=f"day_{exercise['id']}")
                 if st.button(f"Add to {selected_day}", key=f"add_{exercise['id']}"):
                     patient_data["weekly_schedule"][selected_day].append(exercise)
-                    save_patients(patients)
+                    save_patient(patients, selected_patient)
                     st.success(f"Added {exercise['name']} to {selected_day}")
 
     # Display the weekly schedule using a table
@@ -151,41 +157,78 @@ def display_treatment_plan_page(patients):
 
     # Export treatment plan
     if st.button("Export Treatment Plan"):
-        export_plan(patient_data, patient_data["weekly_schedule"])
+        export_plan(selected_patient, patient_data, patient_data["weekly_schedule"])
 
 def display_pt_schedule_page(patients):
-    from OldStreamlit.utils import generate_pt_weekly_schedule
-
     st.header("PT Weekly Schedule")
-    pt_weekly_schedule = generate_pt_weekly_schedule(patients)
-    display_weekly_schedule_table(pt_weekly_schedule, patients)
+    display_weekly_schedule_table(None, patients)
+
+def schedule_version(schedule) -> str:
+    """Content hash of a schedule; keys the cached patient DataFrame below."""
+    return hashlib.sha1(json.dumps(schedule, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def _order_by_day(df):
+    if not df.empty:
+        df["Day"] = pd.Categorical(df["Day"], categories=DAYS_ORDER, ordered=True)
+        df = df.sort_values("Day", kind="stable")
+    return df
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def patient_schedule_frame(patient_name, version, _schedule):
+    """A patient's schedule as a DataFrame, built once per patient and schedule version."""
+    exercises = [(day, exercise) for day, day_exercises in _schedule.items() for exercise in day_exercises]
+    return _order_by_day(pd.DataFrame({
+        "Day": [day for day, _ in exercises],
+        "Exercise": [exercise["name"] for _, exercise in exercises],
+        "Details": [exercise.get("parameters", "") for _, exercise in exercises],
+    }))
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def pt_schedule_frame(version, _patients):
+    """Every patient's appointments as one DataFrame, rebuilt only when the patient data version changes."""
+    pt_schedule = generate_pt_weekly_schedule(_patients)
+    return _order_by_day(pd.DataFrame({
+        "Day": [day for day, entries in pt_schedule.items() for _ in entries],
+        "Appointment": [entry for entries in pt_schedule.values() for entry in entries],
+    }))
+
+def exercise_lookup(patient_data) -> Dict:
+    """name -> exercise for everything a schedule row can refer to; scheduled copies win over recommendations."""
+    lookup = {ex["name"]: ex for ex in patient_data.get("recommendations", {}).get("exercises", [])}
+    for exercises in patient_data.get("weekly_schedule", {}).values():
+        lookup.update((ex["name"], ex) for ex in exercises)
+    return lookup
+
+def apply_schedule_edits(updated_df, lookup) -> Dict:
+    """
+    Rebuilds a schedule from the edited grid. Rows are matched to
+    exercises by name in one pass over `lookup` (unknown names are
+    dropped), and an edited Details cell becomes the exercise's parameters.
+    """
+    schedule = create_weekly_schedule()
+    if updated_df.empty:
+        return schedule
+    rows = updated_df[updated_df["Exercise"].isin(list(lookup))]
+    matched = rows["Exercise"].map(lookup.get)
+    edited = rows["Details"].ne(matched.map(lambda ex: ex.get("parameters", "")))
+    for day, exercise, details, changed in zip(rows["Day"].astype(str), matched, rows["Details"], edited):
+        if day in schedule:
+            schedule[day].append(dict(exercise, parameters=details) if changed else exercise)
+    return schedule
 
 def display_weekly_schedule_table(schedule_data, patients, selected_patient=None):
-    """Displays the weekly schedule using Ag-Grid."""
+    """
+    Displays the weekly schedule using Ag-Grid: a patient's schedule if
+    one is selected, otherwise every patient's (schedule_data is unused).
+    """
 
     # If a patient is selected, show their schedule, otherwise show the PT's overall schedule
     if selected_patient:
-        data = []
-        for day, exercises in schedule_data.items():
-            for exercise in exercises:
-                data.append({"Day": day, "Exercise": exercise["name"], "Details": exercise["parameters"]})
-        df = pd.DataFrame(data)
+        df = patient_schedule_frame(selected_patient, schedule_version(schedule_data), schedule_data)
     else:
-        data = []
-        for day, entries in schedule_data.items():
-            for entry in entries:
-                data.append({"Day": day, "Appointment": entry})
-        df = pd.DataFrame(data)
+        df = pt_schedule_frame(patients_version(), patients)
 
     if not df.empty:
-        # Ensure 'Day' column exists and has the correct order
-        if 'Day' not in df.columns:
-            df['Day'] = ""
-
-        days_order = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
-        df['Day'] = pd.Categorical(df['Day'], categories=days_order, ordered=True)
-        df = df.sort_values('Day')
-
         gb = GridOptionsBuilder.from_dataframe(df)
         gb.configure_default_column(groupable=True, value=True, enableRowGroup=True, autoHeight=True, wrapText=True)
         gb.configure_grid_options(domLayout='normal')
@@ -193,7 +236,7 @@ def display_weekly_schedule_table(schedule_data, patients, selected_patient=None
         # Make cells editable if it's a patient's schedule
         if selected_patient:
             gb.configure_selection("multiple", use_checkbox=False)
-            gb.configure_column("Day", editable=False, cellEditor='agSelectCellEditor', cellEditorParams={'values': days_order})
+            gb.configure_column("Day", editable=False, cellEditor='agSelectCellEditor', cellEditorParams={'values': DAYS_ORDER})
             gb.configure_column("Exercise", editable=True)
             gb.configure_column("Details", editable=True)
 
@@ -215,81 +258,45 @@ def display_weekly_schedule_table(schedule_data, patients, selected_patient=None
         # Handle data updates if it's a patient's schedule
         if selected_patient:
             updated_df = pd.DataFrame(grid_response['data'])
-            if not updated_df.equals(df):
-                updated_schedule = create_weekly_schedule()
-                for index, row in updated_df.iterrows():
-                    # Find the exercise in recommendations based on its name
-                    exercise_details = next((ex for ex in st.session_state.recommendations["exercises"] if ex["name"] == row["Exercise"]), None)
-
-                    if exercise_details:
-                        updated_schedule[row["Day"]].append(exercise_details)
-
-                # Update the patient's weekly schedule and save
-                if selected_patient in patients:
+            if not updated_df.equals(df) and selected_patient in patients:
+                updated_schedule = apply_schedule_edits(updated_df, exercise_lookup(patients[selected_patient]))
+                # Only persist real changes, and only this patient.
+                if updated_schedule != schedule_data:
                     patients[selected_patient]["weekly_schedule"] = updated_schedule
-                    save_patients(patients)
+                    save_patient(patients, selected_patient)
                     st.success("Patient's weekly schedule updated!")
 
-def export_plan(patient_data: Dict, weekly_schedule: Dict):
+def export_plan(patient_name: str, patient_data: Dict, weekly_schedule: Dict):
     """Export the treatment plan as a formatted document"""
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     filename = f"treatment_plan_{timestamp}.txt"
 
-    content = []
-    content.append("PHYSICAL THERAPY TREATMENT PLAN")
-    content.append("=" * 30 + "\n")
-    content.append("PATIENT INFORMATION")
-    content.append("-" * 20)
-    content.append(f"Name: {patient_data.get('name', 'N/A')}")
-    content.append(f"Age: {patient_data.get('age', 'N/A')}")
-    content.append(f"Injury Location: {patient_data.get('injury_location', 'N/A')}")
-    content.append(f"Pain Level: {patient_data.get('pain_level', 'N/A')}/10")
-    content.append(f"Activity Level: {patient_data.get('activity_level', 'N/A')}")
-    content.append(f"\nTreatment Goals:")
-    content.append(f"{patient_data.get('goals', 'N/A')}\n")
-    content.append("WEEKLY EXERCISE SCHEDULE")
-    content.append("-" * 20)
+    # Built in a single pass; the backend's GET /patients/{name}/plan renders the same layout.
+    content = [
+        "PHYSICAL THERAPY TREATMENT PLAN",
+        "=" * 30 + "\n",
+        "PATIENT INFORMATION",
+        "-" * 20,
+        f"Name: {patient_name}",
+        f"Age: {patient_data.get('age', 'N/A')}",
+        f"Injury Location: {patient_data.get('injury_location', 'N/A')}",
+        f"Pain Level: {patient_data.get('pain_level', 'N/A')}/10",
+        f"Activity Level: {patient_data.get('activity_level', 'N/A')}",
+        "\nTreatment Goals:",
+        f"{patient_data.get('goals', 'N/A')}\n",
+        "WEEKLY EXERCISE SCHEDULE",
+        "-" * 20,
+    ]
     for day, exercises in weekly_schedule.items():
         content.append(f"\n{day}:")
         if not exercises:
             content.append("Rest day / No exercises scheduled")
-        else:
-            for exercise in exercises:
-                content.append(f"\n  • {exercise['name']}")
-                content.append(f"    Parameters: {exercise['parameters']}")
-                content.append(f"    Description: {exercise['description']}")
-                content.append(f"    Progression Criteria: {exercise['progressionCriteria']}")
-
-    export_content = "\n".join(content)
-
-    # Using pandas to create a DataFrame (optional for formatting)
-    df = pd.DataFrame({
-        'Patient Information': [
-            f"Name: {patient_data.get('name', 'N/A')}",
-            f"Age: {patient_data.get('age', 'N/A')}",
-            f"Injury Location: {patient_data.get('injury_location', 'N/A')}",
-            f"Pain Level: {patient_data.get('pain_level', 'N/A')}/10",
-            f"Activity Level: {patient_data.get('activity_level', 'N/A')}",
-            f"Treatment Goals: {patient_data.get('goals', 'N/A')}"
-        ],
-        'Weekly Exercise Schedule': [""]  # Placeholder for schedule
-    })
-
-    # Create a formatted string for the schedule
-    schedule_str = ""
-    for day, exercises in weekly_schedule.items():
-        schedule_str += f"\n{day}:\n"
-        if not exercises:
-            schedule_str += "Rest day / No exercises scheduled\n"
-        else:
-            for exercise in exercises:
-                schedule_str += f"  • {exercise['name']}\n"
-                schedule_str += f"    Parameters: {exercise['parameters']}\n"
-                schedule_str += f"    Description: {exercise['description']}\n"
-                schedule_str += f"    Progression Criteria: {exercise['progressionCriteria']}\n"
-
-    # Concatenate patient info and schedule
-    export_content = df.to_string(index=False) + "\n" + schedule_str
+        for exercise in exercises:
+            content.append(f"  • {exercise['name']}")
+            content.append(f"    Parameters: {exercise['parameters']}")
+            content.append(f"    Description: {exercise['description']}")
+            content.append(f"    Progression Criteria: {exercise['progressionCriteria']}")
+    export_content = "\n".join(content) + "\n"
 
     # Create download button in Streamlit
     st.download_button(
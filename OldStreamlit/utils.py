@@ -1,4 +1,5 @@
-import json
+import os
+import sys
 from datetime import datetime
 import pandas as pd
 from typing import Dict
@@ -8,19 +9,55 @@ def create_weekly_schedule():
     days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
     return {day: [] for day in days}
 
+# Patient file, change log and exercise catalog use the backend's modules.
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+from catalog import ExerciseCatalog, from_refs, to_refs  # noqa: E402
+from storage import PatientStore  # noqa: E402
+
+PATIENTS_FILE = "patients.json"
+CATALOG_FILE = "exercise_catalog.jsonl"
+# Per-patient changes since the last snapshot, appended by save_patient.
+LOG_FILE = PATIENTS_FILE + ".wal"
+COMPACT_AFTER = 200
+_store = None
+_catalog = None
+
+def _open_store():
+    """Opens (or reopens, to pick up changes made on disk) the patient store and catalog."""
+    global _store, _catalog
+    if _store is not None:
+        _store.close()
+    _catalog = ExerciseCatalog(CATALOG_FILE).load()
+    _store = PatientStore(PATIENTS_FILE, compact_threshold=COMPACT_AFTER, fsync=True)
+    _store.load()
+    return _store
+
 def load_patients():
-    """Loads patient data from a JSON file, or initializes an empty dictionary."""
-    try:
-        with open("patients.json", "r") as f:
-            patients = json.load(f)
-    except FileNotFoundError:
-        patients = {}
-    return patients
+    """
+    Loads patient data from patients.json plus its change log, or
+    initializes an empty dictionary. Exercise refs are replaced by the
+    catalog entries.
+    """
+    store = _open_store()
+    return {name: from_refs(_catalog, data) for name, data in store.patients.items()}
 
 def save_patients(patients):
-    """Saves patient data to a JSON file."""
-    with open("patients.json", "w") as f:
-        json.dump(patients, f, indent=4)
+    """Rewrites patients.json from `patients`; exercises are stored once in the catalog."""
+    store = _store or _open_store()
+    store.save_all({name: to_refs(_catalog, data) for name, data in patients.items()})
+
+def save_patient(patients, name):
+    """
+    Persists a change to one patient (or its removal, if `name` is no
+    longer in `patients`) by appending it to the change log instead of
+    rewriting patients.json.
+    """
+    store = _store or _open_store()
+    data = patients.get(name)
+    if data is None:
+        store.delete(name)
+    else:
+        store.put(name, to_refs(_catalog, data))
 
 def generate_pt_weekly_schedule(patients):
     """Generates the overall weekly schedule for the PT."""
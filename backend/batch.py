@@ -0,0 +1,71 @@
+# batch.py
+"""
+Command-line batch generation, e.g. when onboarding a clinic:
+
+    python batch.py --all --num-exercises 4 --concurrency 16
+    python batch.py --injury-location "Right Knee"
+    python batch.py --patients "John Doe" "Jane Doe"
+"""
+import argparse
+import asyncio
+import json
+
+from jobs import BatchJob, run_batch_generation
+from repository import create_repository
+from services import LLM_MAX_CONCURRENCY, close_client, init_client
+
+
+async def run(args) -> BatchJob:
+    repo = create_repository()
+    try:
+        if args.patients:
+            patient_names = list(dict.fromkeys(args.patients))
+        else:
+            patient_names = repo.find_names(args.injury_location, args.activity_level)
+        job = BatchJob(patient_names, args.num_exercises)
+        if not patient_names:
+            job.status = "completed"
+            return job
+
+        init_client()
+        task = asyncio.create_task(
+            run_batch_generation(job, repo, args.concurrency, use_cache=not args.no_cache)
+        )
+        while not task.done():
+            await asyncio.sleep(1)
+            progress = job.to_dict(include_results=False)
+            print(f"{progress['completed'] + progress['failed']}/{progress['total']} done "
+                  f"({progress['failed']} failed, {progress['unique_profiles']} unique profiles)")
+        await task
+        await close_client()
+        return job
+    finally:
+        repo.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate exercise plans for many patients at once.")
+    selection = parser.add_mutually_exclusive_group()
+    selection.add_argument("--patients", nargs="+", help="Patient names to generate plans for")
+    selection.add_argument("--all", action="store_true", help="Generate plans for every patient")
+    selection.add_argument("--injury-location", help="Only patients with this injury location")
+    parser.add_argument("--activity-level", help="Only patients with this activity level")
+    parser.add_argument("--num-exercises", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=LLM_MAX_CONCURRENCY)
+    parser.add_argument("--no-cache", action="store_true", help="Ignore cached recommendations")
+    parser.add_argument("--output", help="Write the per-patient results to this JSON file")
+    args = parser.parse_args()
+    if not (args.patients or args.all or args.injury_location or args.activity_level):
+        parser.error("select patients with --patients, --all or a filter")
+
+    job = asyncio.run(run(args))
+    summary = job.to_dict(include_results=bool(args.output))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=4)
+    print(f"Batch {job.status}: {summary['completed']} completed, {summary['failed']} failed "
+          f"out of {summary['total']} patients")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+# loadtest.py
+"""
+Latency and throughput benchmark for the FastAPI backend.
+
+Starts bench/mock_llm.py and the backend app (uvicorn subprocess, fresh
+database per run), seeds a growing number of patients and drives a mixed
+workload of CRUD calls, schedule appends, /pt_schedule and
+/generate_exercises. Reports p50/p95/p99 latency per operation, overall
+throughput and server memory, plus the Test Case 8 SLO (100 generation
+requests in quick succession, 95% under 2s).
+
+    python bench/loadtest.py --patients 100 1000 5000 --requests 2000 --output bench.json
+    python bench/loadtest.py --patients 100 1000 --compare bench.json --tolerance 0.25
+
+Upstream faults can be injected into the mock (--llm-error-rate,
+--llm-slow-rate, ...) to measure the retry and hedging behaviour.
+
+With --compare the run exits non-zero if any operation's p95 or the
+throughput regresses by more than the tolerance.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+
+# Operation -> relative weight in the mixed workload.
+WORKLOAD = {
+    "list_patients": 5,
+    "get_patient": 30,
+    "create_patient": 5,
+    "update_patient": 10,
+    "append_exercise": 25,
+    "pt_schedule": 10,
+    "generate_exercises": 15,
+}
+
+INJURIES = ["Right Knee", "Left Knee", "Lower Back", "Right Shoulder", "Left Ankle", "Hip"]
+ACTIVITY_LEVELS = ["Sedentary", "Light", "Moderate", "Active", "Very Active"]
+# Generation is queued as a job; waiting for it keeps latencies end to end.
+GENERATE_PARAMS = {"wait": 60}
+
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(latencies: List[float], errors: int) -> Dict:
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "mean_ms": 1000 * sum(latencies) / len(latencies) if latencies else 0.0,
+        "p50_ms": 1000 * percentile(latencies, 50),
+        "p95_ms": 1000 * percentile(latencies, 95),
+        "p99_ms": 1000 * percentile(latencies, 99),
+    }
+
+
+def memory_mb(pid: int) -> Dict:
+    """Current and peak resident memory of a process (Linux only)."""
+    result = {"rss_mb": None, "peak_rss_mb": None}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    result["rss_mb"] = int(line.split()[1]) / 1024
+                elif line.startswith("VmHWM:"):
+                    result["peak_rss_mb"] = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return result
+
+
+def random_profile(rng: random.Random, name: str) -> Dict:
+    return {
+        "name": name,
+        "age": rng.randint(18, 85),
+        "injury_location": rng.choice(INJURIES),
+        "pain_level": rng.randint(1, 9),
+        "mobility_status": rng.choice(["Full", "Slightly Reduced", "Needs cane", "Partial weight-bearing"]),
+        "medical_history": rng.choice(["None", "Previous surgery", "Osteoarthritis", "Hypertension"]),
+        "activity_level": rng.choice(ACTIVITY_LEVELS),
+        "goals": rng.choice(["Return to running", "Walk without pain", "Improve strength", "Reduce stiffness"]),
+    }
+
+
+class Backend:
+    """The backend app running under uvicorn in a throwaway working directory."""
+
+    def __init__(self, mock_url: str, repository: str, extra_env: Optional[Dict] = None):
+        self.workdir = tempfile.TemporaryDirectory(prefix="pt-bench-")
+        os.makedirs(os.path.join(self.workdir.name, "database"))
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        env = dict(os.environ)
+        env.update({
+            "ANTHROPIC_BASE_URL": mock_url,
+            "ANTHROPIC_API_KEY": "bench",
+            "PATIENT_REPOSITORY": repository,
+        })
+        env.update(extra_env or {})
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_DIR,
+             "--port", str(self.port), "--log-level", "warning"],
+            cwd=self.workdir.name,
+            env=env,
+        )
+
+    def wait_ready(self, timeout: float = 30.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                if httpx.get(f"{self.url}/patients", timeout=1.0).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.1)
+        raise RuntimeError("Backend did not become ready")
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.workdir.cleanup()
+
+
+class Workload:
+    def __init__(self, client: httpx.AsyncClient, rng: random.Random, names: List[str], use_cache: bool):
+        self.client = client
+        self.rng = rng
+        self.names = names
+        self.use_cache = use_cache
+        self.created = 0
+        self.latencies: Dict[str, List[float]] = {op: [] for op in WORKLOAD}
+        self.errors: Dict[str, int] = {op: 0 for op in WORKLOAD}
+
+    async def request(self, op: str, method: str, url: str, **kwargs) -> Optional[httpx.Response]:
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+            elapsed = time.perf_counter() - start
+            if response.status_code >= 400:
+                self.errors[op] += 1
+            else:
+                self.latencies[op].append(elapsed)
+            return response
+        except httpx.HTTPError:
+            self.errors[op] += 1
+            return None
+
+    async def run_op(self, op: str):
+        name = self.rng.choice(self.names)
+        if op == "list_patients":
+            await self.request(op, "GET", "/patients")
+        elif op == "get_patient":
+            await self.request(op, "GET", f"/patients/{name}")
+        elif op == "create_patient":
+            self.created += 1
+            await self.request(op, "POST", "/patients", json=random_profile(self.rng, f"bench-new-{self.created}-{self.rng.random()}"))
+        elif op == "update_patient":
+            await self.request(op, "PUT", f"/patients/{name}", json={"pain_level": self.rng.randint(1, 9)})
+        elif op == "append_exercise":
+            exercise = {"id": str(self.rng.random()), "name": "Bench Exercise", "description": "",
+                        "parameters": "3x10", "progressionCriteria": "", "rationale": ""}
+            await self.request(op, "POST", f"/weekly_schedule/{name}/{self.rng.choice(DAYS)}", json=exercise)
+        elif op == "pt_schedule":
+            await self.request(op, "GET", "/pt_schedule")
+        elif op == "generate_exercises":
+            await self.request(op, "POST", "/generate_exercises", params=GENERATE_PARAMS,
+                               json={"patient_name": name, "num_exercises": 4, "use_cache": self.use_cache})
+
+
+async def seed(client: httpx.AsyncClient, rng: random.Random, count: int, concurrency: int) -> List[str]:
+    names = [f"bench-{i}" for i in range(count)]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def create(name: str):
+        async with semaphore:
+            await client.post("/patients", json=random_profile(rng, name))
+
+    await asyncio.gather(*(create(name) for name in names))
+    return names
+
+
+async def run_mixed(client: httpx.AsyncClient, rng: random.Random, names: List[str], args) -> Dict:
+    workload = Workload(client, rng, names, args.use_recommendation_cache)
+    ops = rng.choices(list(WORKLOAD), weights=list(WORKLOAD.values()), k=args.requests)
+    queue: asyncio.Queue = asyncio.Queue()
+    for op in ops:
+        queue.put_nowait(op)
+
+    async def worker():
+        while not queue.empty():
+            await workload.run_op(queue.get_nowait())
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    duration = time.perf_counter() - start
+    return {
+        "duration_s": duration,
+        "throughput_rps": args.requests / duration,
+        "ops": {op: summarize(workload.latencies[op], workload.errors[op]) for op in WORKLOAD},
+    }
+
+
+async def run_slo(client: httpx.AsyncClient, rng: random.Random, args) -> Dict:
+    """Test Case 8: 100 random patient profiles requested in quick succession."""
+    names = [f"slo-{i}" for i in range(args.slo_requests)]
+    for name in names:
+        await client.post("/patients", json=random_profile(rng, name))
+    workload = Workload(client, rng, names, args.use_recommendation_cache)
+
+    async def generate(name: str):
+        await workload.request("generate_exercises", "POST", "/generate_exercises", params=GENERATE_PARAMS,
+                               json={"patient_name": name, "num_exercises": 4,
+                                     "use_cache": args.use_recommendation_cache})
+
+    await asyncio.gather(*(generate(name) for name in names))
+    latencies = workload.latencies["generate_exercises"]
+    within = sum(1 for latency in latencies if latency <= args.slo_seconds)
+    return dict(
+        summarize(latencies, workload.errors["generate_exercises"]),
+        slo_seconds=args.slo_seconds,
+        fraction_within_slo=within / len(names),
+        passed=within / len(names) >= 0.95,
+    )
+
+
+async def run_for_count(backend: Backend, count: int, args) -> Dict:
+    rng = random.Random(args.seed + count)
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(base_url=backend.url, timeout=120.0, limits=limits) as client:
+        seed_start = time.perf_counter()
+        names = await seed(client, rng, count, args.concurrency)
+        seed_duration = time.perf_counter() - seed_start
+        result = {"patients": count, "seed_duration_s": seed_duration}
+        result.update(await run_mixed(client, rng, names, args))
+        if not args.skip_slo:
+            result["slo"] = await run_slo(client, rng, args)
+    result.update(memory_mb(backend.process.pid))
+    return result
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Returns a description of every regression beyond `tolerance`."""
+    regressions = []
+    baseline_runs = {run["patients"]: run for run in baseline.get("runs", [])}
+    for run in results["runs"]:
+        base = baseline_runs.get(run["patients"])
+        if base is None:
+            continue
+        label = f"{run['patients']} patients"
+        if run["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{label}: throughput {run['throughput_rps']:.1f} rps "
+                               f"vs baseline {base['throughput_rps']:.1f} rps")
+        for op, stats in run["ops"].items():
+            base_stats = base["ops"].get(op)
+            if not base_stats or not base_stats["count"] or not stats["count"]:
+                continue
+            if stats["p95_ms"] > base_stats["p95_ms"] * (1 + tolerance):
+                regressions.append(f"{label}: {op} p95 {stats['p95_ms']:.1f} ms "
+                                   f"vs baseline {base_stats['p95_ms']:.1f} ms")
+    return regressions
+
+
+def print_run(run: Dict):
+    memory = f"rss {run['rss_mb']:.1f} MB (peak {run['peak_rss_mb']:.1f} MB)" if run["rss_mb"] else "rss n/a"
+    print(f"\n== {run['patients']} patients: {run['throughput_rps']:.1f} req/s, {memory}")
+    print(f"{'operation':<20}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for op, stats in run["ops"].items():
+        print(f"{op:<20}{stats['count']:>7}{stats['errors']:>8}"
+              f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}")
+    if "slo" in run:
+        slo = run["slo"]
+        print(f"Case 8 SLO: {100 * slo['fraction_within_slo']:.0f}% under {slo['slo_seconds']}s "
+              f"(p95 {slo['p95_ms']:.0f} ms) -> {'PASS' if slo['passed'] else 'FAIL'}")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Benchmark the backend against a local mock LLM.")
+    parser.add_argument("--patients", type=int, nargs="+", default=[100, 1000], help="Patient counts to test")
+    parser.add_argument("--requests", type=int, default=1000, help="Mixed-workload requests per patient count")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--repository", default="json", choices=["json", "sqlite"])
+    parser.add_argument("--use-recommendation-cache", action="store_true",
+                        help="Let /generate_exercises serve cached recommendations")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Mock time to first token (s)")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="Mock fraction of failed calls")
+    parser.add_argument("--llm-error-status", type=int, default=529)
+    parser.add_argument("--llm-slow-rate", type=float, default=0.0, help="Mock fraction of slow calls")
+    parser.add_argument("--llm-slow-latency", type=float, default=10.0)
+    parser.add_argument("--slo-requests", type=int, default=100)
+    parser.add_argument("--slo-seconds", type=float, default=2.0)
+    parser.add_argument("--skip-slo", action="store_true")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="Write machine-readable results to this JSON file")
+    parser.add_argument("--compare", help="Baseline results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative regression")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    mock_port = free_port()
+    mock = subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, "mock_llm.py"), "--port", str(mock_port),
+        "--latency", str(args.llm_latency), "--tokens-per-second", str(args.llm_tokens_per_second),
+        "--error-rate", str(args.llm_error_rate), "--error-status", str(args.llm_error_status),
+        "--slow-rate", str(args.llm_slow_rate), "--slow-latency", str(args.llm_slow_latency),
+        "--seed", str(args.seed),
+    ])
+    results = {"config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")}, "runs": []}
+    try:
+        for count in args.patients:
+            backend = Backend(f"http://127.0.0.1:{mock_port}", args.repository)
+            try:
+                backend.wait_ready()
+                run = asyncio.run(run_for_count(backend, count, args))
+            finally:
+                backend.stop()
+            results["runs"].append(run)
+            print_run(run)
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\nNo regressions against baseline.")
+
+
+if __name__ == "__main__":
+    main()
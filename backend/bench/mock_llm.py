@@ -0,0 +1,224 @@
+# mock_llm.py
+"""
+Local stand-in for the Anthropic Messages API, for benchmarks.
+
+Serves POST /v1/messages (plain and streaming) with a synthetic
+recommendations payload containing the number of exercises the prompt
+asks for. Latency is modelled as a fixed time-to-first-token plus a token
+rate for the rest of the output.
+
+    python bench/mock_llm.py --port 8765 --latency 0.5 --tokens-per-second 200
+
+Point the backend at it with ANTHROPIC_BASE_URL=http://127.0.0.1:8765.
+
+Faults can be injected to exercise the backend's retries, hedging and
+circuit breaker:
+
+    python bench/mock_llm.py --error-rate 0.2 --error-status 529 --slow-rate 0.05 --slow-latency 10
+
+  - --error-rate: fraction of requests answered with --error-status
+  - --disconnect-rate: fraction of requests whose connection is dropped
+  - --slow-rate / --slow-latency: fraction of requests delayed by extra seconds
+  - --truncate-rate: fraction of responses cut off (stop_reason max_tokens)
+  - --fence-rate: fraction of responses wrapped in prose and a code fence
+  - --fail-first / --slow-first: fail or delay exactly the first N requests,
+    for deterministic tests (see backend/tests/test_llm_resilience.py)
+  - --retry-after: Retry-After header (seconds) on injected errors
+
+make_server() runs it in-process; `server.stats["requests"]` counts the
+POST /v1/messages requests received.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def build_payload(num_exercises: int) -> str:
+    exercises = [
+        {
+            "id": f"ex{i + 1}",
+            "name": f"Mock Exercise {i + 1}",
+            "description": "Slow, controlled movement through a comfortable range of motion.",
+            "parameters": "3 sets of 10 reps, daily",
+            "progressionCriteria": "Increase to 15 reps when pain stays below 3/10",
+            "rationale": "Restores range of motion and neuromuscular control.",
+        }
+        for i in range(num_exercises)
+    ]
+    return json.dumps({"exercises": exercises, "notes": "Generated by the mock LLM server."})
+
+
+ERROR_TYPES = {
+    400: "invalid_request_error",
+    429: "rate_limit_error",
+    500: "api_error",
+    503: "api_error",
+    529: "overloaded_error",
+}
+
+
+def requested_exercises(body: dict) -> int:
+    text = json.dumps(body.get("messages", []))
+    match = re.search(r"Generate exactly (\d+) exercises", text)
+    return int(match.group(1)) if match else 4
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config: argparse.Namespace = None
+    rng: random.Random = None
+    stats: dict = None
+    stats_lock: threading.Lock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.startswith("/v1/messages"):
+            self.send_error(404)
+            return
+        length = int(self.headers.get("content-length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        config = self.config
+        with self.stats_lock:
+            number = self.stats["requests"]
+            self.stats["requests"] += 1
+        if self.rng.random() < config.disconnect_rate:
+            self.close_connection = True
+            self.connection.shutdown(2)
+            return
+        if number < config.fail_first or self.rng.random() < config.error_rate:
+            time.sleep(config.latency / 2)
+            self._send_error(config.error_status)
+            return
+        if number < config.slow_first or self.rng.random() < config.slow_rate:
+            time.sleep(config.slow_latency)
+        text = build_payload(requested_exercises(body))
+        stop_reason = "end_turn"
+        if self.rng.random() < config.fence_rate:
+            text = f"Here is the plan:\n```json\n{text}\n```"
+        if self.rng.random() < config.truncate_rate:
+            text = text[:len(text) * 2 // 3]
+            stop_reason = "max_tokens"
+        # Roughly 4 characters per token.
+        output_tokens = max(1, len(text) // 4)
+        input_tokens = max(1, len(json.dumps(body)) // 4)
+
+        time.sleep(self.config.latency)
+        if body.get("stream"):
+            self._stream(body, text, input_tokens, output_tokens, stop_reason)
+        else:
+            time.sleep(output_tokens / self.config.tokens_per_second)
+            self._send_json(200, self._message(body, text, input_tokens, output_tokens, stop_reason))
+
+    def _message(self, body: dict, text: str, input_tokens: int, output_tokens: int,
+                 stop_reason: str = "end_turn") -> dict:
+        return {
+            "id": f"msg_{uuid.uuid4().hex}",
+            "type": "message",
+            "role": "assistant",
+            "model": body.get("model", "mock"),
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": stop_reason,
+            "stop_sequence": None,
+            "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens},
+        }
+
+    def _send_error(self, status: int):
+        error_type = ERROR_TYPES.get(status, "api_error")
+        if self.config.retry_after is not None:
+            headers = {"retry-after": str(self.config.retry_after)}
+        else:
+            headers = {"retry-after": "1"} if status == 429 else {}
+        self._send_json(status, {"type": "error", "error": {"type": error_type, "message": "Injected fault"}}, headers)
+
+    def _send_json(self, status: int, payload: dict, headers: dict = None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("content-length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, body: dict, text: str, input_tokens: int, output_tokens: int, stop_reason: str):
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("transfer-encoding", "chunked")
+        self.end_headers()
+
+        def event(name: str, data: dict):
+            chunk = f"event: {name}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(chunk):x}\r\n".encode("ascii") + chunk + b"\r\n")
+            self.wfile.flush()
+
+        message = self._message(body, "", input_tokens, 1)
+        message["content"] = []
+        message["stop_reason"] = None
+        event("message_start", {"type": "message_start", "message": message})
+        event("content_block_start", {"type": "content_block_start", "index": 0,
+                                      "content_block": {"type": "text", "text": ""}})
+        chunk_chars = 4 * self.config.tokens_per_chunk
+        for start in range(0, len(text), chunk_chars):
+            time.sleep(self.config.tokens_per_chunk / self.config.tokens_per_second)
+            event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                          "delta": {"type": "text_delta", "text": text[start:start + chunk_chars]}})
+        event("content_block_stop", {"type": "content_block_stop", "index": 0})
+        event("message_delta", {"type": "message_delta",
+                                "delta": {"stop_reason": stop_reason, "stop_sequence": None},
+                                "usage": {"output_tokens": output_tokens}})
+        event("message_stop", {"type": "message_stop"})
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def make_server(host: str, port: int, config: argparse.Namespace) -> ThreadingHTTPServer:
+    rng = random.Random(config.seed)
+    stats = {"requests": 0}
+    handler = type("ConfiguredMockLLMHandler", (MockLLMHandler,),
+                   {"config": config, "rng": rng, "stats": stats, "stats_lock": threading.Lock()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.stats = stats
+    return server
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Mock Anthropic Messages API for benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="Output token rate")
+    parser.add_argument("--tokens-per-chunk", type=int, default=8, help="Tokens per streamed delta")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, default=529, help="HTTP status of injected failures")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="Fraction of connections dropped")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Fraction of requests delayed further")
+    parser.add_argument("--slow-latency", type=float, default=10.0, help="Extra delay of slow requests (s)")
+    parser.add_argument("--truncate-rate", type=float, default=0.0, help="Fraction of responses cut off")
+    parser.add_argument("--fence-rate", type=float, default=0.0, help="Fraction of responses in a code fence")
+    parser.add_argument("--fail-first", type=int, default=0, help="Fail the first N requests")
+    parser.add_argument("--slow-first", type=int, default=0, help="Delay the first N requests by --slow-latency")
+    parser.add_argument("--retry-after", type=float, help="Retry-After (s) sent with injected errors")
+    parser.add_argument("--seed", type=int, help="Seed for fault injection")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    server = make_server(args.host, args.port, args)
+    print(f"Mock LLM listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
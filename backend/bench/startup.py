@@ -0,0 +1,161 @@
+# startup.py
+"""
+Cold-start benchmark for the backend.
+
+For each database size it writes a synthetic database/patients.json in a
+throwaway directory and measures, as medians over --runs fresh processes:
+
+  - import: time for `import main` in a new interpreter
+  - listening: time from launching uvicorn until it answers /ready at all
+  - ready: time until /ready returns 200 (repository loaded)
+
+    python bench/startup.py --patients 0 1000 10000 --runs 5 --output startup.json
+    python bench/startup.py --patients 0 10000 --compare startup.json --tolerance 0.25
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from loadtest import free_port, random_profile  # noqa: E402
+
+
+def write_database(workdir: str, count: int):
+    import random
+    rng = random.Random(count)
+    os.makedirs(os.path.join(workdir, "database"), exist_ok=True)
+    patients = {}
+    for i in range(count):
+        profile = random_profile(rng, f"patient-{i}")
+        del profile["name"]
+        profile["weekly_schedule"] = {day: [] for day in
+                                      ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]}
+        profile["recommendations"] = {}
+        patients[f"patient-{i}"] = profile
+    with open(os.path.join(workdir, "database", "patients.json"), "w") as f:
+        json.dump(patients, f)
+
+
+def measure_import(workdir: str, env: Dict) -> float:
+    code = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+    output = subprocess.run(
+        [sys.executable, "-c", code], cwd=workdir, env=dict(env, PYTHONPATH=BACKEND_DIR),
+        capture_output=True, text=True, check=True,
+    )
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def measure_server(workdir: str, env: Dict, timeout: float = 60.0) -> Dict:
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/ready"
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_DIR,
+         "--port", str(port), "--log-level", "warning"],
+        cwd=workdir, env=env,
+    )
+    listening = None
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                response = httpx.get(url, timeout=1.0)
+            except httpx.HTTPError:
+                time.sleep(0.005)
+                continue
+            if listening is None:
+                listening = time.perf_counter() - start
+            if response.status_code == 200:
+                return {"listening_s": listening, "ready_s": time.perf_counter() - start}
+            time.sleep(0.005)
+        raise RuntimeError("Backend did not become ready")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def run_for_count(count: int, args) -> Dict:
+    env = dict(os.environ, ANTHROPIC_API_KEY="bench", PATIENT_REPOSITORY=args.repository)
+    imports: List[float] = []
+    listening: List[float] = []
+    ready: List[float] = []
+    for _ in range(args.runs):
+        # A fresh directory each run so the store starts from the snapshot alone.
+        with tempfile.TemporaryDirectory(prefix="pt-startup-") as workdir:
+            write_database(workdir, count)
+            imports.append(measure_import(workdir, env))
+        with tempfile.TemporaryDirectory(prefix="pt-startup-") as workdir:
+            write_database(workdir, count)
+            server = measure_server(workdir, env)
+            listening.append(server["listening_s"])
+            ready.append(server["ready_s"])
+    return {
+        "patients": count,
+        "import_s": statistics.median(imports),
+        "listening_s": statistics.median(listening),
+        "ready_s": statistics.median(ready),
+    }
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    regressions = []
+    baseline_runs = {run["patients"]: run for run in baseline.get("runs", [])}
+    for run in results["runs"]:
+        base = baseline_runs.get(run["patients"])
+        if base is None:
+            continue
+        for metric in ("import_s", "listening_s", "ready_s"):
+            if run[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{run['patients']} patients: {metric} {run[metric]:.3f}s "
+                                   f"vs baseline {base[metric]:.3f}s")
+    return regressions
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Measure backend cold-start time.")
+    parser.add_argument("--patients", type=int, nargs="+", default=[0, 1000, 10000], help="Database sizes")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh processes per size (median is reported)")
+    parser.add_argument("--repository", default="json", choices=["json", "sqlite"])
+    parser.add_argument("--output", help="Write machine-readable results to this JSON file")
+    parser.add_argument("--compare", help="Baseline results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative regression")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    results = {"config": {"runs": args.runs, "repository": args.repository}, "runs": []}
+    print(f"{'patients':>10}{'import s':>12}{'listening s':>14}{'ready s':>10}")
+    for count in args.patients:
+        run = run_for_count(count, args)
+        results["runs"].append(run)
+        print(f"{count:>10}{run['import_s']:>12.3f}{run['listening_s']:>14.3f}{run['ready_s']:>10.3f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\nNo regressions against baseline.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+# bulk.py
+"""
+Row formats for bulk patient import (POST /patients/bulk) and export
+(GET /patients/export).
+
+  - ndjson: one JSON object per line, `{"name": ..., <profile fields>,
+    "weekly_schedule": {...}, "recommendations": {...}}`
+  - csv: a header row, then one patient per row; weekly_schedule and
+    recommendations are JSON-encoded cells
+
+Import rows need the PatientCreate fields; weekly_schedule and
+recommendations are optional, so an export can be imported again as is.
+Both directions work row by row, so neither holds more than a chunk of
+the body in memory.
+"""
+import csv
+import io
+import json
+from typing import AsyncIterator, Dict, Iterable, Iterator, Tuple, Union
+
+from models import PatientCreate
+from repository import PROFILE_FIELDS
+from utils import create_weekly_schedule
+
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+CSV_COLUMNS = ["name"] + PROFILE_FIELDS + ["weekly_schedule", "recommendations"]
+# Export output is buffered into chunks of about this many bytes.
+CHUNK_SIZE = 64 * 1024
+
+
+def format_for(content_type: str) -> str:
+    return "csv" if "csv" in (content_type or "") else "ndjson"
+
+
+# ----------------------------------------------------------------------
+# Import
+# ----------------------------------------------------------------------
+def _decode(line: bytes) -> str:
+    return line.decode("utf-8", errors="replace").rstrip("\r")
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Splits the body into lines, scanning each chunk once so a line spanning many chunks stays linear."""
+    pending = bytearray()
+    async for chunk in chunks:
+        start = 0
+        end = chunk.find(b"\n")
+        while end != -1:
+            if pending:
+                pending += chunk[start:end]
+                yield _decode(pending)
+                pending.clear()
+            else:
+                yield _decode(chunk[start:end])
+            start = end + 1
+            end = chunk.find(b"\n", start)
+        pending += chunk[start:]
+    if pending:
+        yield _decode(pending)
+
+
+async def iter_rows(chunks: AsyncIterator[bytes], fmt: str) -> AsyncIterator[Tuple[int, Union[str, Dict]]]:
+    """
+    Yields (row number, raw row) from a request body: the line for ndjson,
+    a column -> cell dict for csv. Blank lines are skipped; a quoted csv
+    cell may span lines.
+    """
+    header = None
+    record = []  # lines of a csv row whose quoted cell spans lines
+    quotes = 0
+    row = 0
+    async for line in _lines(chunks):
+        if fmt == "ndjson":
+            if line.strip():
+                row += 1
+                yield row, line
+            continue
+        record.append(line)
+        quotes += line.count('"')
+        if quotes % 2:
+            continue  # inside a quoted cell
+        text = "\n".join(record)
+        record, quotes = [], 0
+        if not text.strip():
+            continue
+        values = next(csv.reader([text]))
+        if header is None:
+            header = [value.strip() for value in values]
+            continue
+        row += 1
+        yield row, dict(zip(header, values))
+    text = "\n".join(record)
+    if text.strip():
+        row += 1
+        yield row, text  # unterminated quote; parse_row rejects it
+
+
+def parse_row(raw: Union[str, Dict]) -> Tuple[str, Dict]:
+    """Validates one import row into (name, record). Raises ValueError (incl. pydantic's ValidationError)."""
+    if isinstance(raw, str):
+        raw = json.loads(raw)
+    if not isinstance(raw, dict):
+        raise ValueError("row must be an object")
+    patient = PatientCreate(**raw)
+    data = patient.dict(exclude={"name"})
+    data["weekly_schedule"] = _schedule(_json_cell(raw.get("weekly_schedule")))
+    data["recommendations"] = _json_cell(raw.get("recommendations")) or {}
+    if not isinstance(data["recommendations"], dict):
+        raise ValueError("recommendations must be an object")
+    return patient.name, data
+
+
+def row_name(raw: Union[str, Dict]):
+    """Best-effort patient name of a row that failed parse_row(), for error reports."""
+    if isinstance(raw, str):
+        try:
+            raw = json.loads(raw)
+        except ValueError:
+            return None
+    return raw.get("name") if isinstance(raw, dict) else None
+
+
+def _json_cell(value):
+    if isinstance(value, str):
+        return json.loads(value) if value.strip() else None
+    return value
+
+
+def _schedule(value) -> Dict:
+    schedule = create_weekly_schedule()
+    if value is None:
+        return schedule
+    if not isinstance(value, dict):
+        raise ValueError("weekly_schedule must be an object")
+    for day, exercises in value.items():
+        if day not in schedule:
+            raise ValueError(f"Invalid day in weekly_schedule: {day}")
+        if not isinstance(exercises, list) or not all(isinstance(ex, dict) and ex.get("name") for ex in exercises):
+            raise ValueError(f"weekly_schedule.{day} must be a list of exercises with names")
+        schedule[day] = exercises
+    return schedule
+
+
+# ----------------------------------------------------------------------
+# Export
+# ----------------------------------------------------------------------
+def _ndjson_rows(patients: Iterable[Tuple[str, Dict]]) -> Iterator[str]:
+    for name, data in patients:
+        yield json.dumps(dict(data, name=name)) + "\n"
+
+
+def _csv_rows(patients: Iterable[Tuple[str, Dict]]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    for name, data in patients:
+        writer.writerow(
+            [name] + [data.get(field) for field in PROFILE_FIELDS]
+            + [json.dumps(data.get("weekly_schedule") or {}), json.dumps(data.get("recommendations") or {})]
+        )
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def export_chunks(patients: Iterable[Tuple[str, Dict]], fmt: str) -> Iterator[bytes]:
+    """Encodes (name, record) pairs as `fmt`, in chunks of about CHUNK_SIZE bytes."""
+    rows = _csv_rows(patients) if fmt == "csv" else _ndjson_rows(patients)
+    chunk = []
+    size = 0
+    for row in rows:
+        chunk.append(row)
+        size += len(row)
+        if size >= CHUNK_SIZE:
+            yield "".join(chunk).encode("utf-8")
+            chunk = []
+            size = 0
+    if chunk:
+        yield "".join(chunk).encode("utf-8")
@@ -0,0 +1,186 @@
+# cache.py
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+# Patient fields interpolated into the generation prompt (see services.build_user_prompt).
+PROMPT_FIELDS = [
+    "age",
+    "injury_location",
+    "pain_level",
+    "mobility_status",
+    "medical_history",
+    "activity_level",
+    "goals",
+]
+
+
+def normalize(value) -> str:
+    """Case- and whitespace-insensitive form of a prompt field."""
+    return " ".join(str(value).split()).casefold()
+
+
+def profile_key(patient_data: Dict) -> str:
+    """Hash of the normalized prompt fields of a patient."""
+    profile = [normalize(patient_data.get(field, "")) for field in PROMPT_FIELDS]
+    return hashlib.sha256(json.dumps(profile).encode("utf-8")).hexdigest()
+
+
+class RecommendationCache:
+    """
+    Persistent content-addressed cache of generated recommendations.
+
+    Entries are keyed on the normalized patient profile, num_exercises and
+    the model name, expire after `ttl` seconds and are evicted least
+    recently used once more than `max_entries` are stored. Expired entries
+    can still be read with get_stale().
+
+    The methods block on SQLite; call them from a thread, not the event
+    loop. Hits only read: their access times are kept in memory and
+    written in one batch with the next put() (or every TOUCH_BATCH hits).
+    The entry count is read once and then tracked in memory, so it is
+    approximate when several processes share the file.
+    """
+
+    TOUCH_BATCH = 256
+
+    def __init__(self, path: str, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._count = 0
+        self._touched: Dict[str, float] = {}  # key -> access time not yet written
+
+    def _connect(self) -> sqlite3.Connection:
+        """Returns the connection, opening (and creating) the database on first use. Call with _lock held."""
+        if self._conn is None:
+            self._conn = self._open()
+        return self._conn
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS recommendation_cache (
+                    key TEXT PRIMARY KEY,
+                    profile_key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_recommendation_cache_profile ON recommendation_cache (profile_key);
+                CREATE INDEX IF NOT EXISTS idx_recommendation_cache_accessed ON recommendation_cache (accessed_at);
+                """
+            )
+        (self._count,) = conn.execute("SELECT COUNT(*) FROM recommendation_cache").fetchone()
+        return conn
+
+    def _write_touches(self, conn: sqlite3.Connection):
+        """Writes pending access times; call inside a transaction with _lock held."""
+        if self._touched:
+            conn.executemany(
+                "UPDATE recommendation_cache SET accessed_at = ? WHERE key = ?",
+                [(accessed_at, key) for key, accessed_at in self._touched.items()],
+            )
+            self._touched.clear()
+
+    @staticmethod
+    def key(patient_data: Dict, num_exercises: int, model: str) -> str:
+        payload = json.dumps([profile_key(patient_data), num_exercises, model])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Returns the cached recommendations, or None on a miss or expired entry."""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT value, created_at FROM recommendation_cache WHERE key = ?", (key,)
+            ).fetchone()
+            # Expired rows are kept for get_stale() until LRU eviction removes them.
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            self._touched[key] = now
+            if len(self._touched) >= self.TOUCH_BATCH:
+                with conn:
+                    self._write_touches(conn)
+            self.hits += 1
+        return json.loads(row[0])
+
+    def get_stale(self, key: str) -> Optional[Dict]:
+        """Returns the cached recommendations even if expired; used when the model is unavailable."""
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT value FROM recommendation_cache WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, key: str, patient_data: Dict, value: Dict):
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            self._touched.pop(key, None)
+            self._write_touches(conn)
+            exists = conn.execute("SELECT 1 FROM recommendation_cache WHERE key = ?", (key,)).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO recommendation_cache (key, profile_key, value, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, profile_key(patient_data), json.dumps(value), now, now),
+            )
+            if exists is None:
+                self._count += 1
+            overflow = self._count - self.max_entries
+            if overflow > 0:
+                cursor = conn.execute(
+                    "DELETE FROM recommendation_cache WHERE key IN "
+                    "(SELECT key FROM recommendation_cache ORDER BY accessed_at LIMIT ?)",
+                    (overflow,),
+                )
+                self._count -= cursor.rowcount
+                self.evictions += cursor.rowcount
+
+    def invalidate_profile(self, patient_data: Dict) -> int:
+        """Drops every entry generated for this patient profile."""
+        with self._lock, self._connect() as conn:
+            cursor = conn.execute(
+                "DELETE FROM recommendation_cache WHERE profile_key = ?", (profile_key(patient_data),)
+            )
+            self._count = max(0, self._count - cursor.rowcount)
+        return cursor.rowcount
+
+    def clear(self) -> int:
+        with self._lock, self._connect() as conn:
+            cursor = conn.execute("DELETE FROM recommendation_cache")
+            self._count = 0
+            self._touched.clear()
+        return cursor.rowcount
+
+    def stats(self) -> Dict:
+        with self._lock:
+            self._connect()
+            entries = self._count
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                with self._conn:
+                    self._write_touches(self._conn)
+                self._conn.close()
+                self._conn = None
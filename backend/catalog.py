@@ -0,0 +1,180 @@
+# catalog.py
+import hashlib
+import json
+import os
+import sys
+import threading
+from typing import Dict, Iterable, List, Optional, Union
+
+# A stored exercise is either a catalog reference (str) or, for data written
+# before the catalog existed, the full exercise dict.
+Entry = Union[str, Dict]
+
+
+def exercise_ref(exercise: Dict) -> str:
+    """Content hash of an exercise; equal exercises always get the same ref."""
+    canonical = json.dumps(exercise, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:24]
+
+
+class ExerciseCatalog:
+    """
+    Content-addressed store of exercise dicts. Schedules and
+    recommendations keep short refs; each distinct exercise is held once
+    in memory and, when `path` is given, written once to an append-only
+    JSON-lines file. Entries are immutable, so appending them is always
+    safe and a torn trailing line is simply dropped on load.
+
+    New entries are fsynced before intern() returns, so a patient record
+    written afterwards never refers to a ref that a crash could lose.
+    resolve() hands out copies; the shared entries are never exposed to
+    callers that might edit them.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._entries: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._file = None
+
+    def load(self) -> "ExerciseCatalog":
+        with self._lock:
+            if self.path is None:
+                return self
+            good_offset = 0
+            if os.path.exists(self.path):
+                with open(self.path, "rb") as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            break
+                        self._remember(record["ref"], record["exercise"])
+                        good_offset += len(line)
+                if good_offset != os.path.getsize(self.path):
+                    with open(self.path, "r+b") as f:
+                        f.truncate(good_offset)
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        return self
+
+    def _remember(self, ref: str, exercise: Dict) -> str:
+        ref = sys.intern(ref)
+        self._entries[ref] = exercise
+        return ref
+
+    def intern(self, exercise: Dict) -> str:
+        """Returns the exercise's ref, persisting it first if it is new."""
+        ref = exercise_ref(exercise)
+        if ref in self._entries:
+            return sys.intern(ref)
+        with self._lock:
+            if ref not in self._entries:
+                if self._file is not None:
+                    self._file.write(json.dumps({"ref": ref, "exercise": exercise}) + "\n")
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                ref = self._remember(ref, dict(exercise))
+        return sys.intern(ref)
+
+    def add(self, ref: str, exercise: Dict) -> Dict:
+        """Memoizes an entry that is persisted elsewhere (e.g. in SQLite) and returns the shared copy."""
+        with self._lock:
+            existing = self._entries.get(ref)
+            if existing is None:
+                self._remember(ref, exercise)
+                existing = exercise
+            return existing
+
+    def get(self, ref: str) -> Optional[Dict]:
+        return self._entries.get(ref)
+
+    def resolve(self, entry: Entry) -> Dict:
+        if not isinstance(entry, str):
+            return entry
+        exercise = self._entries.get(entry)
+        if exercise is None:
+            print(f"Exercise catalog entry {entry} is missing")
+            return {"name": "Unknown exercise", "ref": entry}
+        return dict(exercise)
+
+    def resolve_all(self, entries: Iterable[Entry]) -> List[Dict]:
+        return [self.resolve(entry) for entry in entries]
+
+    def __contains__(self, ref: str) -> bool:
+        return ref in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def retain(self, refs: Iterable[str]):
+        """
+        Drops entries not in `refs` and rewrites the file with the rest.
+        Only call it while nothing else is writing (e.g. at startup).
+        """
+        live = set(refs)
+        with self._lock:
+            self._entries = {ref: ex for ref, ex in self._entries.items() if ref in live}
+            if self.path is None:
+                return
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for ref, exercise in self._entries.items():
+                    f.write(json.dumps({"ref": ref, "exercise": exercise}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            if self._file is not None:
+                self._file.close()
+            os.replace(tmp_path, self.path)
+            self._file = open(self.path, "a", encoding="utf-8")
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def to_refs(catalog: ExerciseCatalog, data: Dict) -> Dict:
+    """Shallow copy of a patient record with its exercises replaced by catalog refs."""
+    stored = dict(data)
+    if "weekly_schedule" in data:
+        stored["weekly_schedule"] = {
+            day: [catalog.intern(ex) if isinstance(ex, dict) else sys.intern(ex) for ex in exercises]
+            for day, exercises in data["weekly_schedule"].items()
+        }
+    if data.get("recommendations"):
+        stored["recommendations"] = recommendations_to_refs(catalog, data["recommendations"])
+    return stored
+
+
+def recommendations_to_refs(catalog: ExerciseCatalog, recommendations: Dict) -> Dict:
+    stored = dict(recommendations)
+    if "exercises" in recommendations:
+        stored["exercises"] = [catalog.intern(ex) if isinstance(ex, dict) else sys.intern(ex)
+                               for ex in recommendations["exercises"]]
+    return stored
+
+
+def from_refs(catalog: ExerciseCatalog, data: Dict) -> Dict:
+    """Shallow copy of a stored patient record with catalog refs dereferenced."""
+    resolved = dict(data)
+    if "weekly_schedule" in data:
+        resolved["weekly_schedule"] = {
+            day: catalog.resolve_all(exercises) for day, exercises in data["weekly_schedule"].items()
+        }
+    recommendations = data.get("recommendations")
+    if recommendations and "exercises" in recommendations:
+        resolved["recommendations"] = dict(recommendations, exercises=catalog.resolve_all(recommendations["exercises"]))
+    return resolved
+
+
+def refs_in(data: Dict) -> Iterable[str]:
+    """Every catalog ref a stored patient record points to."""
+    for exercises in data.get("weekly_schedule", {}).values():
+        for entry in exercises:
+            if isinstance(entry, str):
+                yield entry
+    for entry in (data.get("recommendations") or {}).get("exercises", []):
+        if isinstance(entry, str):
+            yield entry
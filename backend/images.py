@@ -0,0 +1,209 @@
+# images.py
+"""
+Preprocessing and result caching for photos sent to the model by
+POST /detect_injury_location.
+
+Uploads are decoded, EXIF-rotated, downscaled so the long edge is at most
+IMAGE_MAX_EDGE pixels and re-encoded as JPEG in a process pool, so large
+phone photos neither block the event loop nor inflate the request and its
+image tokens.
+
+Results are cached by a SHA-256 of the normalized (decoded, rotated,
+downscaled) pixels, so only the same picture hits the cache, whatever its
+file encoding. Matching near-identical photos is opt-in (max_distance):
+a candidate must be close by 64-bit difference hash (dHash) and then also
+pass a pixel comparison of small grayscale thumbnails, since unrelated
+low-texture images often share a dHash.
+
+Pillow is optional and imported on first use, so importing the API does
+not pay for it: without it images are sent as uploaded (JPEG, PNG, GIF
+or WebP only) and cached by a hash of their exact bytes.
+"""
+import asyncio
+import hashlib
+import io
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from metrics import span
+
+# PIL.Image and PIL.ImageOps once _load_pillow() found them.
+Image = None
+ImageOps = None
+_pillow_checked = False
+
+IMAGE_MAX_UPLOAD_BYTES = int(os.environ.get("IMAGE_MAX_UPLOAD_MB", "20")) * 1024 * 1024
+IMAGE_MAX_EDGE = int(os.environ.get("IMAGE_MAX_EDGE", "1024"))
+IMAGE_JPEG_QUALITY = int(os.environ.get("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", str(min(2, os.cpu_count() or 1))))
+# Side of the grayscale thumbnail a near-duplicate match is confirmed with, and the
+# largest mean per-pixel difference (0-255) still counted as the same photo.
+FINGERPRINT_SIZE = 32
+NEAR_MATCH_MAX_DIFF = float(os.environ.get("IMAGE_NEAR_MATCH_MAX_DIFF", "4"))
+
+# Magic bytes of the formats the model accepts.
+SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+class PreparedImage(NamedTuple):
+    data: bytes
+    media_type: str
+    image_hash: str  # sha256 hex of the normalized pixels (of the raw bytes without Pillow)
+    width: int  # 0 when unknown (no Pillow)
+    height: int
+    original_bytes: int
+    perceptual_hash: Optional[str] = None  # dHash, 16 hex digits; None without Pillow
+    fingerprint: Optional[bytes] = None  # FINGERPRINT_SIZE^2 grayscale pixels
+
+
+def _load_pillow() -> bool:
+    """Imports Pillow on first call (optional, see module docstring); returns whether it is available."""
+    global Image, ImageOps, _pillow_checked
+    if not _pillow_checked:
+        try:
+            from PIL import Image, ImageOps
+        except ImportError:
+            pass
+        _pillow_checked = True
+    return Image is not None
+
+
+def sniff_media_type(data: bytes) -> Optional[str]:
+    for signature, media_type in SIGNATURES:
+        if data.startswith(signature):
+            return media_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def dhash(image) -> str:
+    """Difference hash: one bit per horizontally adjacent pixel pair of a 9x8 grayscale thumbnail."""
+    pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+
+def prepare_image(raw: bytes) -> PreparedImage:
+    """Downscales and re-encodes one upload. Runs in a worker process; raises ValueError for non-images."""
+    if not _load_pillow():
+        media_type = sniff_media_type(raw)
+        if media_type is None:
+            raise ValueError("Unsupported image format; send JPEG, PNG, GIF or WebP")
+        return PreparedImage(raw, media_type, hashlib.sha256(raw).hexdigest(), 0, 0, len(raw))
+    try:
+        image = Image.open(io.BytesIO(raw))
+        # JPEG can decode straight at a reduced scale, which is most of the saving for big photos.
+        image.draft("RGB", (IMAGE_MAX_EDGE, IMAGE_MAX_EDGE))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGB")
+    except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+        raise ValueError(f"Could not read image: {e}")
+    image.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.LANCZOS)
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    digest = hashlib.sha256(b"%dx%d:" % image.size + image.tobytes()).hexdigest()
+    fingerprint = image.convert("L").resize((FINGERPRINT_SIZE, FINGERPRINT_SIZE), Image.LANCZOS).tobytes()
+    return PreparedImage(out.getvalue(), "image/jpeg", digest, image.width, image.height, len(raw),
+                         dhash(image), fingerprint)
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, not fork: the server process has threads (repository, flusher) holding locks.
+            _pool = ProcessPoolExecutor(max_workers=max(1, IMAGE_WORKERS), mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+async def prepare(raw: bytes) -> PreparedImage:
+    """prepare_image() off the event loop, in the process pool when Pillow does real work."""
+    with span("image.prepare"):
+        if not _load_pillow():
+            return prepare_image(raw)
+        return await asyncio.get_running_loop().run_in_executor(_get_pool(), prepare_image, raw)
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
+
+
+def _same_picture(a: bytes, b: bytes) -> bool:
+    return len(a) == len(b) and sum(abs(x - y) for x, y in zip(a, b)) / len(a) <= NEAR_MATCH_MAX_DIFF
+
+
+class ImageResultCache:
+    """
+    LRU cache of detection results by exact image hash (PreparedImage.image_hash).
+
+    With `max_distance` > 0, a miss also considers entries whose dHash is
+    within that many differing bits, and serves one only if its thumbnail
+    fingerprint confirms it is the same picture. That scan is linear in
+    the cache size.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_distance: int = 0):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        # image_hash -> (result, perceptual_hash, fingerprint)
+        self._entries: "OrderedDict[str, Tuple[Dict, Optional[str], Optional[bytes]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, image: PreparedImage) -> Optional[Dict]:
+        with self._lock:
+            key = image.image_hash if image.image_hash in self._entries else self._nearest(image)
+            if key is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+
+    def _nearest(self, image: PreparedImage) -> Optional[str]:
+        if self.max_distance <= 0 or image.perceptual_hash is None or image.fingerprint is None:
+            return None
+        value = int(image.perceptual_hash, 16)
+        candidates = []
+        for key, (_, perceptual_hash, fingerprint) in self._entries.items():
+            if perceptual_hash is None or fingerprint is None:
+                continue
+            distance = bin(value ^ int(perceptual_hash, 16)).count("1")
+            if distance <= self.max_distance:
+                candidates.append((distance, key, fingerprint))
+        for _, key, fingerprint in sorted(candidates):
+            if _same_picture(image.fingerprint, fingerprint):
+                return key
+        return None
+
+    def put(self, image: PreparedImage, result: Dict):
+        with self._lock:
+            self._entries[image.image_hash] = (result, image.perceptual_hash, image.fingerprint)
+            self._entries.move_to_end(image.image_hash)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
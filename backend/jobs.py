@@ -0,0 +1,533 @@
+# jobs.py
+import asyncio
+import ipaddress
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from fastapi.concurrency import run_in_threadpool
+
+from cache import RecommendationCache
+from repository import PatientRepository
+from services import MODEL, LLMUnavailable, generate_exercises, similarity_index
+
+# How many finished batch jobs to remember for polling.
+MAX_BATCH_JOBS = 100
+
+
+class BatchJob:
+    """Progress and per-patient results of one batch generation run."""
+
+    def __init__(self, patient_names: List[str], num_exercises: int):
+        self.id = uuid.uuid4().hex
+        self.patient_names = patient_names
+        self.num_exercises = num_exercises
+        self.status = "pending"
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.unique_profiles = 0
+        self.usage = {"input_tokens": 0, "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0, "output_tokens": 0}
+        self.results: Dict[str, Dict] = {name: {"status": "pending"} for name in patient_names}
+        self.task: Optional[asyncio.Task] = None
+
+    def record(self, name: str, status: str, detail: Optional[str] = None, exercises: int = 0):
+        result = {"status": status}
+        if detail:
+            result["detail"] = detail
+        if status == "completed":
+            result["exercises"] = exercises
+        self.results[name] = result
+
+    def to_dict(self, include_results: bool = True) -> Dict:
+        counts = {"pending": 0, "completed": 0, "failed": 0}
+        for result in self.results.values():
+            counts[result["status"]] += 1
+        data = {
+            "job_id": self.id,
+            "status": self.status,
+            "total": len(self.patient_names),
+            "unique_profiles": self.unique_profiles,
+            "usage": self.usage,
+            "completed": counts["completed"],
+            "failed": counts["failed"],
+            "pending": counts["pending"],
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+        if include_results:
+            data["results"] = self.results
+        return data
+
+
+batch_jobs: "OrderedDict[str, BatchJob]" = OrderedDict()
+
+
+def register_batch_job(job: BatchJob):
+    """Keeps the job pollable, dropping the oldest finished jobs past MAX_BATCH_JOBS."""
+    batch_jobs[job.id] = job
+    while len(batch_jobs) > MAX_BATCH_JOBS:
+        oldest_id, oldest = next(iter(batch_jobs.items()))
+        if oldest.status in ("pending", "running"):
+            break
+        del batch_jobs[oldest_id]
+
+
+async def run_batch_generation(job: BatchJob, repo: PatientRepository, concurrency: int, use_cache: bool = True):
+    """
+    Generates recommendations for every patient of the job, at most
+    `concurrency` model calls at a time. Patients with identical profiles
+    share one generation, and all results are stored in a single commit.
+    """
+    job.status = "running"
+    groups: Dict[str, List[str]] = {}
+    profiles: Dict[str, Dict] = {}
+    for name in job.patient_names:
+        patient_data = await run_in_threadpool(repo.get, name)
+        if patient_data is None:
+            job.record(name, "failed", "Patient not found")
+            continue
+        key = RecommendationCache.key(patient_data, job.num_exercises, MODEL)
+        groups.setdefault(key, []).append(name)
+        profiles.setdefault(key, patient_data)
+    job.unique_profiles = len(groups)
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    generated: Dict[str, Dict] = {}
+
+    async def generate(key: str):
+        usage = {}
+        async with semaphore:
+            try:
+                recommendations = await generate_exercises(profiles[key], job.num_exercises, use_cache=use_cache, usage=usage)
+            except LLMUnavailable as e:
+                for name in groups[key]:
+                    job.record(name, "failed", str(e))
+                return
+            except Exception as e:
+                # One bad group must not cost the job the groups that succeeded.
+                print(f"Batch generation {job.id}: generating for {', '.join(groups[key])} failed: {e}")
+                for name in groups[key]:
+                    job.record(name, "failed", "Failed to generate exercises")
+                return
+        for field in job.usage:
+            job.usage[field] += usage.get(field, 0)
+        for name in groups[key]:
+            if recommendations:
+                generated[name] = recommendations
+                job.record(name, "completed", exercises=len(recommendations.get("exercises", [])))
+            else:
+                job.record(name, "failed", "Failed to generate exercises")
+
+    try:
+        await asyncio.gather(*(generate(key) for key in groups))
+        await run_in_threadpool(repo.set_recommendations_many, generated)
+        if similarity_index.built:
+            for key, names in groups.items():
+                for name in names:
+                    if name in generated:
+                        similarity_index.add(name, profiles[key], generated[name])
+        job.status = "completed"
+    except Exception as e:
+        print(f"Batch generation {job.id} failed: {e}")
+        job.status = "failed"
+    finally:
+        job.finished_at = time.time()
+
+
+def ensure_similarity_index(repo: PatientRepository):
+    """Builds the similar-patient index from stored recommendations on first use."""
+    if not similarity_index.built:
+        similarity_index.build(repo.iter_patients())
+
+
+class GenerationFailed(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: Optional[float] = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+async def generate_for_patient(repo: PatientRepository, patient_name: str, num_exercises: int,
+                               use_cache: bool = True, mode: str = "auto") -> Dict:
+    """
+    Generates and stores recommendations for one patient. Returns
+    {"recommendations", "source", "similarity_score", "usage"}; raises
+    GenerationFailed with the HTTP status the failure maps to.
+
+    In "auto" mode a plan generated for a similar patient is used without
+    a model call when one is close enough. While the model is unavailable
+    a stale cached or similar plan is used if there is one.
+    """
+    patient_data = await run_in_threadpool(repo.get, patient_name)
+    if patient_data is None:
+        raise GenerationFailed(404, "Patient not found")
+
+    match = None
+    if mode != "fresh":
+        await run_in_threadpool(ensure_similarity_index, repo)
+        match = await run_in_threadpool(similarity_index.query, patient_data, num_exercises, patient_name)
+
+    usage = {}
+    if match is not None and mode == "auto":
+        recommendations, source = match.recommendations, "similar"
+    else:
+        reference = match.recommendations if match is not None else None
+        try:
+            recommendations = await generate_exercises(
+                patient_data, num_exercises, use_cache=use_cache and mode != "fresh",
+                usage=usage, reference=reference,
+            )
+        except LLMUnavailable as e:
+            if match is None:
+                raise GenerationFailed(503, str(e), e.retry_after)
+            recommendations, source = match.recommendations, "similar"
+        else:
+            if not recommendations:
+                raise GenerationFailed(500, "Failed to generate exercises")
+            if usage.pop("response_stale", False):
+                source = "stale-cache"
+            else:
+                source = "cache" if usage.get("response_cached") else "model"
+
+    await run_in_threadpool(repo.set_recommendations, patient_name, recommendations)
+    if similarity_index.built:
+        similarity_index.add(patient_name, patient_data, recommendations)
+    return {
+        "recommendations": recommendations,
+        "source": source,
+        "similarity_score": round(match.score, 3) if source == "similar" else None,
+        "usage": usage,
+    }
+
+
+# Single-patient generation jobs behind POST /generate_exercises. Their state
+# is kept in SQLite so it survives restarts; unfinished jobs are re-queued
+# when the queue starts.
+GENERATION_JOBS_PATH = os.environ.get("GENERATION_JOBS_PATH", os.path.join("database", "generation_jobs.db"))
+GENERATION_WORKERS = int(os.environ.get("GENERATION_WORKERS", "16"))
+# Finished jobs (and their idempotency keys) are kept this long.
+GENERATION_JOB_RETENTION = float(os.environ.get("GENERATION_JOB_RETENTION", str(24 * 3600)))
+# Webhook deliveries are tried this many times, with exponential backoff.
+CALLBACK_ATTEMPTS = 3
+CALLBACK_TIMEOUT = 10.0
+
+ACTIVE_STATUSES = ("queued", "running")
+
+
+class IdempotencyConflict(Exception):
+    """An Idempotency-Key was reused with different request parameters."""
+
+
+class GenerationJob:
+    """One queued POST /generate_exercises request and, once finished, its outcome."""
+
+    def __init__(self, patient_name: str, num_exercises: int, use_cache: bool = True, mode: str = "auto",
+                 idempotency_key: Optional[str] = None, callback_url: Optional[str] = None):
+        self.id = uuid.uuid4().hex
+        self.patient_name = patient_name
+        self.num_exercises = num_exercises
+        self.use_cache = use_cache
+        self.mode = mode
+        self.idempotency_key = idempotency_key
+        self.callback_url = callback_url
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.outcome: Optional[Dict] = None
+        self.error: Optional[Dict] = None
+        self.callback: Optional[Dict] = None
+        self.done = asyncio.Event()
+
+    @property
+    def coalesce_key(self) -> str:
+        """Jobs with the same key do the same work, so an active one absorbs the others."""
+        return json.dumps([self.patient_name, self.num_exercises, self.use_cache, self.mode])
+
+    @property
+    def finished(self) -> bool:
+        return self.status not in ACTIVE_STATUSES
+
+    def to_dict(self) -> Dict:
+        data = {
+            "job_id": self.id,
+            "status": self.status,
+            "patient_name": self.patient_name,
+            "num_exercises": self.num_exercises,
+            "use_cache": self.use_cache,
+            "mode": self.mode,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self.outcome is not None:
+            data.update(self.outcome)
+        if self.error is not None:
+            data["error"] = self.error
+        if self.callback_url is not None:
+            data["callback_url"] = self.callback_url
+            data["callback"] = self.callback
+        return data
+
+    def to_record(self) -> Dict:
+        return {field: getattr(self, field) for field in (
+            "id", "patient_name", "num_exercises", "use_cache", "mode", "idempotency_key", "callback_url",
+            "status", "created_at", "started_at", "finished_at", "outcome", "error", "callback",
+        )}
+
+    @classmethod
+    def from_record(cls, record: Dict) -> "GenerationJob":
+        job = cls(record["patient_name"], record["num_exercises"], record["use_cache"], record["mode"],
+                  record["idempotency_key"], record["callback_url"])
+        for field in ("id", "status", "created_at", "started_at", "finished_at", "outcome", "error", "callback"):
+            setattr(job, field, record[field])
+        if job.finished:
+            job.done.set()
+        return job
+
+
+class GenerationJobStore:
+    """SQLite table of generation jobs, one JSON record per job."""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        """Returns the connection, opening (and creating) the database on first use. Call with _lock held."""
+        if self._conn is None:
+            self._conn = self._open()
+        return self._conn
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        with conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS generation_jobs (
+                    id TEXT PRIMARY KEY,
+                    idempotency_key TEXT UNIQUE,
+                    status TEXT NOT NULL,
+                    record TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    finished_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS idx_generation_jobs_status ON generation_jobs (status);
+                CREATE INDEX IF NOT EXISTS idx_generation_jobs_finished ON generation_jobs (finished_at);
+                """
+            )
+        return conn
+
+    def save(self, job: GenerationJob):
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO generation_jobs (id, idempotency_key, status, record, created_at, finished_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (job.id, job.idempotency_key, job.status, json.dumps(job.to_record()), job.created_at, job.finished_at),
+            )
+
+    def _load(self, row) -> Optional[GenerationJob]:
+        return GenerationJob.from_record(json.loads(row[0])) if row is not None else None
+
+    def get(self, job_id: str) -> Optional[GenerationJob]:
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT record FROM generation_jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._load(row)
+
+    def get_by_idempotency_key(self, key: str) -> Optional[GenerationJob]:
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT record FROM generation_jobs WHERE idempotency_key = ?", (key,)
+            ).fetchone()
+        return self._load(row)
+
+    def unfinished(self) -> List[GenerationJob]:
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute(
+                "SELECT record FROM generation_jobs WHERE status IN (?, ?) ORDER BY created_at", ACTIVE_STATUSES
+            ).fetchall()
+        return [self._load(row) for row in rows]
+
+    def prune(self, older_than: float) -> int:
+        """Deletes jobs that finished before `older_than` (a timestamp)."""
+        with self._lock, self._connect() as conn:
+            cursor = conn.execute("DELETE FROM generation_jobs WHERE finished_at < ?", (older_than,))
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class GenerationQueue:
+    """
+    In-process queue of generation jobs worked by `workers` asyncio tasks.
+    submit() returns immediately; an active job with the same parameters
+    for the same patient, or any retained job with the same idempotency
+    key, is returned instead of starting a new one. Finished jobs are
+    POSTed to their callback_url if they have one.
+    """
+
+    def __init__(self, store: GenerationJobStore, repo: PatientRepository, workers: int = GENERATION_WORKERS):
+        self.store = store
+        self.repo = repo
+        self.workers = max(1, workers)
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._active: Dict[str, GenerationJob] = {}  # job id -> queued or running job
+        self._by_coalesce_key: Dict[str, GenerationJob] = {}
+        self._by_idempotency_key: Dict[str, GenerationJob] = {}
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        await run_in_threadpool(self.store.prune, time.time() - GENERATION_JOB_RETENTION)
+        # Jobs that were queued or running when the process stopped run again.
+        for job in await run_in_threadpool(self.store.unfinished):
+            job.status = "queued"
+            self._track(job)
+            self._queue.put_nowait(job)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _track(self, job: GenerationJob):
+        self._active[job.id] = job
+        self._by_coalesce_key[job.coalesce_key] = job
+        if job.idempotency_key is not None:
+            self._by_idempotency_key[job.idempotency_key] = job
+
+    def _untrack(self, job: GenerationJob):
+        self._active.pop(job.id, None)
+        if self._by_coalesce_key.get(job.coalesce_key) is job:
+            del self._by_coalesce_key[job.coalesce_key]
+        if job.idempotency_key is not None and self._by_idempotency_key.get(job.idempotency_key) is job:
+            del self._by_idempotency_key[job.idempotency_key]
+
+    async def submit(self, job: GenerationJob) -> Tuple[GenerationJob, bool]:
+        """Queues `job` and returns (job, True), or (existing job, False) if it coalesces with one."""
+        if job.idempotency_key is not None:
+            existing = self._by_idempotency_key.get(job.idempotency_key)
+            if existing is None:
+                existing = await run_in_threadpool(self.store.get_by_idempotency_key, job.idempotency_key)
+                # Another submit with this key may have been queued meanwhile.
+                existing = self._by_idempotency_key.get(job.idempotency_key, existing)
+            if existing is not None:
+                if existing.coalesce_key != job.coalesce_key:
+                    raise IdempotencyConflict(job.idempotency_key)
+                return existing, False
+        existing = self._by_coalesce_key.get(job.coalesce_key)
+        if existing is not None:
+            return existing, False
+
+        self._track(job)
+        # Saved before a worker can pick it up, so "queued" never overwrites a later state.
+        await run_in_threadpool(self.store.save, job)
+        self._queue.put_nowait(job)
+        return job, True
+
+    async def get(self, job_id: str) -> Optional[GenerationJob]:
+        job = self._active.get(job_id)
+        if job is None:
+            job = await run_in_threadpool(self.store.get, job_id)
+        return job
+
+    async def wait(self, job: GenerationJob, timeout: float) -> bool:
+        """Waits up to `timeout` seconds for the job to finish; returns whether it did."""
+        try:
+            await asyncio.wait_for(job.done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return job.finished
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            except Exception as e:
+                print(f"Generation job {job.id} failed: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: GenerationJob):
+        job.status = "running"
+        job.started_at = time.time()
+        await run_in_threadpool(self.store.save, job)
+        try:
+            job.outcome = await generate_for_patient(
+                self.repo, job.patient_name, job.num_exercises, job.use_cache, job.mode
+            )
+            job.status = "completed"
+        except GenerationFailed as e:
+            job.error = {"status_code": e.status_code, "detail": e.detail}
+            if e.retry_after is not None:
+                job.error["retry_after"] = math.ceil(e.retry_after)
+            job.status = "failed"
+        except Exception as e:
+            print(f"Generation job {job.id} failed: {e}")
+            job.error = {"status_code": 500, "detail": "Failed to generate exercises"}
+            job.status = "failed"
+        job.finished_at = time.time()
+        self._untrack(job)
+        await run_in_threadpool(self.store.save, job)
+        job.done.set()
+        if job.callback_url is not None:
+            await self._deliver_callback(job)
+
+    async def _deliver_callback(self, job: GenerationJob):
+        import httpx  # only needed for callbacks
+
+        job.callback = {"status": "pending", "attempts": 0}
+        async with httpx.AsyncClient(timeout=CALLBACK_TIMEOUT) as client:
+            for attempt in range(CALLBACK_ATTEMPTS):
+                if attempt:
+                    await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+                job.callback["attempts"] = attempt + 1
+                try:
+                    response = await client.post(job.callback_url, json=job.to_dict())
+                except httpx.HTTPError as e:
+                    job.callback["detail"] = str(e) or type(e).__name__
+                    continue
+                job.callback["response_status"] = response.status_code
+                # Server errors are retried; anything else is the receiver's final answer.
+                if response.status_code < 500:
+                    break
+        status = job.callback.get("response_status")
+        if status is not None and 200 <= status < 300:
+            job.callback["status"] = "delivered"
+        elif status is not None and status < 500:
+            job.callback["status"] = "rejected"
+        else:
+            job.callback["status"] = "failed"
+        await run_in_threadpool(self.store.save, job)
+
+
+def is_local_url(url: str) -> bool:
+    """Whether `url` is an http(s) URL on this machine; callbacks may only go there."""
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return False
+    if parsed.hostname == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(parsed.hostname).is_loopback
+    except ValueError:
+        return False
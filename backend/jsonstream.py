@@ -0,0 +1,160 @@
+# jsonstream.py
+import json
+from typing import Dict, List, Optional
+
+from pydantic import ValidationError
+
+from metrics import record_repair
+from models import Exercise
+
+
+class ExerciseStreamParser:
+    """
+    Incremental parser for a streamed recommendations object of the form
+    {"exercises": [{...}, {...}], "notes": "..."}.
+
+    Text is fed in chunks as the model produces it; feed() returns every
+    element of the "exercises" array that became complete in that chunk.
+    Anything before the first "{" (e.g. prose or a code fence) is skipped,
+    and so is anything after the root object closes.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._pos = 0
+        self._root_start: Optional[int] = None
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_string = ""
+        self._in_exercises = False
+        self._item_start: Optional[int] = None
+        self.exercises: List[Dict] = []  # every complete element so far
+
+    def feed(self, chunk: str) -> List[Dict]:
+        self.text += chunk
+        completed = []
+        text = self.text
+        for i in range(self._pos, len(text)):
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if len(self._stack) == 1:
+                        self._last_string = text[self._string_start:i]
+                continue
+
+            if not self._stack:
+                # Outside the root object: only an opening brace matters.
+                if ch == "{" and self._root_start is None:
+                    self._root_start = i
+                    self._stack.append("{")
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._string_start = i + 1
+            elif ch in "{[":
+                if ch == "[" and len(self._stack) == 1 and self._last_string == "exercises":
+                    self._in_exercises = True
+                elif ch == "{" and self._in_exercises and len(self._stack) == 2:
+                    self._item_start = i
+                self._stack.append(ch)
+            elif ch in "}]":
+                self._stack.pop()
+                depth = len(self._stack)
+                if ch == "}" and self._in_exercises and depth == 2 and self._item_start is not None:
+                    try:
+                        exercise = json.loads(text[self._item_start:i + 1])
+                    except ValueError:
+                        pass
+                    else:
+                        completed.append(exercise)
+                        self.exercises.append(exercise)
+                    self._item_start = None
+                elif ch == "]" and self._in_exercises and depth == 1:
+                    self._in_exercises = False
+        self._pos = len(text)
+        return completed
+
+    def result(self) -> Dict:
+        """Parses the complete root object once the stream has finished."""
+        if self._root_start is None:
+            raise ValueError("No JSON object found in the response")
+        decoder = json.JSONDecoder()
+        parsed, _ = decoder.raw_decode(self.text, self._root_start)
+        return parsed
+
+    def repaired(self) -> Dict:
+        """
+        result(), or if the response was cut off (e.g. at max_tokens), the
+        exercises that were complete before the cut.
+        """
+        try:
+            return self.result()
+        except ValueError:
+            record_repair("truncated" if self._root_start is not None else "unparseable")
+            return {"exercises": list(self.exercises), "notes": ""}
+
+
+def parse_recommendations(text: str) -> Dict:
+    """
+    Parses a model response into validated recommendations. Plain JSON
+    takes the fast path; otherwise code fences and surrounding prose are
+    skipped and a truncated response keeps its complete exercises.
+    """
+    try:
+        data = json.loads(text)
+    except ValueError:
+        parser = ExerciseStreamParser()
+        parser.feed(text)
+        try:
+            data = parser.result()
+            record_repair("wrapped")
+        except ValueError:
+            data = parser.repaired()
+    return validate_recommendations(data)
+
+
+def validate_recommendations(data) -> Dict:
+    """
+    Checks parsed output against the Exercise schema. Invalid exercises
+    are dropped rather than failing the whole response.
+    """
+    if isinstance(data, list):
+        data = {"exercises": data}
+    if not isinstance(data, dict):
+        data = {}
+    exercises = []
+    for item in data.get("exercises") or []:
+        try:
+            exercises.append(Exercise.parse_obj(item).dict())
+        except ValidationError:
+            record_repair("invalid_exercise")
+    notes = data.get("notes")
+    return {"exercises": _unique_ids(exercises), "notes": notes if isinstance(notes, str) else ""}
+
+
+def merge_recommendations(current: Dict, extra: Dict, num_exercises: int) -> Dict:
+    """Appends `extra`'s exercises to `current`, up to num_exercises in total."""
+    return {
+        "exercises": _unique_ids(current["exercises"] + extra["exercises"])[:num_exercises],
+        "notes": current["notes"] or extra["notes"],
+    }
+
+
+def _unique_ids(exercises: List[Dict]) -> List[Dict]:
+    """Gives exercises with a missing or repeated id the next free "exN" id."""
+    seen = set()
+    for index, exercise in enumerate(exercises, 1):
+        if not exercise.get("id") or exercise["id"] in seen:
+            exercise["id"] = f"ex{index}"
+            while exercise["id"] in seen:
+                exercise["id"] += "a"
+        seen.add(exercise["id"])
+    return exercises
@@ -0,0 +1,41 @@
+# locks.py
+import threading
+from contextlib import contextmanager
+from typing import Dict, List
+
+
+class KeyedLocks:
+    """
+    One lock per key (e.g. patient name), created on demand and dropped
+    once nobody holds or waits for it. Writes to different patients run in
+    parallel; writes to the same patient are serialized.
+    """
+
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks: Dict[str, List] = {}  # key -> [lock, users]
+
+    @contextmanager
+    def hold(self, *keys: str):
+        """Acquires the locks for all keys, in sorted order to avoid deadlocks."""
+        keys = sorted(set(keys))
+        with self._guard:
+            entries = []
+            for key in keys:
+                entry = self._locks.setdefault(key, [threading.Lock(), 0])
+                entry[1] += 1
+                entries.append(entry)
+        acquired = []
+        try:
+            for entry in entries:
+                entry[0].acquire()
+                acquired.append(entry)
+            yield
+        finally:
+            for entry in reversed(acquired):
+                entry[0].release()
+            with self._guard:
+                for key, entry in zip(keys, entries):
+                    entry[1] -= 1
+                    if entry[1] == 0:
+                        del self._locks[key]
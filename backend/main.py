@@ -1,42 +1,266 @@
 # main.py
-import uvicorn
-from fastapi import FastAPI, HTTPException
-from typing import List, Dict
-from OldStreamlit.models import PatientCreate, PatientUpdate, ExerciseRecommendationsRequest
-from OldStreamlit.utils import load_patients, save_patients, create_weekly_schedule
-from services import generate_exercises
+import asyncio
+import base64
+import binascii
+import json
+import math
+import os
+import time
+from fastapi import FastAPI, HTTPException, Header, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from typing import List, Dict, Optional
+from models import PatientCreate, PatientUpdate, ExerciseRecommendationsRequest, BatchGenerationRequest
+from utils import create_weekly_schedule
+from repository import create_repository, LazyRepository, PatientExists, PatientNotFound, VersionConflict, PATIENT_FIELDS, PROFILE_FIELDS
+from services import (stream_exercises, client_initialized, close_client, recommendation_cache, similarity_index, llm_breaker,
+                      detect_injury_location, LLMUnavailable, LLM_MAX_CONCURRENCY)
+from jobs import (BatchJob, batch_jobs, register_batch_job, run_batch_generation, GenerationJob, GenerationJobStore,
+                  GenerationQueue, IdempotencyConflict, is_local_url, GENERATION_JOBS_PATH)
+from metrics import MetricsMiddleware, profiler, record_image_cache, registry
+from bulk import FORMATS, export_chunks, format_for, iter_rows, parse_row, row_name
+import planexport
+from planexport import PlanCache, cached_plan, plan_filename, zip_documents
+from images import ImageResultCache, IMAGE_MAX_UPLOAD_BYTES, prepare, shutdown_pool
 
 app = FastAPI(title="PT Exercise Planner API")
+app.add_middleware(MetricsMiddleware)
+
+# Page size bounds for GET /patients when paginating.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# POST /patients/bulk commits valid rows this many at a time.
+BULK_BATCH_SIZE = 1000
+# The /debug/profiler endpoints expose stack traces; off unless PROFILER_ENABLED=1.
+PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED", "0") == "1"
+
+# Rendered treatment plans, keyed by patient version (see planexport).
+plan_cache = PlanCache(int(os.environ.get("PLAN_CACHE_MB", "64")) * 1024 * 1024)
+
+# Injury-location results by image hash (see images.py).
+image_cache = ImageResultCache(
+    max_entries=int(os.environ.get("IMAGE_CACHE_MAX_ENTRIES", "1024")),
+    max_distance=int(os.environ.get("IMAGE_HASH_MAX_DISTANCE", "0")),
+)
+
+_import_started = time.perf_counter()
+
+# Patient storage (JSON snapshot + log or SQLite, see PATIENT_REPOSITORY),
+# loaded in the background at startup; see /ready.
+repo = LazyRepository(create_repository)
+
+# POST /generate_exercises only queues; workers run the generations.
+generation_queue = GenerationQueue(GenerationJobStore(GENERATION_JOBS_PATH), repo)
+# Longest a POST /generate_exercises?wait=... may wait for its job.
+MAX_GENERATION_WAIT = 60.0
+
+
+@app.exception_handler(PatientNotFound)
+async def patient_not_found_handler(request: Request, exc: PatientNotFound):
+    return JSONResponse(status_code=404, content={"detail": "Patient not found"})
+
+
+@app.exception_handler(VersionConflict)
+async def version_conflict_handler(request: Request, exc: VersionConflict):
+    return JSONResponse(
+        status_code=412,
+        content={"detail": "Patient was modified by another request; reload it and retry"},
+    )
+
+
+def etag(version: str) -> str:
+    return f'"{version}"'
+
+
+def expected_version(if_match: Optional[str]) -> Optional[str]:
+    """Turns an If-Match header into the version a write must be based on."""
+    if if_match is None or if_match.strip() == "*":
+        return None
+    value = if_match.strip()
+    if value.startswith("W/"):
+        value = value[2:]
+    return value.strip('"')
+
+
+def encode_cursor(name: str) -> str:
+    return base64.urlsafe_b64encode(name.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> str:
+    try:
+        return base64.b64decode(cursor.encode("ascii"), altchars=b"-_", validate=True).decode("utf-8")
+    except (ValueError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@app.on_event("startup")
+def load_repository():
+    repo.start()
+
+
+@app.on_event("startup")
+async def start_generation_queue():
+    await generation_queue.start()
+
+
+@app.on_event("shutdown")
+async def stop_generation_queue():
+    await generation_queue.stop()
+    generation_queue.store.close()
+
+
+@app.on_event("shutdown")
+async def stop_llm_client():
+    await close_client()
+
+
+@app.on_event("shutdown")
+def close_recommendation_cache():
+    recommendation_cache.close()
+
+
+@app.on_event("shutdown")
+def stop_image_workers():
+    shutdown_pool()
+
+
+@app.on_event("shutdown")
+def close_repository():
+    repo.close()
+
+
+@app.get("/ready")
+def readiness():
+    """
+    Readiness probe: 200 once the patient repository is loaded, 503 while
+    it is still warming up. The Anthropic client is created on the first
+    generation and is reported but not waited for; so are storage problems
+    such as a failed log compaction.
+    """
+    status = repo.status()
+    if repo.ready:
+        status["storage"] = repo.storage_status()
+    status["llm_client"] = "ready" if client_initialized() else "lazy"
+    status["llm_circuit"] = llm_breaker.status()
+    status["uptime_seconds"] = time.perf_counter() - _import_started
+    return JSONResponse(status_code=200 if repo.ready else 503, content=status)
 
-# In-memory (or JSON file) data structure for patients
-patients_db = load_patients()
 
 @app.get("/patients", response_model=List[str])
-def list_patients():
+def list_patients(response: Response, prefix: Optional[str] = None, cursor: Optional[str] = None,
+                  limit: Optional[int] = None):
     """
     Returns a list of patient names (keys).
+    With prefix, cursor or limit, returns one page of names in sorted
+    order; the X-Next-Cursor header holds the cursor of the next page.
+    """
+    if prefix is None and cursor is None and limit is None:
+        return repo.list_names()
+    limit = DEFAULT_PAGE_SIZE if limit is None else limit
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    after = decode_cursor(cursor) if cursor else None
+    names = repo.list_names_page(prefix or "", after, limit + 1)
+    if len(names) > limit:
+        names = names[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(names[-1])
+    return names
+
+
+@app.get("/patients/export")
+def export_patients(format: str = "ndjson"):
+    """
+    Streams every patient as NDJSON or CSV (see bulk.py), one row per
+    patient, without building the whole export in memory.
+    """
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(FORMATS)}")
+    return StreamingResponse(
+        export_chunks(repo.iter_patients(), format),
+        media_type=FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="patients.{format}"'},
+    )
+
+
+@app.post("/patients/bulk")
+async def import_patients(request: Request, format: Optional[str] = None):
     """
-    return list(patients_db.keys())
+    Creates patients from an NDJSON or CSV body (format defaults from the
+    Content-Type), in the layout GET /patients/export produces. Rows are
+    validated as they stream in and stored BULK_BATCH_SIZE at a time, one
+    storage commit per batch. Invalid rows and name conflicts are reported
+    per row and do not stop the others.
+    """
+    fmt = format or format_for(request.headers.get("content-type"))
+    if fmt not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(FORMATS)}")
+    created = 0
+    errors = []
+    batch = []  # (row number, name, record)
+
+    async def commit():
+        nonlocal created
+        versions = await run_in_threadpool(repo.create_many, [(name, data) for _, name, data in batch])
+        for (row, name, data), version in zip(batch, versions):
+            if version is None:
+                errors.append({"row": row, "name": name, "error": "conflict", "detail": "Patient already exists"})
+                continue
+            created += 1
+            if similarity_index.built and data["recommendations"]:
+                similarity_index.add(name, data, data["recommendations"])
+        batch.clear()
+
+    async for row, raw in iter_rows(request.stream(), fmt):
+        try:
+            name, data = parse_row(raw)
+        except ValueError as e:
+            errors.append({"row": row, "name": row_name(raw), "error": "invalid", "detail": str(e)})
+            continue
+        batch.append((row, name, data))
+        if len(batch) >= BULK_BATCH_SIZE:
+            await commit()
+    if batch:
+        await commit()
+    await run_in_threadpool(repo.flush)
+    return {"created": created, "failed": len(errors), "errors": errors}
 
 
 @app.get("/patients/{patient_name}")
-def get_patient(patient_name: str):
+def get_patient(patient_name: str, response: Response, fields: Optional[str] = None,
+                view: str = "full", include_recommendations: bool = False):
     """
-    Returns the patient's data.
+    Returns the patient's data, with its version in the ETag header.
+    fields=age,pain_level returns only those fields. view=summary returns
+    the profile and exercise names per day, without recommendations
+    unless include_recommendations is set.
     """
-    if patient_name not in patients_db:
+    if view not in ("full", "summary"):
+        raise HTTPException(status_code=400, detail="view must be 'full' or 'summary'")
+    if fields is None and view == "full":
+        patient, version = repo.get_with_version(patient_name)
+    else:
+        if fields is not None:
+            selected = [field.strip() for field in fields.split(",") if field.strip()]
+            unknown = [field for field in selected if field not in PATIENT_FIELDS]
+            if unknown:
+                raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+        else:
+            selected = PROFILE_FIELDS + ["weekly_schedule"]
+        if include_recommendations and "recommendations" not in selected:
+            selected.append("recommendations")
+        patient, version = repo.get_fields(patient_name, selected, summarize_schedule=view == "summary")
+    if patient is None:
         raise HTTPException(status_code=404, detail="Patient not found")
-    return patients_db[patient_name]
+    response.headers["ETag"] = etag(version)
+    return patient
 
 
 @app.post("/patients", status_code=201)
-def create_patient(payload: PatientCreate):
+def create_patient(payload: PatientCreate, response: Response, durable: bool = False):
     """
     Creates a new patient entry.
+    With durable=true, answers only once the write is on disk (see PATIENT_LOG_FLUSH_MS).
     """
-    if payload.name in patients_db:
-        raise HTTPException(status_code=400, detail="Patient already exists")
-
     new_data = {
         "age": payload.age,
         "injury_location": payload.injury_location,
@@ -48,117 +272,421 @@ def create_patient(payload: PatientCreate):
         "weekly_schedule": create_weekly_schedule(),
         "recommendations": {}
     }
-    patients_db[payload.name] = new_data
-    save_patients(patients_db)
+    try:
+        version = repo.create(payload.name, new_data)
+    except PatientExists:
+        raise HTTPException(status_code=400, detail="Patient already exists")
+    if durable:
+        repo.flush()
+    response.headers["ETag"] = etag(version)
     return {"message": f"Patient '{payload.name}' created successfully"}
 
 
 @app.put("/patients/{patient_name}")
-def update_patient(patient_name: str, payload: PatientUpdate):
+def update_patient(patient_name: str, payload: PatientUpdate, response: Response,
+                   if_match: Optional[str] = Header(None), durable: bool = False):
     """
     Updates an existing patient’s data.
+    With If-Match, fails with 412 if the patient changed since that ETag.
+    With durable=true, answers only once the write is on disk.
     """
-    if patient_name not in patients_db:
-        raise HTTPException(status_code=404, detail="Patient not found")
-
-    existing_data = patients_db[patient_name]
-
-    # Update fields if provided
+    fields = payload.dict(exclude={"new_name"}, exclude_none=True)
+    # Renaming and field updates are applied atomically
+    try:
+        version = repo.update(patient_name, fields, new_name=payload.new_name or None,
+                              expected_version=expected_version(if_match))
+    except PatientExists:
+        raise HTTPException(status_code=400, detail="New name conflicts with existing patient name")
+    if durable:
+        repo.flush()
     if payload.new_name:
-        # handle renaming logic
-        if payload.new_name != patient_name and payload.new_name in patients_db:
-            raise HTTPException(status_code=400, detail="New name conflicts with existing patient name")
-        # move data in the dictionary
-        patients_db[payload.new_name] = existing_data
-        del patients_db[patient_name]
+        similarity_index.rename(patient_name, payload.new_name)
         patient_name = payload.new_name
-
-    if payload.age is not None:
-        patients_db[patient_name]["age"] = payload.age
-    if payload.injury_location is not None:
-        patients_db[patient_name]["injury_location"] = payload.injury_location
-    if payload.pain_level is not None:
-        patients_db[patient_name]["pain_level"] = payload.pain_level
-    if payload.mobility_status is not None:
-        patients_db[patient_name]["mobility_status"] = payload.mobility_status
-    if payload.medical_history is not None:
-        patients_db[patient_name]["medical_history"] = payload.medical_history
-    if payload.activity_level is not None:
-        patients_db[patient_name]["activity_level"] = payload.activity_level
-    if payload.goals is not None:
-        patients_db[patient_name]["goals"] = payload.goals
-
-    save_patients(patients_db)
+    response.headers["ETag"] = etag(version)
     return {"message": f"Patient '{patient_name}' updated successfully"}
 
 
 @app.delete("/patients/{patient_name}")
-def delete_patient(patient_name: str):
+def delete_patient(patient_name: str, if_match: Optional[str] = Header(None), durable: bool = False):
     """
     Deletes a patient entry.
+    With If-Match, fails with 412 if the patient changed since that ETag.
+    With durable=true, answers only once the write is on disk.
     """
-    if patient_name not in patients_db:
-        raise HTTPException(status_code=404, detail="Patient not found")
-    del patients_db[patient_name]
-    save_patients(patients_db)
+    repo.delete(patient_name, expected_version=expected_version(if_match))
+    if durable:
+        repo.flush()
+    similarity_index.remove(patient_name)
     return {"message": f"Patient '{patient_name}' has been deleted."}
 
 
-@app.post("/generate_exercises")
-def generate_patient_exercises(request: ExerciseRecommendationsRequest):
+def _check_plan_format(format: str):
+    if format not in planexport.FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(planexport.FORMATS)}")
+
+
+@app.get("/patients/{patient_name}/plan")
+def get_treatment_plan(patient_name: str, format: str = "txt"):
+    """
+    Returns the patient's treatment plan (profile and weekly schedule) as
+    a txt, csv or pdf download, with the patient's version in the ETag.
+    """
+    _check_plan_format(format)
+    document, version = cached_plan(plan_cache, patient_name, format, repo.get_version, repo.get_with_version)
+    if document is None:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    return Response(
+        content=document,
+        media_type=planexport.FORMATS[format],
+        headers={
+            "ETag": etag(version),
+            "Content-Disposition": f'attachment; filename="{plan_filename(patient_name, format)}"',
+        },
+    )
+
+
+@app.get("/plans/export")
+def export_treatment_plans(format: str = "txt"):
     """
-    Calls the Anthropic-based exercise generation using a patient's data.
+    Streams a zip with every patient's treatment plan in `format`, one
+    document per patient. Unchanged plans come from the render cache.
+    """
+    _check_plan_format(format)
+
+    def documents():
+        for name in repo.list_names():
+            document, _ = cached_plan(plan_cache, name, format, repo.get_version, repo.get_with_version)
+            if document is not None:  # deleted since the listing
+                yield plan_filename(name, format), document
+
+    return StreamingResponse(
+        zip_documents(documents()),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="treatment_plans_{format}.zip"'},
+    )
+
+
+@app.post("/generate_exercises", status_code=202)
+async def generate_patient_exercises(request: ExerciseRecommendationsRequest, response: Response,
+                                     idempotency_key: Optional[str] = Header(None), wait: float = 0):
+    """
+    Queues exercise generation for a patient and returns the job (202),
+    to be polled at GET /jobs/{job_id} (the Location header). A request
+    for a patient that already has the same generation queued or running
+    returns that job; so does a repeated Idempotency-Key.
+
+    With `wait` (seconds) the request waits that long for the job and, if
+    it finishes in time, answers like a synchronous call: the
+    recommendations with X-Recommendation-Source and X-Usage-* headers,
+    or the job's error status.
+    """
+    if not 0 <= wait <= MAX_GENERATION_WAIT:
+        raise HTTPException(status_code=400, detail=f"wait must be between 0 and {MAX_GENERATION_WAIT}")
+    if request.callback_url is not None and not is_local_url(request.callback_url):
+        raise HTTPException(status_code=400, detail="callback_url must be an http(s) URL on localhost")
+    if not await run_in_threadpool(repo.exists, request.patient_name):
+        raise HTTPException(status_code=404, detail="Patient not found")
+
+    try:
+        job, created = await generation_queue.submit(GenerationJob(
+            request.patient_name, request.num_exercises, request.use_cache, request.mode,
+            idempotency_key=idempotency_key, callback_url=request.callback_url,
+        ))
+    except IdempotencyConflict:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used with different parameters")
+    response.headers["Location"] = f"/jobs/{job.id}"
+    response.headers["X-Job-Id"] = job.id
+    if not created:
+        response.headers["X-Job-Coalesced"] = "true"
+
+    if wait and await generation_queue.wait(job, wait):
+        if job.status == "failed":
+            headers = {"X-Job-Id": job.id}
+            if "retry_after" in job.error:
+                headers["Retry-After"] = str(job.error["retry_after"])
+            raise HTTPException(status_code=job.error["status_code"], detail=job.error["detail"], headers=headers)
+        response.status_code = 200
+        response.headers["X-Recommendation-Source"] = job.outcome["source"]
+        if job.outcome["similarity_score"] is not None:
+            response.headers["X-Similarity-Score"] = f"{job.outcome['similarity_score']:.3f}"
+        for key, value in job.outcome["usage"].items():
+            response.headers[f"X-Usage-{key.replace('_', '-')}"] = str(value)
+        return job.outcome["recommendations"]
+    if job.finished:
+        response.status_code = 200
+    return job.to_dict()
+
+
+@app.get("/jobs/{job_id}")
+async def get_generation_job(job_id: str):
+    """
+    Returns a generation job: its status (queued, running, completed or
+    failed) and, once finished, the recommendations and where they came
+    from, or the error.
+    """
+    job = await generation_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+@app.post("/generate_exercises/stream")
+async def stream_patient_exercises(request: ExerciseRecommendationsRequest):
+    """
+    Streams generated exercises as NDJSON, one event per line, as soon as
+    each exercise is complete. The final "done" event carries the full
+    recommendations, which are also saved on the patient.
     """
     patient_name = request.patient_name
-    num_exercises = request.num_exercises
+    patient_data = await run_in_threadpool(repo.get, patient_name)
+    if patient_data is None:
+        raise HTTPException(status_code=404, detail="Patient not found")
+
+    async def events():
+        use_cache = request.use_cache and request.mode != "fresh"
+        async for event in stream_exercises(patient_data, request.num_exercises, use_cache=use_cache):
+            if event["type"] == "done":
+                await run_in_threadpool(repo.set_recommendations, patient_name, event["recommendations"])
+                if similarity_index.built:
+                    similarity_index.add(patient_name, patient_data, event["recommendations"])
+            yield json.dumps(event) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+
+@app.post("/generate_exercises/batch", status_code=202)
+async def generate_exercises_batch(request: BatchGenerationRequest):
+    """
+    Starts generating exercises for many patients at once and returns a
+    job id to poll. Select patients by name, or by filters.
+    """
+    if request.patient_names is not None:
+        patient_names = list(dict.fromkeys(request.patient_names))
+    else:
+        patient_names = await run_in_threadpool(
+            repo.find_names, request.injury_location, request.activity_level
+        )
+    if not patient_names:
+        raise HTTPException(status_code=400, detail="No patients selected")
+
+    job = BatchJob(patient_names, request.num_exercises)
+    register_batch_job(job)
+    concurrency = request.concurrency or LLM_MAX_CONCURRENCY
+    job.task = asyncio.create_task(run_batch_generation(job, repo, concurrency, request.use_cache))
+    return job.to_dict(include_results=False)
+
+
+@app.get("/generate_exercises/batch/{job_id}")
+def get_batch_job(job_id: str, include_results: bool = True):
+    """
+    Returns progress and per-patient results of a batch generation job.
+    """
+    job = batch_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict(include_results=include_results)
+
+
+@app.get("/recommendation_cache/stats")
+def get_recommendation_cache_stats():
+    """
+    Returns hit/miss counters and the number of cached recommendation sets.
+    """
+    return recommendation_cache.stats()
+
+
+@app.delete("/recommendation_cache")
+def clear_recommendation_cache():
+    """
+    Drops every cached recommendation set.
+    """
+    removed = recommendation_cache.clear()
+    return {"message": f"Removed {removed} cached recommendation sets"}
 
-    if patient_name not in patients_db:
+
+@app.delete("/recommendation_cache/{patient_name}")
+def invalidate_patient_recommendations(patient_name: str):
+    """
+    Drops cached recommendations generated for this patient's profile.
+    """
+    patient_data = repo.get(patient_name)
+    if patient_data is None:
         raise HTTPException(status_code=404, detail="Patient not found")
+    removed = recommendation_cache.invalidate_profile(patient_data)
+    return {"message": f"Removed {removed} cached recommendation sets for {patient_name}"}
+
+
+async def _read_image_upload(request: Request) -> bytes:
+    """The uploaded image: the "image" (or first) file of a multipart form, or the raw body."""
+    too_large = HTTPException(status_code=413, detail=f"Image is larger than {IMAGE_MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > IMAGE_MAX_UPLOAD_BYTES + 64 * 1024:
+        raise too_large
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        # Parsed as it streams in; the file part is spooled to disk past 1 MB (needs python-multipart).
+        form = await request.form()
+        upload = form.get("image")
+        if upload is None or isinstance(upload, str):
+            upload = next((value for value in form.values() if not isinstance(value, str)), None)
+        if upload is None:
+            raise HTTPException(status_code=400, detail="No image file in the upload")
+        raw = await upload.read(IMAGE_MAX_UPLOAD_BYTES + 1)
+        await form.close()
+    else:
+        chunks = []
+        size = 0
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > IMAGE_MAX_UPLOAD_BYTES:
+                raise too_large
+            chunks.append(chunk)
+        raw = b"".join(chunks)
+    if len(raw) > IMAGE_MAX_UPLOAD_BYTES:
+        raise too_large
+    if not raw:
+        raise HTTPException(status_code=400, detail="Empty image")
+    return raw
+
 
-    patient_data = patients_db[patient_name]
-    recommendations = generate_exercises(patient_data, num_exercises)
-    if not recommendations:
-        raise HTTPException(status_code=500, detail="Failed to generate exercises")
+@app.post("/detect_injury_location")
+async def detect_injury(request: Request):
+    """
+    Identifies the body part a photo points at. Takes a multipart upload
+    (field "image") or a raw image body. The photo is downscaled and
+    re-encoded in a worker process before it goes to the model, and the
+    result is cached by a hash of the normalized pixels, so the same photo
+    uploaded again is answered without a model call.
+    """
+    image = await _read_image_upload(request)
+    try:
+        prepared = await prepare(image)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    upload = {
+        "image_hash": prepared.image_hash,
+        "original_bytes": prepared.original_bytes,
+        "sent_bytes": len(prepared.data),
+        "width": prepared.width,
+        "height": prepared.height,
+    }
+    # Only the diagnosis is cached; everything about the upload describes this request.
+    cached = image_cache.get(prepared)
+    record_image_cache("hit" if cached is not None else "miss")
+    if cached is not None:
+        return dict(upload, location=cached["location"], usage={}, cached=True)
 
-    patients_db[patient_name]["recommendations"] = recommendations
-    save_patients(patients_db)
-    return recommendations
+    usage = {}
+    try:
+        location = await detect_injury_location(
+            base64.b64encode(prepared.data).decode("ascii"), prepared.media_type, usage
+        )
+    except LLMUnavailable as e:
+        raise HTTPException(
+            status_code=503, detail="Injury detection is temporarily unavailable",
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
+    if not location:
+        raise HTTPException(status_code=500, detail="Failed to identify the injury location")
+    image_cache.put(prepared, {"location": location})
+    return dict(upload, location=location, usage=usage, cached=False)
 
 
 @app.get("/weekly_schedule/{patient_name}")
-def get_weekly_schedule(patient_name: str):
+def get_weekly_schedule(patient_name: str, response: Response):
     """
     Returns the weekly schedule for a given patient.
     """
-    if patient_name not in patients_db:
+    version = repo.get_version(patient_name)
+    schedule = repo.get_weekly_schedule(patient_name)
+    if schedule is None:
         raise HTTPException(status_code=404, detail="Patient not found")
-    return patients_db[patient_name]["weekly_schedule"]
+    response.headers["ETag"] = etag(version)
+    return schedule
 
 
 @app.post("/weekly_schedule/{patient_name}/{day}")
-def add_exercise_to_day(patient_name: str, day: str, exercise: Dict):
+def add_exercise_to_day(patient_name: str, day: str, exercise: Dict, response: Response,
+                        if_match: Optional[str] = Header(None), durable: bool = False):
     """
     Add an exercise to a particular day of the patient's weekly schedule.
+    With If-Match, fails with 412 if the patient changed since that ETag.
+    With durable=true, answers only once the write is on disk.
     """
-    if patient_name not in patients_db:
+    name = exercise.get("name")
+    if not isinstance(name, str) or not name.strip():
+        raise HTTPException(status_code=400, detail="Exercise needs a non-empty 'name'")
+    schedule = repo.get_weekly_schedule(patient_name)
+    if schedule is None:
         raise HTTPException(status_code=404, detail="Patient not found")
-    if day not in patients_db[patient_name]["weekly_schedule"]:
+    if day not in schedule:
         raise HTTPException(status_code=400, detail="Invalid day provided")
 
-    patients_db[patient_name]["weekly_schedule"][day].append(exercise)
-    save_patients(patients_db)
+    version = repo.append_exercise(patient_name, day, exercise, expected_version=expected_version(if_match))
+    if durable:
+        repo.flush()
+    response.headers["ETag"] = etag(version)
     return {"message": f"Exercise added to {day} for {patient_name}"}
 
 
 @app.get("/pt_schedule")
-def get_overall_pt_schedule():
+def get_overall_pt_schedule(day: Optional[str] = None, offset: int = 0, limit: Optional[int] = None):
     """
     Returns the PT's overall schedule (combines all patients).
+    Optionally restricted to one day, with offset/limit paging each day's entries.
     """
-    from OldStreamlit.utils import generate_pt_weekly_schedule
-    schedule = generate_pt_weekly_schedule(patients_db)
-    return schedule
+    if day is not None and day not in create_weekly_schedule():
+        raise HTTPException(status_code=400, detail="Invalid day provided")
+    if offset < 0 or (limit is not None and limit < 0):
+        raise HTTPException(status_code=400, detail="offset and limit must not be negative")
+    return repo.pt_schedule(day=day, offset=offset, limit=limit)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """
+    Request latency histograms, storage/LLM/schedule spans and token
+    counters in the Prometheus text format.
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+def _check_profiler_enabled():
+    if not PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+
+@app.get("/debug/profiler")
+def get_profiler_status():
+    """
+    Returns whether the sampling profiler is running and how many samples it holds.
+    Like the other /debug/profiler endpoints, 404 unless PROFILER_ENABLED=1.
+    """
+    _check_profiler_enabled()
+    return profiler.status()
+
+
+@app.post("/debug/profiler/start")
+def start_profiler(interval: float = 0.005):
+    """
+    Starts sampling all thread stacks every `interval` seconds.
+    """
+    _check_profiler_enabled()
+    if interval <= 0:
+        raise HTTPException(status_code=400, detail="interval must be positive")
+    profiler.start(interval)
+    return profiler.status()
+
+
+@app.post("/debug/profiler/stop", response_class=PlainTextResponse)
+def stop_profiler(top: Optional[int] = None):
+    """
+    Stops the profiler and returns the collected samples as collapsed stacks.
+    """
+    _check_profiler_enabled()
+    profiler.stop()
+    return PlainTextResponse(profiler.report(top))
 
 
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,309 @@
+# metrics.py
+import os
+import sys
+import threading
+import time
+import traceback
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+# Set METRICS_ENABLED=0 to turn spans and request timing into no-ops.
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1").lower() not in ("0", "false", "no")
+
+# Latency buckets in seconds, from sub-millisecond storage writes to slow LLM calls.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{str(value)}"'.replace("\n", " ") for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label set, in the Prometheus layout."""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series: Dict[Tuple[str, ...], list] = {}  # labels -> [bucket counts, sum, count]
+
+    def observe(self, value: float, *label_values: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = [(key, list(counts), total, count) for key, (counts, total, count) in self._series.items()]
+        for key, counts, total, count in sorted(series):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, key, 'le="%s"' % bound)
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labels, key, 'le="+Inf"')
+            yield f"{self.name}_bucket{labels} {count}"
+            yield f"{self.name}_sum{_format_labels(self.labels, key)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labels, key)} {count}"
+
+
+class CounterMetric:
+    """Monotonic counter per label set."""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, *label_values: str):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labels, key)} {value}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> CounterMetric:
+        metric = CounterMetric(name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Text exposition format served by GET /metrics."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+request_duration = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route.", ("method", "route", "status")
+)
+span_duration = registry.histogram(
+    "span_duration_seconds", "Time spent in instrumented sections (storage, LLM, schedule).", ("span",)
+)
+llm_tokens = registry.counter("llm_tokens_total", "Anthropic tokens used, by kind.", ("kind",))
+upstream_attempt_duration = registry.histogram(
+    "upstream_attempt_duration_seconds", "Duration of each upstream call attempt (primary, hedge) by outcome.",
+    ("upstream", "kind", "outcome"),
+)
+circuit_transitions = registry.counter(
+    "circuit_breaker_transitions_total", "Circuit breaker state changes.", ("circuit", "state")
+)
+llm_output_repairs = registry.counter(
+    "llm_output_repairs_total", "Model responses that needed repair, by kind.", ("kind",)
+)
+patient_store_flush_duration = registry.histogram(
+    "patient_store_flush_duration_seconds", "Time to write (and fsync) one batch of patient log records."
+)
+patient_store_compaction_failures = registry.counter(
+    "patient_store_compaction_failures_total", "Patient log compactions that failed to write the snapshot."
+)
+patient_store_flush_records = registry.histogram(
+    "patient_store_flush_records", "Mutations written per patient log flush; sum/count is the coalescing ratio.",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024),
+)
+image_cache_requests = registry.counter(
+    "image_cache_requests_total", "Injury-location lookups by image hash, by result (hit, miss).", ("result",)
+)
+llm_fallbacks = registry.counter(
+    "llm_fallbacks_total", "Generations served without the model because it was unavailable.", ("source",)
+)
+
+
+@contextmanager
+def span(name: str):
+    """Times the enclosed block into span_duration_seconds{span=name}."""
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        span_duration.observe(time.perf_counter() - start, name)
+
+
+def record_tokens(report: Dict):
+    """Adds a usage_report() dict to llm_tokens_total."""
+    if not METRICS_ENABLED:
+        return
+    for kind, value in report.items():
+        if isinstance(value, int) and value and not isinstance(value, bool):
+            llm_tokens.inc(value, kind)
+
+
+def record_attempt(upstream: str, kind: str, outcome: str, seconds: float):
+    if METRICS_ENABLED:
+        upstream_attempt_duration.observe(seconds, upstream, kind, outcome)
+
+
+def record_circuit_transition(circuit: str, state: str):
+    if METRICS_ENABLED:
+        circuit_transitions.inc(1, circuit, state)
+
+
+def record_repair(kind: str):
+    if METRICS_ENABLED:
+        llm_output_repairs.inc(1, kind)
+
+
+def record_flush(records: int, seconds: float):
+    if METRICS_ENABLED:
+        patient_store_flush_duration.observe(seconds)
+        patient_store_flush_records.observe(records)
+
+
+def record_compaction_failure():
+    if METRICS_ENABLED:
+        patient_store_compaction_failures.inc(1)
+
+
+def record_image_cache(result: str):
+    if METRICS_ENABLED:
+        image_cache_requests.inc(1, result)
+
+
+def record_fallback(source: str):
+    if METRICS_ENABLED:
+        llm_fallbacks.inc(1, source)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording request latency per route template
+    (e.g. /patients/{patient_name}), so patient names never become labels.
+    Timing runs until the response body is fully sent, which includes
+    streamed responses.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._routes: Dict = {}
+
+    def _route(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        route = self._routes.get(endpoint)
+        if route is None:
+            for candidate in scope["app"].routes:
+                if getattr(candidate, "endpoint", None) is endpoint:
+                    route = candidate.path
+                    break
+            route = self._routes[endpoint] = route or "unmatched"
+        return route
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            request_duration.observe(
+                time.perf_counter() - start, scope["method"], self._route(scope), str(status[0])
+            )
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler that snapshots every thread's stack at a fixed
+    interval with sys._current_frames(). Nothing runs while it is stopped;
+    report() returns collapsed stacks ("frame;frame;frame count"), which
+    flamegraph tools read directly.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.interval = 0.005
+        self.samples: Counter = Counter()
+        self.started_at: Optional[float] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval: float = 0.005):
+        with self._lock:
+            if self.running:
+                return
+            self.interval = interval
+            self.samples = Counter()
+            self.started_at = time.time()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            thread = self._thread
+            self._stop.set()
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = traceback.extract_stack(frame)
+                key = ";".join(f"{os.path.basename(f.filename)}:{f.name}:{f.lineno}" for f in stack)
+                self.samples[key] += 1
+
+    def report(self, top: Optional[int] = None) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common(top)) + "\n"
+
+    def status(self) -> Dict:
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "started_at": self.started_at,
+            "samples": sum(self.samples.values()),
+        }
+
+
+profiler = SamplingProfiler()
@@ -1,6 +1,6 @@
 # models.py
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, Field
+from typing import List, Optional
 
 class PatientCreate(BaseModel):
     name: str
@@ -22,6 +22,31 @@ class PatientUpdate(BaseModel):
     activity_level: Optional[str] = None
     goals: Optional[str] = None
 
+class Exercise(BaseModel):
+    """One generated exercise, as the model is asked to return it (see services.SYSTEM_PROMPT)."""
+    id: str = ""
+    name: str = Field(..., min_length=1)
+    description: str = ""
+    parameters: str = ""
+    progressionCriteria: str = ""
+    rationale: str = ""
+
 class ExerciseRecommendationsRequest(BaseModel):
     patient_name: str
     num_exercises: int
+    use_cache: bool = True
+    # auto: reuse a similar patient's plan if one is close enough;
+    # seed: always call the model, with the closest plan as a reference;
+    # fresh: always call the model, skipping every cache.
+    mode: str = Field("auto", regex="^(auto|seed|fresh)$")
+    # Finished jobs are POSTed here; must be on localhost.
+    callback_url: Optional[str] = None
+
+class BatchGenerationRequest(BaseModel):
+    # Either explicit names or filters; no names and no filters means every patient.
+    patient_names: Optional[List[str]] = None
+    injury_location: Optional[str] = None
+    activity_level: Optional[str] = None
+    num_exercises: int
+    concurrency: Optional[int] = None
+    use_cache: bool = True
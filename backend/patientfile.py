@@ -0,0 +1,221 @@
+# patientfile.py
+"""
+Streaming reader/writer for patient database files.
+
+A database file maps patient name -> record. Two formats are supported and
+detected automatically when reading:
+
+  - json: the original `{"name": {...}, ...}` object, indented or compact
+  - msgpack: a stream of [name, record] pairs (needs the optional msgpack
+    package)
+
+Reading yields one patient at a time and writing goes patient by patient
+to a temp file that is atomically renamed, so neither holds more than one
+serialized patient plus a read buffer in memory.
+
+    python patientfile.py convert database/patients.json database/patients.msgpack --format msgpack
+"""
+import argparse
+import json
+import os
+from typing import Dict, Iterable, Iterator, Optional, Tuple, Union
+
+try:
+    import msgpack
+except ImportError:  # optional, only needed for the msgpack format
+    msgpack = None
+
+FORMATS = ("json", "msgpack")
+READ_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+def detect_format(path: str) -> str:
+    with open(path, "rb") as f:
+        head = f.read(64).lstrip()
+    if not head or head[:1] == b"{":
+        return "json"
+    return "msgpack"
+
+
+def iter_patients(path: str) -> Iterator[Tuple[str, Dict]]:
+    """Yields (name, record) pairs from a database file; nothing if it is missing or empty."""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return iter(())
+    if detect_format(path) == "msgpack":
+        return _iter_msgpack(path)
+    return _iter_json(path)
+
+
+def read_patients(path: str) -> Dict:
+    return dict(iter_patients(path))
+
+
+def _iter_msgpack(path: str) -> Iterator[Tuple[str, Dict]]:
+    _require_msgpack()
+    with open(path, "rb") as f:
+        for name, data in msgpack.Unpacker(f, raw=False, read_size=READ_SIZE):
+            yield name, data
+
+
+class _JsonObjectReader:
+    """Incremental reader over the top-level object of a JSON file."""
+
+    def __init__(self, f):
+        self.f = f
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size: int) -> bool:
+        if self.eof:
+            return False
+        chunk = self.f.read(size)
+        if len(chunk) < size:
+            self.eof = True
+        # Drop consumed text so the buffer only holds the current item.
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def next_char(self) -> str:
+        """Skips whitespace and returns (without consuming) the next character."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill(READ_SIZE):
+                return ""
+
+    def expect(self, char: str):
+        if self.next_char() != char:
+            raise ValueError(f"Expected {char!r} at offset {self.pos} of the patients file")
+        self.pos += 1
+
+    def value(self):
+        """Decodes the next JSON value, reading more input until it is complete."""
+        self.next_char()
+        size = READ_SIZE
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # Incomplete value: read more, doubling so one large record stays linear.
+                if not self._fill(size):
+                    raise
+                size *= 2
+                continue
+            # A number could continue past the end of the buffer.
+            if end == len(self.buffer) and not self.eof:
+                self._fill(size)
+                continue
+            self.pos = end
+            return value
+
+
+def _iter_json(path: str) -> Iterator[Tuple[str, Dict]]:
+    with open(path, "r", encoding="utf-8") as f:
+        reader = _JsonObjectReader(f)
+        reader.expect("{")
+        if reader.next_char() == "}":
+            return
+        while True:
+            name = reader.value()
+            reader.expect(":")
+            yield name, reader.value()
+            if reader.next_char() == ",":
+                reader.pos += 1
+                continue
+            reader.expect("}")
+            return
+
+
+def _require_msgpack():
+    if msgpack is None:
+        raise RuntimeError("The msgpack format needs the msgpack package (pip install msgpack)")
+
+
+def _pairs(patients: Union[Dict, Iterable[Tuple[str, Dict]]]) -> Iterable[Tuple[str, Dict]]:
+    return patients.items() if isinstance(patients, dict) else patients
+
+
+def encode_patients(patients: Union[Dict, Iterable[Tuple[str, Dict]]], fmt: str = "json") -> bytes:
+    """Serializes a whole database in one buffer (for snapshots taken under a lock)."""
+    if fmt == "msgpack":
+        _require_msgpack()
+        packer = msgpack.Packer(use_bin_type=True)
+        return b"".join(packer.pack([name, data]) for name, data in _pairs(patients))
+    if isinstance(patients, dict):
+        return json.dumps(patients).encode("utf-8")
+    return json.dumps(dict(patients)).encode("utf-8")
+
+
+def write_patients(path: str, patients: Union[Dict, Iterable[Tuple[str, Dict]]], fmt: str = "json",
+                   indent: Optional[int] = None, fsync: bool = True):
+    """
+    Writes a database file patient by patient and atomically replaces
+    `path`. With `indent`, the JSON output is byte-identical to
+    json.dump(patients, f, indent=indent).
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown patients file format: {fmt}")
+    tmp_path = path + ".tmp"
+    if fmt == "msgpack":
+        _require_msgpack()
+        packer = msgpack.Packer(use_bin_type=True)
+        with open(tmp_path, "wb") as f:
+            for name, data in _pairs(patients):
+                f.write(packer.pack([name, data]))
+            _finish(f, fsync)
+    else:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            _write_json(f, _pairs(patients), indent)
+            _finish(f, fsync)
+    os.replace(tmp_path, path)
+
+
+def _write_json(f, pairs: Iterable[Tuple[str, Dict]], indent: Optional[int] = None):
+    # Same separators as json.dumps, so the output matches it byte for byte.
+    if indent is None:
+        separator, newline, closing = ", ", "", "}"
+    else:
+        separator, newline, closing = ",", "\n" + " " * indent, "\n}"
+    first = True
+    f.write("{")
+    for name, data in pairs:
+        value = json.dumps(data, indent=indent)
+        if indent is not None:
+            value = value.replace("\n", newline)
+        f.write(("" if first else separator) + newline + json.dumps(name) + ": " + value)
+        first = False
+    f.write("}" if first else closing)
+
+
+def _finish(f, fsync: bool):
+    f.flush()
+    if fsync:
+        os.fsync(f.fileno())
+
+
+def convert(source: str, destination: str, fmt: str = "json", indent: Optional[int] = None):
+    """Rewrites a database file in another format, one patient at a time."""
+    write_patients(destination, iter_patients(source), fmt=fmt, indent=indent)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert patient database files between formats.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert_parser = subparsers.add_parser("convert")
+    convert_parser.add_argument("source")
+    convert_parser.add_argument("destination")
+    convert_parser.add_argument("--format", default="json", choices=FORMATS)
+    convert_parser.add_argument("--indent", type=int, help="Indent JSON output (default: compact)")
+    args = parser.parse_args()
+    convert(args.source, args.destination, args.format, args.indent)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+# planexport.py
+"""
+Renders treatment plans (patient profile plus weekly schedule) as text,
+CSV or PDF for GET /patients/{name}/plan and the zip of every plan from
+GET /plans/export.
+
+Each plan is rendered in one pass from the templates below. Rendered
+documents are cached by (patient name, patient version, format), so an
+unchanged patient is never rendered twice. Versions are never reused,
+not even for a patient deleted and created again under the same name,
+so any write (rename and delete included) makes the old entries
+unreachable and they simply age out.
+"""
+import csv
+import io
+import re
+import textwrap
+import threading
+import zipfile
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+FORMATS = {
+    "txt": "text/plain",
+    "csv": "text/csv",
+    "pdf": "application/pdf",
+}
+
+PLAN_TEMPLATE = """PHYSICAL THERAPY TREATMENT PLAN
+==============================
+
+PATIENT INFORMATION
+--------------------
+Name: {name}
+Age: {age}
+Injury Location: {injury_location}
+Pain Level: {pain_level}/10
+Activity Level: {activity_level}
+
+Treatment Goals:
+{goals}
+
+WEEKLY EXERCISE SCHEDULE
+--------------------
+{schedule}"""
+DAY_TEMPLATE = "\n{day}:\n{exercises}"
+EXERCISE_TEMPLATE = """  • {name}
+    Parameters: {parameters}
+    Description: {description}
+    Progression Criteria: {progressionCriteria}
+"""
+REST_DAY = "Rest day / No exercises scheduled\n"
+
+CSV_COLUMNS = ["patient", "day", "position", "name", "parameters", "description", "progressionCriteria"]
+EXERCISE_FIELDS = ["name", "parameters", "description", "progressionCriteria"]
+
+
+def _exercise_fields(exercise: Dict) -> Dict:
+    return {field: exercise.get(field, "") for field in EXERCISE_FIELDS}
+
+
+def render_text(name: str, data: Dict) -> str:
+    days = []
+    for day, exercises in data.get("weekly_schedule", {}).items():
+        body = "".join(EXERCISE_TEMPLATE.format(**_exercise_fields(ex)) for ex in exercises) or REST_DAY
+        days.append(DAY_TEMPLATE.format(day=day, exercises=body))
+    return PLAN_TEMPLATE.format(
+        name=name,
+        age=data.get("age", "N/A"),
+        injury_location=data.get("injury_location", "N/A"),
+        pain_level=data.get("pain_level", "N/A"),
+        activity_level=data.get("activity_level", "N/A"),
+        goals=data.get("goals", "N/A"),
+        schedule="".join(days),
+    )
+
+
+def render_csv(name: str, data: Dict) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    for day, exercises in data.get("weekly_schedule", {}).items():
+        for position, exercise in enumerate(exercises):
+            writer.writerow([name, day, position] + [exercise.get(field, "") for field in EXERCISE_FIELDS])
+    return buffer.getvalue()
+
+
+# Letter page, 10pt Helvetica.
+PAGE_WIDTH, PAGE_HEIGHT = 612, 792
+MARGIN = 50
+LINE_HEIGHT = 13
+FONT_SIZE = 10
+WRAP_COLUMNS = 95
+LINES_PER_PAGE = (PAGE_HEIGHT - 2 * MARGIN) // LINE_HEIGHT
+
+
+def _pdf_string(text: str) -> bytes:
+    data = text.encode("cp1252", errors="replace")
+    return b"(" + data.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+
+def render_pdf(text: str) -> bytes:
+    """
+    Lays plain text out as a minimal PDF (built-in Helvetica, no
+    dependencies), wrapping long lines and breaking pages as needed.
+    """
+    lines: List[str] = []
+    for line in text.split("\n"):
+        indent = len(line) - len(line.lstrip(" "))
+        lines.extend(textwrap.wrap(line, WRAP_COLUMNS, subsequent_indent=" " * (indent + 2)) or [""])
+    pages = [lines[i:i + LINES_PER_PAGE] for i in range(0, len(lines), LINES_PER_PAGE)] or [[]]
+
+    objects: List[bytes] = []  # object n is objects[n - 1]
+    objects.append(b"<< /Type /Catalog /Pages 2 0 R >>")
+    objects.append(b"")  # page tree, filled in once page ids are known
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+    page_ids = []
+    for page in pages:
+        stream = b"BT /F1 %d Tf %d TL %d %d Td " % (FONT_SIZE, LINE_HEIGHT, MARGIN, PAGE_HEIGHT - MARGIN)
+        stream += b"".join(_pdf_string(line) + b" Tj T* " for line in page) + b"ET"
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>"
+            % (PAGE_WIDTH, PAGE_HEIGHT, len(objects))
+        )
+        page_ids.append(len(objects))
+    kids = b" ".join(b"%d 0 R" % page_id for page_id in page_ids)
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def render_plan(name: str, data: Dict, fmt: str) -> bytes:
+    if fmt == "csv":
+        return render_csv(name, data).encode("utf-8")
+    text = render_text(name, data)
+    if fmt == "pdf":
+        return render_pdf(text)
+    return text.encode("utf-8")
+
+
+class PlanCache:
+    """LRU cache of rendered plans keyed by (name, version, format), bounded by total size."""
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple[str, str, str], bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name: str, version: str, fmt: str) -> Optional[bytes]:
+        key = (name, version, fmt)
+        with self._lock:
+            document = self._entries.get(key)
+            if document is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return document
+
+    def put(self, name: str, version: str, fmt: str, document: bytes):
+        key = (name, version, fmt)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous)
+            self._entries[key] = document
+            self._bytes += len(document)
+            while self._bytes > self.max_bytes and self._entries:
+                self._bytes -= len(self._entries.popitem(last=False)[1])
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+
+def cached_plan(cache: PlanCache, name: str, fmt: str,
+                get_version: Callable[[str], Optional[str]],
+                get_with_version: Callable[[str], Tuple[Optional[Dict], Optional[str]]]) -> Tuple[Optional[bytes], Optional[str]]:
+    """
+    Returns (document, version) for a patient, rendering only when the
+    cache has nothing for its current version; (None, None) if it is gone.
+    """
+    version = get_version(name)
+    if version is None:
+        return None, None
+    document = cache.get(name, version, fmt)
+    if document is None:
+        data, version = get_with_version(name)
+        if data is None:
+            return None, None
+        document = render_plan(name, data, fmt)
+        cache.put(name, version, fmt, document)
+    return document, version
+
+
+_UNSAFE = re.compile(r"[^A-Za-z0-9._-]+")
+
+
+def plan_filename(name: str, fmt: str) -> str:
+    return f"treatment_plan_{_UNSAFE.sub('_', name).strip('_') or 'patient'}.{fmt}"
+
+
+class _ChunkWriter(io.RawIOBase):
+    """Unseekable sink that hands what zipfile wrote so far to the caller."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def zip_documents(documents: Iterable[Tuple[str, bytes]]) -> Iterator[bytes]:
+    """Streams a zip of (filename, document) pairs, one member at a time."""
+    sink = _ChunkWriter()
+    seen: Dict[str, int] = {}
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for filename, document in documents:
+            count = seen.get(filename, 0)
+            seen[filename] = count + 1
+            if count:
+                stem, dot, ext = filename.rpartition(".")
+                filename = f"{stem}-{count + 1}{dot}{ext}"
+            archive.writestr(filename, document)
+            yield sink.take()
+    yield sink.take()
@@ -0,0 +1,926 @@
+# repository.py
+import bisect
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from catalog import ExerciseCatalog, exercise_ref, from_refs, recommendations_to_refs, refs_in, to_refs
+from locks import KeyedLocks
+from metrics import span
+from schedule_index import PTScheduleIndex
+from storage import PatientStore
+from utils import DATA_FILE, EXERCISE_CATALOG_FILE, create_weekly_schedule, exercise_name, patient_store
+
+PROFILE_FIELDS = [
+    "age",
+    "injury_location",
+    "pain_level",
+    "mobility_status",
+    "medical_history",
+    "activity_level",
+    "goals",
+]
+
+# Everything GET /patients/{name}?fields= can select.
+PATIENT_FIELDS = PROFILE_FIELDS + ["weekly_schedule", "recommendations"]
+
+
+def project(data: Dict, fields: List[str], summarize_schedule: bool = False) -> Dict:
+    """Copies `fields` out of a full record; the schedule can be reduced to exercise names."""
+    result = {}
+    for field in fields:
+        if field == "weekly_schedule" and summarize_schedule:
+            result[field] = {day: [exercise_name(ex) for ex in exercises]
+                             for day, exercises in data.get(field, {}).items()}
+        elif field in data:
+            result[field] = data[field]
+    return result
+
+
+def prefix_upper_bound(prefix: str) -> str:
+    """Smallest string greater than every string starting with `prefix`."""
+    return prefix + "\U0010ffff"
+
+
+class PatientNotFound(Exception):
+    pass
+
+
+class PatientExists(Exception):
+    pass
+
+
+class VersionConflict(Exception):
+    """The patient changed since the version the caller based its write on."""
+    pass
+
+
+class PatientRepository:
+    """
+    Storage interface used by the API. Implementations only need to
+    provide the primitive operations below; callers never touch the
+    underlying dict or database directly.
+
+    Every patient carries an opaque version string that changes on each
+    write. Mutations return the new version and, when given
+    `expected_version`, raise VersionConflict instead of overwriting a
+    newer record (optimistic concurrency, exposed as ETag/If-Match).
+    """
+
+    def list_names(self) -> List[str]:
+        raise NotImplementedError
+
+    def list_names_page(self, prefix: str = "", after: Optional[str] = None, limit: int = 100) -> List[str]:
+        """
+        Up to `limit` names starting with `prefix`, in sorted order,
+        strictly after `after` (the last name of the previous page).
+        """
+        names = sorted(name for name in self.list_names() if name.startswith(prefix))
+        if after is not None:
+            names = names[bisect.bisect_right(names, after):]
+        return names[:limit]
+
+    def exists(self, name: str) -> bool:
+        raise NotImplementedError
+
+    def get(self, name: str) -> Optional[Dict]:
+        """Returns the full patient record, or None if it does not exist."""
+        raise NotImplementedError
+
+    def get_version(self, name: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def get_with_version(self, name: str) -> Tuple[Optional[Dict], Optional[str]]:
+        """Returns the record together with the version it was read at."""
+        return self.get(name), self.get_version(name)
+
+    def get_fields(self, name: str, fields: List[str],
+                   summarize_schedule: bool = False) -> Tuple[Optional[Dict], Optional[str]]:
+        """
+        Like get_with_version, but only loads `fields` (see PATIENT_FIELDS).
+        With `summarize_schedule`, weekly_schedule maps each day to
+        exercise names instead of full exercise objects.
+        """
+        data, version = self.get_with_version(name)
+        if data is None:
+            return None, None
+        return project(data, fields, summarize_schedule), version
+
+    def get_weekly_schedule(self, name: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    def find_names(self, injury_location: Optional[str] = None, activity_level: Optional[str] = None) -> List[str]:
+        """Names of patients matching every given filter."""
+        raise NotImplementedError
+
+    def iter_patients(self) -> Iterator[Tuple[str, Dict]]:
+        """Yields (name, record) pairs one at a time."""
+        raise NotImplementedError
+
+    def iter_schedule_entries(self) -> Iterator[Tuple[str, str, str]]:
+        """Yields (day, patient_name, exercise_name) for every scheduled exercise."""
+        raise NotImplementedError
+
+    def create(self, name: str, data: Dict) -> str:
+        """Raises PatientExists if the name is taken."""
+        raise NotImplementedError
+
+    def create_many(self, patients: List[Tuple[str, Dict]]) -> List[Optional[str]]:
+        """
+        Creates several patients in one storage commit. Returns each one's
+        version, in order, or None where the name was taken (by an existing
+        patient or an earlier entry of the batch).
+        """
+        raise NotImplementedError
+
+    def update(self, name: str, fields: Dict, new_name: Optional[str] = None,
+               expected_version: Optional[str] = None) -> str:
+        """
+        Sets profile fields (see PROFILE_FIELDS) on an existing patient,
+        renaming it first if `new_name` is given. Both happen atomically.
+        """
+        raise NotImplementedError
+
+    def delete(self, name: str, expected_version: Optional[str] = None):
+        raise NotImplementedError
+
+    def set_recommendations(self, name: str, recommendations: Dict) -> str:
+        raise NotImplementedError
+
+    def set_recommendations_many(self, recommendations: Dict[str, Dict]):
+        """Stores recommendations for several patients in one commit."""
+        raise NotImplementedError
+
+    def append_exercise(self, name: str, day: str, exercise: Dict, expected_version: Optional[str] = None) -> str:
+        raise NotImplementedError
+
+    def flush(self):
+        """Blocks until every write made so far is durable. Writes are durable on return unless batched."""
+        pass
+
+    def close(self):
+        pass
+
+    def storage_status(self) -> Dict:
+        """Health of the underlying storage for the readiness probe (e.g. failed compactions)."""
+        return {}
+
+    def pt_schedule(self, day: Optional[str] = None, offset: int = 0, limit: Optional[int] = None) -> Dict:
+        """
+        Combines every patient's schedule into the PT's weekly schedule,
+        optionally for one day and with `offset`/`limit` applied per day.
+        """
+        schedule = create_weekly_schedule()
+        for entry_day, patient_name, exercise_name in self.iter_schedule_entries():
+            schedule.setdefault(entry_day, []).append(f"{patient_name}: {exercise_name}")
+        if day is not None:
+            schedule = {day: schedule.get(day, [])}
+        end = None if limit is None else offset + limit
+        return {d: entries[offset:end] for d, entries in schedule.items()}
+
+
+class JsonPatientRepository(PatientRepository):
+    """
+    Keeps every patient in memory and persists through the snapshot +
+    write-ahead log in storage.PatientStore. This is the original behaviour.
+
+    Writes hold a per-patient lock for the check-then-write, so different
+    patients are updated in parallel. Versions come from one in-memory
+    sequence shared by all patients and are prefixed with a per-process
+    epoch, so a version is never issued twice: not to a patient deleted
+    and created again, nor across a restart.
+
+    Scheduled and recommended exercises are stored as refs into the
+    exercise catalog and dereferenced on read.
+    """
+
+    def __init__(self, store: PatientStore, catalog: ExerciseCatalog):
+        self.store = store
+        self.catalog = catalog.load()
+        self.patients = store.load()
+        self.locks = KeyedLocks()
+        self._epoch = uuid.uuid4().hex[:8]
+        self._versions: Dict[str, int] = {}
+        self._sequence = itertools.count(1)
+        self.schedule_index = PTScheduleIndex()
+        self._schedule_index_stale = False
+        live_refs = set()
+        for name, data in self.patients.items():
+            # Records written before the catalog existed hold full exercises;
+            # swap in refs now and let the next snapshot persist them.
+            data.update(to_refs(self.catalog, data))
+            live_refs.update(refs_in(data))
+            self.schedule_index.add_patient(name, self._schedule(data))
+        self.catalog.retain(live_refs)
+        # Sorted copy of the names for cursor pagination, kept up to date on create/rename/delete.
+        self._names_lock = threading.Lock()
+        self._sorted_names = sorted(self.patients)
+
+    def list_names(self) -> List[str]:
+        return list(self.patients.keys())
+
+    def list_names_page(self, prefix: str = "", after: Optional[str] = None, limit: int = 100) -> List[str]:
+        with self._names_lock:
+            names = self._sorted_names
+            start = bisect.bisect_left(names, prefix)
+            if after is not None:
+                start = max(start, bisect.bisect_right(names, after))
+            end = bisect.bisect_left(names, prefix_upper_bound(prefix), lo=start) if prefix else len(names)
+            return names[start:min(end, start + limit)]
+
+    def _add_name(self, name: str):
+        with self._names_lock:
+            bisect.insort(self._sorted_names, name)
+
+    def _add_names(self, names: List[str]):
+        with self._names_lock:
+            self._sorted_names.extend(names)
+            self._sorted_names.sort()
+
+    def _remove_name(self, name: str):
+        with self._names_lock:
+            index = bisect.bisect_left(self._sorted_names, name)
+            if index < len(self._sorted_names) and self._sorted_names[index] == name:
+                del self._sorted_names[index]
+
+    def exists(self, name: str) -> bool:
+        return name in self.patients
+
+    def get(self, name: str) -> Optional[Dict]:
+        data = self.patients.get(name)
+        return from_refs(self.catalog, data) if data is not None else None
+
+    def _schedule(self, data: Dict) -> Dict:
+        return {day: self.catalog.resolve_all(exercises) for day, exercises in data.get("weekly_schedule", {}).items()}
+
+    def get_version(self, name: str) -> Optional[str]:
+        if name not in self.patients:
+            return None
+        return f"{self._epoch}-{self._versions.get(name, 0)}"
+
+    def get_with_version(self, name: str) -> Tuple[Optional[Dict], Optional[str]]:
+        with self.locks.hold(name):
+            return self.get(name), self.get_version(name)
+
+    def _check(self, name: str, expected_version: Optional[str]):
+        if name not in self.patients:
+            raise PatientNotFound(name)
+        if expected_version is not None and expected_version != self.get_version(name):
+            raise VersionConflict(name)
+
+    def _bump(self, name: str) -> str:
+        self._versions[name] = next(self._sequence)
+        return self.get_version(name)
+
+    def get_weekly_schedule(self, name: str) -> Optional[Dict]:
+        data = self.patients.get(name)
+        if data is None:
+            return None
+        return self._schedule(data)
+
+    def find_names(self, injury_location: Optional[str] = None, activity_level: Optional[str] = None) -> List[str]:
+        return [
+            name
+            for name, data in list(self.patients.items())
+            if (injury_location is None or data.get("injury_location") == injury_location)
+            and (activity_level is None or data.get("activity_level") == activity_level)
+        ]
+
+    def iter_patients(self) -> Iterator[Tuple[str, Dict]]:
+        for name, data in list(self.patients.items()):
+            yield name, from_refs(self.catalog, data)
+
+    def iter_schedule_entries(self) -> Iterator[Tuple[str, str, str]]:
+        for patient_name, data in list(self.patients.items()):
+            for day, exercises in self._schedule(data).items():
+                for exercise in exercises:
+                    yield day, patient_name, exercise_name(exercise)
+
+    def create(self, name: str, data: Dict) -> str:
+        with self.locks.hold(name):
+            if name in self.patients:
+                raise PatientExists(name)
+            self.store.put(name, to_refs(self.catalog, data))
+            self.schedule_index.add_patient(name, data.get("weekly_schedule", {}))
+            self._add_name(name)
+            return self._bump(name)
+
+    def create_many(self, patients: List[Tuple[str, Dict]]) -> List[Optional[str]]:
+        with self.locks.hold(*(name for name, _ in patients)):
+            new: Dict[str, Dict] = {}
+            for name, data in patients:
+                if name not in self.patients and name not in new:
+                    new[name] = data
+            self.store.put_many({name: to_refs(self.catalog, data) for name, data in new.items()})
+            for name, data in new.items():
+                self.schedule_index.add_patient(name, data.get("weekly_schedule", {}))
+            self._add_names(list(new))
+            versions = {name: self._bump(name) for name in new}
+        return [versions.pop(name, None) for name, _ in patients]
+
+    def update(self, name: str, fields: Dict, new_name: Optional[str] = None,
+               expected_version: Optional[str] = None) -> str:
+        renaming = new_name is not None and new_name != name
+        with self.locks.hold(name, *([new_name] if renaming else [])):
+            self._check(name, expected_version)
+            if renaming and new_name in self.patients:
+                raise PatientExists(new_name)
+            self.store.update(name, fields, new_name=new_name)
+            if renaming:
+                self.schedule_index.rename_patient(name, new_name)
+                self._remove_name(name)
+                self._add_name(new_name)
+                self._versions.pop(name, None)
+                name = new_name
+            return self._bump(name)
+
+    def delete(self, name: str, expected_version: Optional[str] = None):
+        with self.locks.hold(name):
+            self._check(name, expected_version)
+            self.store.delete(name)
+            self.schedule_index.remove_patient(name)
+            self._remove_name(name)
+            self._versions.pop(name, None)
+
+    def set_recommendations(self, name: str, recommendations: Dict) -> str:
+        with self.locks.hold(name):
+            self._check(name, None)
+            self.store.update(name, {"recommendations": recommendations_to_refs(self.catalog, recommendations)})
+            return self._bump(name)
+
+    def set_recommendations_many(self, recommendations: Dict[str, Dict]):
+        names = list(recommendations)
+        with self.locks.hold(*names):
+            updates = {
+                name: {"recommendations": recommendations_to_refs(self.catalog, recs)}
+                for name, recs in recommendations.items() if name in self.patients
+            }
+            self.store.update_many(updates)
+            for name in updates:
+                self._bump(name)
+
+    def append_exercise(self, name: str, day: str, exercise: Dict, expected_version: Optional[str] = None) -> str:
+        with self.locks.hold(name):
+            self._check(name, expected_version)
+            self.store.append_exercise(name, day, self.catalog.intern(exercise))
+            version = self._bump(name)
+            try:
+                self.schedule_index.add_exercise(name, day, exercise_name(exercise))
+            except (KeyError, TypeError) as e:
+                # The write is already durable; rebuild the PT view on its next read instead of failing it.
+                print(f"Failed to update the PT schedule index for {name}, rebuilding it: {e}")
+                self._schedule_index_stale = True
+            return version
+
+    def pt_schedule(self, day: Optional[str] = None, offset: int = 0, limit: Optional[int] = None) -> Dict:
+        with span("schedule.build"):
+            if self._schedule_index_stale:
+                self._schedule_index_stale = False
+                self.schedule_index.rebuild((name, self._schedule(data)) for name, data in list(self.patients.items()))
+            return self.schedule_index.schedule(day, offset, limit)
+
+    def flush(self):
+        self.store.sync()
+
+    def storage_status(self) -> Dict:
+        return self.store.status()
+
+    def close(self):
+        self.store.close()
+        self.catalog.close()
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patients (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    age INTEGER,
+    injury_location TEXT,
+    pain_level INTEGER,
+    mobility_status TEXT,
+    medical_history TEXT,
+    activity_level TEXT,
+    goals TEXT,
+    version INTEGER NOT NULL DEFAULT 1,
+    -- Non-exercise keys of the recommendations object (e.g. "notes");
+    -- NULL means no recommendations have been generated yet.
+    recommendations_meta TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_patients_injury_location ON patients (injury_location);
+
+CREATE TABLE IF NOT EXISTS schedule_entries (
+    id INTEGER PRIMARY KEY,
+    patient_id INTEGER NOT NULL REFERENCES patients (id) ON DELETE CASCADE,
+    day TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT,
+    -- Either ref points into exercise_catalog (and data is empty), or data
+    -- holds the exercise JSON inline (rows written before the catalog).
+    data TEXT NOT NULL,
+    ref TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_schedule_entries_day ON schedule_entries (day, patient_id, position);
+CREATE INDEX IF NOT EXISTS idx_schedule_entries_patient ON schedule_entries (patient_id, day, position);
+
+CREATE TABLE IF NOT EXISTS recommendations (
+    id INTEGER PRIMARY KEY,
+    patient_id INTEGER NOT NULL REFERENCES patients (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    name TEXT,
+    data TEXT NOT NULL,
+    ref TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_recommendations_patient ON recommendations (patient_id, position);
+
+-- Single-row counter every patient version is drawn from.
+CREATE TABLE IF NOT EXISTS version_sequence (
+    value INTEGER NOT NULL
+);
+
+-- Content-addressed exercises (see catalog.exercise_ref), stored once.
+CREATE TABLE IF NOT EXISTS exercise_catalog (
+    ref TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class SqlitePatientRepository(PatientRepository):
+    """
+    Normalized SQLite storage: patients, weekly schedule entries and
+    recommended exercises live in separate indexed tables, so reads and
+    writes only touch the rows involved and nothing is held in memory.
+
+    Safe to share between processes (WAL mode, busy timeout); versions are
+    drawn from the version_sequence table and checked inside each write
+    transaction, so a deleted and recreated patient never gets a version
+    it had before.
+
+    Schedule entries and recommended exercises reference rows of
+    exercise_catalog; decoded catalog entries are interned in memory so
+    each distinct exercise is parsed once per process.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self.catalog = ExerciseCatalog()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            columns = [row["name"] for row in conn.execute("PRAGMA table_info(patients)")]
+            if "version" not in columns:
+                conn.execute("ALTER TABLE patients ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+            conn.execute(
+                """INSERT INTO version_sequence (value) SELECT COALESCE(MAX(version), 0) FROM patients
+                   WHERE NOT EXISTS (SELECT 1 FROM version_sequence)"""
+            )
+            for table in ("schedule_entries", "recommendations"):
+                columns = [row["name"] for row in conn.execute(f"PRAGMA table_info({table})")]
+                if "ref" not in columns:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN ref TEXT")
+            conn.execute(
+                """DELETE FROM exercise_catalog WHERE ref NOT IN (
+                       SELECT ref FROM schedule_entries WHERE ref IS NOT NULL
+                       UNION SELECT ref FROM recommendations WHERE ref IS NOT NULL)"""
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        """Returns this thread's connection, opening it on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    def _patient_id(self, conn: sqlite3.Connection, name: str) -> Optional[int]:
+        row = conn.execute("SELECT id FROM patients WHERE name = ?", (name,)).fetchone()
+        return row["id"] if row else None
+
+    def list_names(self) -> List[str]:
+        rows = self._connect().execute("SELECT name FROM patients ORDER BY id")
+        return [row["name"] for row in rows]
+
+    def list_names_page(self, prefix: str = "", after: Optional[str] = None, limit: int = 100) -> List[str]:
+        # A range scan of the UNIQUE index on name; SQLite's BINARY collation
+        # orders like Python string comparison.
+        clauses, params = ["name >= ?"], [prefix]
+        if prefix:
+            clauses.append("name < ?")
+            params.append(prefix_upper_bound(prefix))
+        if after is not None:
+            clauses.append("name > ?")
+            params.append(after)
+        rows = self._connect().execute(
+            f"SELECT name FROM patients WHERE {' AND '.join(clauses)} ORDER BY name LIMIT ?",
+            params + [limit],
+        )
+        return [row["name"] for row in rows]
+
+    def exists(self, name: str) -> bool:
+        return self._patient_id(self._connect(), name) is not None
+
+    def get_version(self, name: str) -> Optional[str]:
+        row = self._connect().execute("SELECT version FROM patients WHERE name = ?", (name,)).fetchone()
+        return str(row["version"]) if row else None
+
+    def get(self, name: str) -> Optional[Dict]:
+        return self.get_with_version(name)[0]
+
+    def get_with_version(self, name: str) -> Tuple[Optional[Dict], Optional[str]]:
+        conn = self._connect()
+        # One read transaction so the row, its schedule and its version agree.
+        with conn:
+            conn.execute("BEGIN")
+            row = conn.execute("SELECT * FROM patients WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                return None, None
+            data = {field: row[field] for field in PROFILE_FIELDS}
+            data["weekly_schedule"] = self._load_schedule(conn, row["id"])
+            data["recommendations"] = self._load_recommendations(conn, row["id"], row["recommendations_meta"])
+        return data, str(row["version"])
+
+    def get_fields(self, name: str, fields: List[str],
+                   summarize_schedule: bool = False) -> Tuple[Optional[Dict], Optional[str]]:
+        conn = self._connect()
+        profile = [field for field in fields if field in PROFILE_FIELDS]
+        columns = ", ".join(["id", "version", "recommendations_meta"] + profile)
+        with conn:
+            conn.execute("BEGIN")
+            row = conn.execute(f"SELECT {columns} FROM patients WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                return None, None
+            data = {}
+            for field in fields:
+                if field in PROFILE_FIELDS:
+                    data[field] = row[field]
+                elif field == "weekly_schedule" and summarize_schedule:
+                    data[field] = self._load_schedule_names(conn, row["id"])
+                elif field == "weekly_schedule":
+                    data[field] = self._load_schedule(conn, row["id"])
+                elif field == "recommendations":
+                    data[field] = self._load_recommendations(conn, row["id"], row["recommendations_meta"])
+        return data, str(row["version"])
+
+    def _load_schedule_names(self, conn: sqlite3.Connection, patient_id: int) -> Dict:
+        schedule = create_weekly_schedule()
+        rows = conn.execute(
+            "SELECT day, name FROM schedule_entries WHERE patient_id = ? ORDER BY position",
+            (patient_id,),
+        )
+        for row in rows:
+            schedule.setdefault(row["day"], []).append(row["name"])
+        return schedule
+
+    def _decode_exercise(self, row: sqlite3.Row) -> Dict:
+        ref = row["ref"]
+        if ref is None:
+            return json.loads(row["data"])
+        exercise = self.catalog.get(ref)
+        if exercise is None:
+            exercise = self.catalog.add(ref, json.loads(row["catalog_data"]))
+        return dict(exercise)
+
+    def _store_exercise(self, conn: sqlite3.Connection, exercise: Dict) -> str:
+        ref = exercise_ref(exercise)
+        conn.execute("INSERT OR IGNORE INTO exercise_catalog (ref, data) VALUES (?, ?)", (ref, json.dumps(exercise)))
+        return ref
+
+    def _load_schedule(self, conn: sqlite3.Connection, patient_id: int) -> Dict:
+        schedule = create_weekly_schedule()
+        rows = conn.execute(
+            """SELECT s.day, s.data, s.ref, c.data AS catalog_data
+               FROM schedule_entries s LEFT JOIN exercise_catalog c ON c.ref = s.ref
+               WHERE s.patient_id = ? ORDER BY s.position""",
+            (patient_id,),
+        )
+        for row in rows:
+            schedule.setdefault(row["day"], []).append(self._decode_exercise(row))
+        return schedule
+
+    def _load_recommendations(self, conn: sqlite3.Connection, patient_id: int, meta: Optional[str]) -> Dict:
+        if meta is None:
+            return {}
+        recommendations = json.loads(meta)
+        rows = conn.execute(
+            """SELECT r.data, r.ref, c.data AS catalog_data
+               FROM recommendations r LEFT JOIN exercise_catalog c ON c.ref = r.ref
+               WHERE r.patient_id = ? ORDER BY r.position""",
+            (patient_id,),
+        )
+        recommendations["exercises"] = [self._decode_exercise(row) for row in rows]
+        return recommendations
+
+    def get_weekly_schedule(self, name: str) -> Optional[Dict]:
+        conn = self._connect()
+        patient_id = self._patient_id(conn, name)
+        if patient_id is None:
+            return None
+        return self._load_schedule(conn, patient_id)
+
+    def find_names(self, injury_location: Optional[str] = None, activity_level: Optional[str] = None) -> List[str]:
+        clauses, params = [], []
+        if injury_location is not None:
+            clauses.append("injury_location = ?")
+            params.append(injury_location)
+        if activity_level is not None:
+            clauses.append("activity_level = ?")
+            params.append(activity_level)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self._connect().execute(f"SELECT name FROM patients {where} ORDER BY id", params)
+        return [row["name"] for row in rows]
+
+    def iter_patients(self) -> Iterator[Tuple[str, Dict]]:
+        for name in self.list_names():
+            data = self.get(name)
+            if data is not None:
+                yield name, data
+
+    def iter_schedule_entries(self) -> Iterator[Tuple[str, str, str]]:
+        rows = self._connect().execute(
+            """SELECT s.day, p.name AS patient_name, s.name
+               FROM schedule_entries s JOIN patients p ON p.id = s.patient_id
+               ORDER BY p.id, s.position"""
+        )
+        for row in rows:
+            yield row["day"], row["patient_name"], row["name"]
+
+    def pt_schedule(self, day: Optional[str] = None, offset: int = 0, limit: Optional[int] = None) -> Dict:
+        # Each day is one range scan of idx_schedule_entries_day, already in output order.
+        conn = self._connect()
+        days = [day] if day is not None else list(create_weekly_schedule().keys())
+        schedule = {}
+        with span("schedule.build"):
+            for d in days:
+                rows = conn.execute(
+                    """SELECT p.name AS patient_name, s.name
+                       FROM schedule_entries s JOIN patients p ON p.id = s.patient_id
+                       WHERE s.day = ?
+                       ORDER BY s.patient_id, s.position
+                       LIMIT ? OFFSET ?""",
+                    (d, -1 if limit is None else limit, offset),
+                )
+                schedule[d] = [f"{row['patient_name']}: {row['name']}" for row in rows]
+        return schedule
+
+    def create(self, name: str, data: Dict) -> str:
+        conn = self._connect()
+        try:
+            with conn:
+                version = self._insert(conn, name, data)
+        except sqlite3.IntegrityError:
+            raise PatientExists(name)
+        return str(version)
+
+    def create_many(self, patients: List[Tuple[str, Dict]]) -> List[Optional[str]]:
+        conn = self._connect()
+        versions: List[Optional[str]] = []
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for name, data in patients:
+                try:
+                    versions.append(str(self._insert(conn, name, data)))
+                except sqlite3.IntegrityError:
+                    versions.append(None)
+        return versions
+
+    def _next_version(self, conn: sqlite3.Connection) -> int:
+        conn.execute("UPDATE version_sequence SET value = value + 1")
+        return conn.execute("SELECT value FROM version_sequence").fetchone()["value"]
+
+    def _insert(self, conn: sqlite3.Connection, name: str, data: Dict) -> int:
+        """Inserts one patient with its schedule and recommendations; returns its version."""
+        columns = ", ".join(PROFILE_FIELDS)
+        placeholders = ", ".join("?" for _ in PROFILE_FIELDS)
+        version = self._next_version(conn)
+        cursor = conn.execute(
+            f"INSERT INTO patients (name, version, {columns}) VALUES (?, ?, {placeholders})",
+            [name, version] + [data.get(field) for field in PROFILE_FIELDS],
+        )
+        patient_id = cursor.lastrowid
+        position = 0
+        for day, exercises in data.get("weekly_schedule", {}).items():
+            for exercise in exercises:
+                conn.execute(
+                    "INSERT INTO schedule_entries (patient_id, day, position, name, data, ref) VALUES (?, ?, ?, ?, '', ?)",
+                    (patient_id, day, position, exercise.get("name"), self._store_exercise(conn, exercise)),
+                )
+                position += 1
+        if data.get("recommendations"):
+            self._write_recommendations(conn, patient_id, data["recommendations"])
+        return version
+
+    def _bump_version(self, conn: sqlite3.Connection, name: str, expected_version: Optional[str]) -> Tuple[int, int]:
+        """
+        Moves the patient to the next version of the sequence, checking
+        `expected_version` in the same statement. Taking the next version is
+        the transaction's first write, so it also takes SQLite's write lock
+        and the rest of the transaction cannot race with other workers.
+        Returns (patient id, new version).
+        """
+        version = self._next_version(conn)
+        if expected_version is None:
+            cursor = conn.execute("UPDATE patients SET version = ? WHERE name = ?", (version, name))
+        else:
+            cursor = conn.execute(
+                "UPDATE patients SET version = ? WHERE name = ? AND version = ?",
+                (version, name, expected_version),
+            )
+        if cursor.rowcount == 0:
+            if self._patient_id(conn, name) is None:
+                raise PatientNotFound(name)
+            raise VersionConflict(name)
+        return self._patient_id(conn, name), version
+
+    def update(self, name: str, fields: Dict, new_name: Optional[str] = None,
+               expected_version: Optional[str] = None) -> str:
+        fields = {key: value for key, value in fields.items() if key in PROFILE_FIELDS}
+        if new_name is not None and new_name != name:
+            fields["name"] = new_name
+        conn = self._connect()
+        try:
+            with conn:
+                patient_id, version = self._bump_version(conn, name, expected_version)
+                if fields:
+                    assignments = ", ".join(f"{key} = ?" for key in fields)
+                    conn.execute(f"UPDATE patients SET {assignments} WHERE id = ?", list(fields.values()) + [patient_id])
+        except sqlite3.IntegrityError:
+            raise PatientExists(new_name)
+        return str(version)
+
+    def delete(self, name: str, expected_version: Optional[str] = None):
+        conn = self._connect()
+        with conn:
+            patient_id, _ = self._bump_version(conn, name, expected_version)
+            conn.execute("DELETE FROM patients WHERE id = ?", (patient_id,))
+
+    def set_recommendations(self, name: str, recommendations: Dict) -> str:
+        conn = self._connect()
+        with conn:
+            patient_id, version = self._bump_version(conn, name, None)
+            self._write_recommendations(conn, patient_id, recommendations)
+        return str(version)
+
+    def set_recommendations_many(self, recommendations: Dict[str, Dict]):
+        conn = self._connect()
+        with conn:
+            for name, recs in recommendations.items():
+                try:
+                    patient_id, _ = self._bump_version(conn, name, None)
+                except PatientNotFound:
+                    continue
+                self._write_recommendations(conn, patient_id, recs)
+
+    def _write_recommendations(self, conn: sqlite3.Connection, patient_id: int, recommendations: Dict):
+        meta = {key: value for key, value in recommendations.items() if key != "exercises"}
+        conn.execute("UPDATE patients SET recommendations_meta = ? WHERE id = ?", (json.dumps(meta), patient_id))
+        conn.execute("DELETE FROM recommendations WHERE patient_id = ?", (patient_id,))
+        conn.executemany(
+            "INSERT INTO recommendations (patient_id, position, name, data, ref) VALUES (?, ?, ?, '', ?)",
+            [
+                (patient_id, position, exercise.get("name"), self._store_exercise(conn, exercise))
+                for position, exercise in enumerate(recommendations.get("exercises", []))
+            ],
+        )
+
+    def append_exercise(self, name: str, day: str, exercise: Dict, expected_version: Optional[str] = None) -> str:
+        conn = self._connect()
+        with conn:
+            patient_id, version = self._bump_version(conn, name, expected_version)
+            ref = self._store_exercise(conn, exercise)
+            conn.execute(
+                """INSERT INTO schedule_entries (patient_id, day, position, name, data, ref)
+                   SELECT ?, ?, COALESCE(MAX(position), -1) + 1, ?, '', ?
+                   FROM schedule_entries WHERE patient_id = ?""",
+                (patient_id, day, exercise.get("name"), ref, patient_id),
+            )
+        return str(version)
+
+    def import_patients(self, patients: Iterator[Tuple[str, Dict]], only_if_empty: bool = False):
+        """Bulk-loads (name, record) pairs in a single transaction."""
+        conn = self._connect()
+        with conn:
+            # Take the write lock up front so concurrent seeders see each other.
+            conn.execute("BEGIN IMMEDIATE")
+            if only_if_empty and not self.is_empty():
+                return
+            for name, data in patients:
+                self._insert(conn, name, data)
+
+    def is_empty(self) -> bool:
+        return self._connect().execute("SELECT 1 FROM patients LIMIT 1").fetchone() is None
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def create_repository() -> PatientRepository:
+    """
+    Builds the repository selected by PATIENT_REPOSITORY ("json" or "sqlite").
+    A fresh SQLite database is seeded from the JSON data file if one exists.
+    """
+    backend = os.environ.get("PATIENT_REPOSITORY", "json").lower()
+    if backend == "json":
+        return JsonPatientRepository(patient_store, ExerciseCatalog(EXERCISE_CATALOG_FILE))
+    if backend == "sqlite":
+        repo = SqlitePatientRepository(os.environ.get("PATIENT_SQLITE_PATH", os.path.join("database", "patients.db")))
+        if repo.is_empty() and os.path.exists(DATA_FILE):
+            seed = PatientStore(DATA_FILE)
+            seed_catalog = ExerciseCatalog(EXERCISE_CATALOG_FILE)
+            try:
+                patients = seed.load()
+                seed_catalog.load()
+                repo.import_patients(
+                    ((name, from_refs(seed_catalog, data)) for name, data in patients.items()),
+                    only_if_empty=True,
+                )
+            except RuntimeError:
+                pass  # another worker holds the JSON store and is seeding
+            finally:
+                seed.close()
+                seed_catalog.close()
+        return repo
+    raise ValueError(f"Unknown PATIENT_REPOSITORY: {backend}")
+
+
+class LazyRepository:
+    """
+    Stands in for the repository built by `factory` so the app can start
+    serving before the database is loaded. start() builds it on a
+    background thread; any repository call made earlier waits for it
+    (or builds it inline if start() was never called). status() reports
+    warm-up progress for the readiness probe without blocking.
+    """
+
+    def __init__(self, factory: Callable[[], PatientRepository]):
+        self._factory = factory
+        self._repo: Optional[PatientRepository] = None
+        self._lock = threading.Lock()
+        self._loaded = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+        self.load_seconds: Optional[float] = None
+
+    def start(self):
+        """Begins loading in the background; returns immediately."""
+        with self._lock:
+            if self._thread is None and not self._loaded.is_set():
+                self._thread = threading.Thread(target=self._load, name="repository-load", daemon=True)
+                self._thread.start()
+
+    def _load(self):
+        start = time.perf_counter()
+        try:
+            self._repo = self._factory()
+        except BaseException as e:
+            print(f"Failed to load patient repository: {e}")
+            self._error = e
+        finally:
+            self.load_seconds = time.perf_counter() - start
+            self._loaded.set()
+
+    def _get(self) -> PatientRepository:
+        if not self._loaded.is_set():
+            with self._lock:
+                inline = self._thread is None and not self._loaded.is_set()
+                if inline:
+                    self._load()
+            self._loaded.wait()
+        if self._repo is None:
+            raise RuntimeError("Patient repository failed to load") from self._error
+        return self._repo
+
+    @property
+    def ready(self) -> bool:
+        return self._loaded.is_set() and self._repo is not None
+
+    def status(self) -> Dict:
+        if self.ready:
+            state = "ready"
+        elif self._error is not None:
+            state = "failed"
+        else:
+            state = "loading" if self._thread is not None else "not_started"
+        return {"repository": state, "load_seconds": self.load_seconds}
+
+    def close(self):
+        """Closes the repository if it was ever loaded, without loading it."""
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+        if self._repo is not None:
+            self._repo.close()
+
+    def __getattr__(self, name: str):
+        return getattr(self._get(), name)
@@ -0,0 +1,193 @@
+# resilience.py
+"""
+Retry, hedging and circuit breaking for calls to an upstream service.
+
+call_with_retries() runs one logical call as a series of attempts:
+
+  - a failed attempt is retried with exponential backoff and full jitter
+    while the error is retryable and the attempt budget and deadline allow
+  - with `hedge_after` set, an attempt still running after that many
+    seconds gets a second, identical request; whichever finishes first wins
+    and the other is cancelled
+  - a CircuitBreaker shared by all calls opens after consecutive upstream
+    failures, so later calls fail fast with CircuitOpenError until a single
+    probe call succeeds
+
+Every attempt is timed into upstream_attempt_duration_seconds.
+"""
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from metrics import record_attempt, record_circuit_transition
+
+T = TypeVar("T")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Circuit '{name}' is open; retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker. After `failure_threshold`
+    failed attempts in a row it opens for `reset_timeout` seconds, then lets
+    one probe through (half-open): success closes it, failure reopens it.
+    Used from the event loop only, so it needs no lock.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        """Whether a call may go upstream now; in half-open state only one probe at a time."""
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            record_circuit_transition(self.name, CLOSED)
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def release(self):
+        """Gives up a half-open probe slot without a verdict (e.g. the call was cancelled)."""
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probing or (self.opened_at is None and self.failures >= self.failure_threshold):
+            self.opened_at = time.monotonic()
+            record_circuit_transition(self.name, OPEN)
+        self._probing = False
+
+    def status(self) -> dict:
+        return {"state": self.state, "consecutive_failures": self.failures, "retry_after": round(self.retry_after(), 1)}
+
+
+class RetryPolicy:
+    """
+    Attempt budget and timing for call_with_retries(). `deadline` bounds
+    the whole call: no retry starts if its backoff would end past it.
+    `hedge_after` (seconds) enables hedged requests; None disables them.
+    """
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0,
+                 deadline: Optional[float] = None, hedge_after: Optional[float] = None):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.hedge_after = hedge_after
+
+    def backoff(self, retry: int) -> float:
+        """Full-jitter exponential delay before retry number `retry` (0-based)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+
+async def call_with_retries(make_call: Callable[[], Awaitable[T]], policy: RetryPolicy, breaker: CircuitBreaker,
+                            is_retryable: Callable[[BaseException], bool],
+                            retry_after: Callable[[BaseException], Optional[float]] = lambda exc: None) -> T:
+    """
+    Runs make_call() (a fresh coroutine per attempt) under `policy` and
+    `breaker`. Raises CircuitOpenError when the breaker rejects an attempt,
+    otherwise the last attempt's error once retries are exhausted.
+    `retry_after` may return a server-requested delay (e.g. from a 429).
+    """
+    start = time.monotonic()
+    retry = 0
+    while True:
+        if not breaker.allow():
+            raise CircuitOpenError(breaker.name, breaker.retry_after())
+        try:
+            result = await _attempt(make_call, policy, breaker.name)
+        except asyncio.CancelledError:
+            breaker.release()
+            raise
+        except Exception as exc:
+            if not is_retryable(exc):
+                # The upstream answered (e.g. a 400), so it is healthy; the request is not.
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            if retry + 1 >= policy.max_attempts:
+                raise
+            delay = min(policy.max_delay, max(policy.backoff(retry), retry_after(exc) or 0.0))
+            if policy.deadline is not None and time.monotonic() - start + delay > policy.deadline:
+                raise
+            print(f"{breaker.name} attempt {retry + 1} failed ({exc}); retrying in {delay:.2f}s")
+            retry += 1
+            await asyncio.sleep(delay)
+            continue
+        breaker.record_success()
+        return result
+
+
+async def _attempt(make_call: Callable[[], Awaitable[T]], policy: RetryPolicy, name: str) -> T:
+    if policy.hedge_after is None:
+        return await _timed(make_call, name, "primary")
+
+    primary = asyncio.ensure_future(_timed(make_call, name, "primary"))
+    pending = {primary}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=policy.hedge_after)
+        if primary in done:
+            return primary.result()
+        pending.add(asyncio.ensure_future(_timed(make_call, name, "hedge")))
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def _timed(make_call: Callable[[], Awaitable[T]], name: str, kind: str) -> T:
+    start = time.perf_counter()
+    outcome = "success"
+    try:
+        return await make_call()
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    except Exception as exc:
+        outcome = type(exc).__name__
+        raise
+    finally:
+        record_attempt(name, kind, outcome, time.perf_counter() - start)
@@ -0,0 +1,113 @@
+# schedule_index.py
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from utils import create_weekly_schedule, exercise_name
+
+
+class PTScheduleIndex:
+    """
+    Materialized, per-day view of the PT's combined weekly schedule.
+
+    The repository updates it on every create/rename/delete/append instead
+    of rebuilding it from all patients on each request. Entries are kept
+    pre-formatted ("Patient: Exercise") and grouped by patient in patient
+    order. Each day's flat list is built on its first read and then
+    updated in place by every write, so reads cost time proportional to
+    the output and writes to the patients on that day.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_day: Dict[str, Dict[str, List[str]]] = {day: {} for day in create_weekly_schedule()}
+        self._flat: Dict[str, List[str]] = {}
+
+    def days(self) -> List[str]:
+        return list(self._by_day.keys())
+
+    def rebuild(self, patients: Iterable[Tuple[str, Dict]]):
+        """Replaces the whole index with the given (name, weekly_schedule) pairs."""
+        with self._lock:
+            self._by_day = {day: {} for day in create_weekly_schedule()}
+            self._flat = {}
+            for patient_name, weekly_schedule in patients:
+                self._add_patient(patient_name, weekly_schedule)
+
+    @staticmethod
+    def _start(patients: Dict[str, List[str]], patient_name: str) -> int:
+        """Offset of a patient's first entry in the day's flat list."""
+        start = 0
+        for name, entries in patients.items():
+            if name == patient_name:
+                break
+            start += len(entries)
+        return start
+
+    def _set(self, day: str, patient_name: str, entries: Optional[List[str]]):
+        """Sets (or, with None, removes) a patient's entries for a day. Needs the lock."""
+        patients = self._by_day.setdefault(day, {})
+        old = patients.get(patient_name)
+        flat = self._flat.get(day)
+        if flat is not None:
+            if old is None:
+                flat.extend(entries or ())
+            else:
+                start = self._start(patients, patient_name)
+                flat[start:start + len(old)] = entries or ()
+        if entries is None:
+            patients.pop(patient_name, None)
+        else:
+            patients[patient_name] = entries
+
+    def _add_patient(self, patient_name: str, weekly_schedule: Dict):
+        for day, exercises in weekly_schedule.items():
+            if exercises:
+                self._set(day, patient_name, [f"{patient_name}: {exercise_name(ex)}" for ex in exercises])
+
+    def add_patient(self, patient_name: str, weekly_schedule: Dict):
+        with self._lock:
+            self._add_patient(patient_name, weekly_schedule)
+
+    def remove_patient(self, patient_name: str):
+        with self._lock:
+            for day, patients in self._by_day.items():
+                if patient_name in patients:
+                    self._set(day, patient_name, None)
+
+    def rename_patient(self, patient_name: str, new_name: str):
+        with self._lock:
+            for day, patients in self._by_day.items():
+                entries = patients.get(patient_name)
+                if entries is not None:
+                    prefix = len(patient_name) + 2
+                    self._set(day, patient_name, None)
+                    self._set(day, new_name, [f"{new_name}: {entry[prefix:]}" for entry in entries])
+
+    def add_exercise(self, patient_name: str, day: str, exercise_name: str):
+        entry = f"{patient_name}: {exercise_name}"
+        with self._lock:
+            entries = self._by_day.setdefault(day, {}).get(patient_name)
+            if entries is None:
+                self._set(day, patient_name, [entry])
+                return
+            flat = self._flat.get(day)
+            if flat is not None:
+                flat.insert(self._start(self._by_day[day], patient_name) + len(entries), entry)
+            entries.append(entry)
+
+    def _day_entries(self, day: str) -> List[str]:
+        flat = self._flat.get(day)
+        if flat is None:
+            flat = [entry for entries in self._by_day[day].values() for entry in entries]
+            self._flat[day] = flat
+        return flat
+
+    def schedule(self, day: Optional[str] = None, offset: int = 0, limit: Optional[int] = None) -> Dict:
+        """
+        Returns {day: ["Patient: Exercise", ...]} for one day or the whole
+        week, with `offset`/`limit` applied to each day's entries.
+        """
+        with self._lock:
+            days = [day] if day is not None else list(self._by_day.keys())
+            end = None if limit is None else offset + limit
+            return {d: self._day_entries(d)[offset:end] for d in days}
@@ -1,25 +1,122 @@
 # services.py
+import asyncio
 import json
 import os
-import anthropic
-from typing import Dict
+import threading
+import time
+from typing import AsyncIterator, Dict, List, Optional
+from fastapi.concurrency import run_in_threadpool
+from cache import RecommendationCache
+from jsonstream import ExerciseStreamParser, merge_recommendations, parse_recommendations, validate_recommendations
+from metrics import record_attempt, record_fallback, record_repair, record_tokens, span
+from resilience import CircuitBreaker, CircuitOpenError, RetryPolicy, call_with_retries
+from similarity import SimilarityIndex
 
-def generate_exercises(patient_data: Dict, num_exercises: int) -> Dict:
+MODEL = "claude-3-5-sonnet-20241022"
+
+# Tuning for the shared client; see init_client().
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "64"))
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", "100"))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "60"))  # per attempt
+
+# Retries, hedging and circuit breaking around model calls; see resilience.py.
+# The SDK's own retries are disabled so attempts are counted in one place.
+LLM_MAX_ATTEMPTS = int(os.environ.get("LLM_MAX_ATTEMPTS", "3"))
+LLM_RETRY_BASE_DELAY = float(os.environ.get("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.environ.get("LLM_RETRY_MAX_DELAY", "8"))
+LLM_DEADLINE = float(os.environ.get("LLM_DEADLINE", "120"))
+LLM_HEDGE_AFTER = float(os.environ.get("LLM_HEDGE_AFTER", "0")) or None  # seconds; 0 disables hedging
+LLM_BREAKER_THRESHOLD = int(os.environ.get("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_RESET = float(os.environ.get("LLM_BREAKER_RESET", "30"))
+
+# Rate limits, overload (529), server errors and request timeouts are worth retrying.
+RETRYABLE_STATUS = frozenset({408, 409, 429, 500, 502, 503, 504, 529})
+
+# anthropic.AsyncAnthropic; the SDK is imported when the first generation needs it.
+_client = None
+_client_lock = threading.Lock()
+_semaphore: Optional[asyncio.Semaphore] = None
+
+# Identical (normalized) profiles are served from here instead of the model.
+recommendation_cache = RecommendationCache(
+    os.environ.get("RECOMMENDATION_CACHE_PATH", os.path.join("database", "recommendation_cache.db")),
+    ttl=float(os.environ.get("RECOMMENDATION_CACHE_TTL", str(7 * 24 * 3600))),
+    max_entries=int(os.environ.get("RECOMMENDATION_CACHE_MAX_ENTRIES", "10000")),
+)
+
+# Past plans of similar (not identical) patients; filled by the API from the repository.
+similarity_index = SimilarityIndex(threshold=float(os.environ.get("SIMILARITY_THRESHOLD", "0.75")))
+
+llm_retry_policy = RetryPolicy(
+    max_attempts=LLM_MAX_ATTEMPTS, base_delay=LLM_RETRY_BASE_DELAY, max_delay=LLM_RETRY_MAX_DELAY,
+    deadline=LLM_DEADLINE, hedge_after=LLM_HEDGE_AFTER,
+)
+llm_breaker = CircuitBreaker("llm", failure_threshold=LLM_BREAKER_THRESHOLD, reset_timeout=LLM_BREAKER_RESET)
+
+
+class LLMUnavailable(Exception):
+    """The model could not be reached (retries exhausted or circuit open) and nothing cached could stand in."""
+
+    def __init__(self, retry_after: float):
+        super().__init__("Exercise generation is temporarily unavailable")
+        self.retry_after = retry_after
+
+
+def init_client():
     """
-    Calls Anthropic’s API to generate exercise recommendations 
-    based on patient data.
+    Creates the long-lived, connection-pooled Anthropic client and returns
+    it. Called on the first generation (see _get_client); every later
+    generation reuses it.
     """
-    anthropic_api_key = os.environ.get("ANTHROPIC_API_KEY")
-    if not anthropic_api_key:
-        print("Error: ANTHROPIC_API_KEY not set")
-        return {}
+    global _client, _semaphore
+    with _client_lock:
+        if _client is not None:
+            return _client
+        anthropic_api_key = os.environ.get("ANTHROPIC_API_KEY")
+        if not anthropic_api_key:
+            print("Error: ANTHROPIC_API_KEY not set")
+            return None
+
+        # Imported here: the SDK is a large import and most requests never need it.
+        import anthropic
+        import httpx
+
+        _semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+        _client = anthropic.AsyncAnthropic(
+            api_key=anthropic_api_key,
+            timeout=LLM_TIMEOUT,
+            max_retries=0,
+            http_client=anthropic.DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=LLM_MAX_CONNECTIONS,
+                    max_keepalive_connections=LLM_MAX_CONNECTIONS,
+                ),
+            ),
+        )
+        return _client
+
+
+async def _get_client():
+    # The first call imports the SDK off the event loop so other requests keep flowing.
+    return _client if _client is not None else await asyncio.to_thread(init_client)
 
-    client = anthropic.Anthropic(api_key=anthropic_api_key)
-    try:
-        message = client.messages.create(
-                model="claude-3-5-sonnet-20241022",
-                max_tokens=10000,
-            system=f"""You are an expert physical therapy assistant specialized in creating evidence-based exercise recommendations. Your role is to analyze patient data and suggest appropriate exercises based on their condition. Your recommendations must be formatted as structured data for easy integration into a PT planning system.
+
+def client_initialized() -> bool:
+    return _client is not None
+
+
+async def close_client():
+    """Closes the shared client's connection pool. Called at app shutdown."""
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+
+# Static instructions. Everything that varies per request (patient data,
+# num_exercises) goes in the user message. Not marked for prompt caching:
+# at a few hundred tokens it is below the API's minimum cacheable prefix.
+SYSTEM_PROMPT = """You are an expert physical therapy assistant specialized in creating evidence-based exercise recommendations. Your role is to analyze patient data and suggest appropriate exercises based on their condition. Your recommendations must be formatted as structured data for easy integration into a PT planning system.
 
 Each exercise recommendation must be evidence-based and include:
 1. Clear name and brief description
@@ -27,49 +124,372 @@ Each exercise recommendation must be evidence-based and include:
 3. Clear progression criteria
 4. Scientific rationale
 
-Generate exactly {num_exercises} exercises.
-
-Format all responses as a JSON object. Be precise and concise, avoiding unnecessary explanations or disclaimers.""",
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"""Generate a set of targeted exercises for this patient:
-<patient_data>
-Age: {patient_data['age']}
-Injury Location: {patient_data['injury_location']}
-Pain Level: {patient_data['pain_level']}/10
-Mobility Status: {patient_data['mobility_status']}
-Medical History: {patient_data['medical_history']}
-Activity Level: {patient_data['activity_level']}
-Goals: {patient_data['goals']}
-</patient_data>
+Format all responses as a JSON object. Be precise and concise, avoiding unnecessary explanations or disclaimers.
 
 Provide output in this exact JSON structure:
-{{
+{
   "exercises": [
-    {{
+    {
       "id": "string",
       "name": "string",
       "description": "string",
       "parameters": "string",
       "progressionCriteria": "string",
       "rationale": "string"
-    }}
+    }
   ],
   "notes": "string"
-}}"""
-                }
-            ]
-        )
+}"""
+
+# Output budget: roughly one exercise object each, plus the wrapper and notes.
+LLM_TOKENS_PER_EXERCISE = int(os.environ.get("LLM_TOKENS_PER_EXERCISE", "300"))
+LLM_BASE_OUTPUT_TOKENS = int(os.environ.get("LLM_BASE_OUTPUT_TOKENS", "300"))
+LLM_MAX_OUTPUT_TOKENS = 10000
+# When a response has fewer valid exercises than asked for, only the
+# missing ones are requested, up to this many more times.
+LLM_TOPUP_ROUNDS = int(os.environ.get("LLM_TOPUP_ROUNDS", "1"))
+
+
+def max_tokens_for(num_exercises: int) -> int:
+    """Sizes max_tokens from the number of exercises requested."""
+    budget = LLM_BASE_OUTPUT_TOKENS + LLM_TOKENS_PER_EXERCISE * max(1, num_exercises)
+    return min(budget, LLM_MAX_OUTPUT_TOKENS)
+
+
+def build_user_prompt(patient_data: Dict, num_exercises: int, reference: Optional[Dict] = None,
+                      existing: Optional[List[str]] = None) -> str:
+    prompt = f"""Generate a set of targeted exercises for this patient:
+<patient_data>
+Age: {patient_data['age']}
+Injury Location: {patient_data['injury_location']}
+Pain Level: {patient_data['pain_level']}/10
+Mobility Status: {patient_data['mobility_status']}
+Medical History: {patient_data['medical_history']}
+Activity Level: {patient_data['activity_level']}
+Goals: {patient_data['goals']}
+</patient_data>
+"""
+    if reference:
+        prompt += f"""
+A plan written for a patient with a similar profile, to adapt rather than copy:
+<reference_plan>
+{json.dumps(reference)}
+</reference_plan>
+"""
+    if existing:
+        names = "\n".join(f"- {name}" for name in existing)
+        prompt += f"""
+The plan already has these exercises; add different ones:
+<existing_exercises>
+{names}
+</existing_exercises>
+"""
+    return prompt + f"""
+Generate exactly {num_exercises} exercises."""
+
 
-        if isinstance(message.content, list):
-            content = message.content[0].text
-        else:
-            content = message.content
+def build_request(patient_data: Dict, num_exercises: int, reference: Optional[Dict] = None,
+                  existing: Optional[List[str]] = None) -> Dict:
+    """Keyword arguments for messages.create / messages.stream."""
+    return {
+        "model": MODEL,
+        "max_tokens": max_tokens_for(num_exercises),
+        "system": SYSTEM_PROMPT,
+        "messages": [
+            {
+                "role": "user",
+                "content": build_user_prompt(patient_data, num_exercises, reference, existing),
+            }
+        ],
+        "timeout": LLM_TIMEOUT,
+    }
 
-        parsed = json.loads(content)
-        return parsed
 
+def is_retryable(exc: BaseException) -> bool:
+    import anthropic  # already imported by init_client()
+    if isinstance(exc, anthropic.APIStatusError):
+        return exc.status_code in RETRYABLE_STATUS
+    # APITimeoutError is a subclass of APIConnectionError.
+    return isinstance(exc, (anthropic.APIConnectionError, asyncio.TimeoutError))
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    """The Retry-After of a rate-limited or overloaded response, in seconds."""
+    response = getattr(exc, "response", None)
+    try:
+        return float(response.headers["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+async def stale_recommendations(cache_key: str) -> Optional[Dict]:
+    """An expired cache entry for the profile, served while the model is unavailable."""
+    cached = await run_in_threadpool(recommendation_cache.get_stale, cache_key)
+    if cached is not None:
+        record_fallback("stale_cache")
+    return cached
+
+
+def usage_report(usage) -> Dict:
+    """Token counts of one model call: uncached input, cache writes/reads, output."""
+    return {
+        "input_tokens": usage.input_tokens,
+        "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", None) or 0,
+        "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", None) or 0,
+        "output_tokens": usage.output_tokens,
+    }
+
+
+async def generate_exercises(patient_data: Dict, num_exercises: int, use_cache: bool = True,
+                             usage: Optional[Dict] = None, reference: Optional[Dict] = None) -> Dict:
+    """
+    Returns exercise recommendations for the patient, from the cache when an
+    identical profile was generated before, otherwise from the model.
+    If `usage` is given it is filled with the call's token usage report.
+    `reference` is a similar patient's plan included in the prompt.
+
+    When the model is unavailable an expired cache entry is returned
+    (usage then has response_stale=True); without one LLMUnavailable is
+    raised. Other failures return {}.
+    """
+    cache_key = RecommendationCache.key(patient_data, num_exercises, MODEL)
+    if use_cache:
+        cached = await run_in_threadpool(recommendation_cache.get, cache_key)
+        if cached is not None:
+            if usage is not None:
+                usage.update(input_tokens=0, cache_creation_input_tokens=0, cache_read_input_tokens=0,
+                             output_tokens=0, response_cached=True)
+            return cached
+
+    try:
+        recommendations = await _request_exercises(patient_data, num_exercises, usage, reference)
+    except LLMUnavailable:
+        cached = await stale_recommendations(cache_key) if use_cache else None
+        if cached is None:
+            raise
+        if usage is not None:
+            usage.update(input_tokens=0, cache_creation_input_tokens=0, cache_read_input_tokens=0,
+                         output_tokens=0, response_cached=True, response_stale=True)
+        return cached
+    # A partial plan (a top-up failed) is returned but not cached.
+    if len(recommendations.get("exercises", [])) >= num_exercises:
+        await run_in_threadpool(recommendation_cache.put, cache_key, patient_data, recommendations)
+    return recommendations
+
+
+async def _request_exercises(patient_data: Dict, num_exercises: int, usage: Optional[Dict] = None,
+                             reference: Optional[Dict] = None) -> Dict:
+    """
+    Calls Anthropic’s API to generate exercise recommendations
+    based on patient data, retrying transient errors. Raises
+    LLMUnavailable when the model cannot be reached.
+
+    The response is repaired and validated (see parse_recommendations);
+    if fewer than num_exercises survive, only the missing ones are
+    requested again.
+    """
+    client = await _get_client()
+    if client is None:
+        print("Error: Anthropic client is not initialized")
+        return {}
+
+    totals: Dict[str, int] = {}
+    recommendations = {"exercises": [], "notes": ""}
+    try:
+        for topup in range(1 + LLM_TOPUP_ROUNDS):
+            missing = num_exercises - len(recommendations["exercises"])
+            if missing <= 0:
+                break
+            existing = [exercise["name"] for exercise in recommendations["exercises"]]
+            if topup:
+                record_repair("topup")
+                print(f"Response had {len(existing)} of {num_exercises} exercises; requesting {missing} more")
+            text = await _call_model(client, build_request(patient_data, missing, reference, existing), totals)
+            recommendations = merge_recommendations(recommendations, parse_recommendations(text), num_exercises)
+    except LLMUnavailable:
+        if not recommendations["exercises"]:
+            raise
+        print("Model became unavailable during a top-up; returning the exercises so far")
     except Exception as e:
         print(f"Anthropic API error: {e}")
-        return {}
\ No newline at end of file
+    finally:
+        if usage is not None and totals:
+            usage.update(totals, response_cached=False)
+    return recommendations if recommendations["exercises"] else {}
+
+
+async def _call_model(client, request: Dict, totals: Dict[str, int]) -> str:
+    """
+    One model call, with retries; returns the response text and adds its
+    token usage to `totals`. Raises LLMUnavailable if the model cannot be
+    reached, and non-retryable API errors as they are.
+    """
+    async def attempt():
+        # A concurrency slot per attempt, so backoff sleeps do not hold one.
+        async with _semaphore:
+            return await client.messages.create(**request)
+
+    try:
+        with span("llm.request"):
+            message = await call_with_retries(attempt, llm_retry_policy, llm_breaker, is_retryable, retry_after)
+    except CircuitOpenError as e:
+        raise LLMUnavailable(e.retry_after)
+    except Exception as e:
+        if is_retryable(e):
+            print(f"Anthropic API error: {e}")
+            raise LLMUnavailable(llm_breaker.retry_after() or LLM_RETRY_MAX_DELAY)
+        raise
+
+    report = usage_report(message.usage)
+    record_tokens(report)
+    for key, value in report.items():
+        totals[key] = totals.get(key, 0) + value
+
+    if isinstance(message.content, list):
+        return message.content[0].text
+    return message.content
+
+
+INJURY_LOCATION_PROMPT = (
+    "You are a physical wellness assistant. The user is pointing to a part of their body "
+    "where it hurts. Identify the body part or region they are indicating."
+)
+
+
+async def detect_injury_location(image_base64: str, media_type: str, usage: Optional[Dict] = None) -> Optional[str]:
+    """
+    Asks the model which body part a photo points at. Returns None if the
+    client is not configured; raises LLMUnavailable like the generations.
+    """
+    client = await _get_client()
+    if client is None:
+        print("Error: Anthropic client is not initialized")
+        return None
+    request = {
+        "model": MODEL,
+        "max_tokens": 512,
+        "messages": [{
+            "role": "user",
+            "content": [
+                {"type": "image", "source": {"type": "base64", "media_type": media_type, "data": image_base64}},
+                {"type": "text", "text": INJURY_LOCATION_PROMPT},
+            ],
+        }],
+    }
+    try:
+        text = await _call_model(client, request, {} if usage is None else usage)
+    except LLMUnavailable:
+        raise
+    except Exception as e:
+        print(f"Error detecting injury location: {e}")
+        return None
+    return text.strip()
+
+
+async def stream_exercises(patient_data: Dict, num_exercises: int, use_cache: bool = True) -> AsyncIterator[Dict]:
+    """
+    Streaming variant of generate_exercises. Yields
+    {"type": "exercise", "exercise": {...}} as soon as each exercise is
+    complete, then {"type": "done", "recommendations": {...}}, or
+    {"type": "error", "detail": "..."} if generation fails. Exercises
+    missing from a cut-off stream are requested separately and yielded
+    before "done".
+    """
+    cache_key = RecommendationCache.key(patient_data, num_exercises, MODEL)
+    if use_cache:
+        cached = await run_in_threadpool(recommendation_cache.get, cache_key)
+        if cached is not None:
+            for exercise in cached.get("exercises", []):
+                yield {"type": "exercise", "exercise": exercise}
+            yield {"type": "done", "recommendations": cached, "usage": {"response_cached": True}}
+            return
+
+    client = await _get_client()
+    if client is None:
+        yield {"type": "error", "detail": "Anthropic client is not initialized"}
+        return
+
+    # Retried like generate_exercises, but only until the first exercise has
+    # been sent; after that a retry would repeat output. Not hedged.
+    request = build_request(patient_data, num_exercises)
+    retry = 0
+    while True:
+        if not llm_breaker.allow():
+            cached = await stale_recommendations(cache_key) if use_cache else None
+            if cached is None:
+                yield {"type": "error", "detail": "Exercise generation is temporarily unavailable",
+                       "retry_after": round(llm_breaker.retry_after(), 1)}
+                return
+            for exercise in cached.get("exercises", []):
+                yield {"type": "exercise", "exercise": exercise}
+            yield {"type": "done", "recommendations": cached, "usage": {"response_cached": True, "response_stale": True}}
+            return
+
+        parser = ExerciseStreamParser()
+        sent = 0
+        start = time.perf_counter()
+        try:
+            async with _semaphore:
+                with span("llm.stream"):
+                    async with client.messages.stream(**request) as stream:
+                        async for text in stream.text_stream:
+                            for exercise in parser.feed(text):
+                                sent += 1
+                                yield {"type": "exercise", "exercise": exercise}
+                        message = await stream.get_final_message()
+            recommendations = validate_recommendations(parser.repaired())
+        except Exception as e:
+            record_attempt("llm", "stream", type(e).__name__, time.perf_counter() - start)
+            print(f"Anthropic API error: {e}")
+            if not is_retryable(e):
+                llm_breaker.record_success()
+                yield {"type": "error", "detail": "Failed to generate exercises"}
+                return
+            llm_breaker.record_failure()
+            if sent:
+                # Keep what was streamed; the top-up below asks for the rest.
+                message = None
+                recommendations = validate_recommendations(parser.repaired())
+                break
+            if retry + 1 >= llm_retry_policy.max_attempts:
+                yield {"type": "error", "detail": "Failed to generate exercises"}
+                return
+            await asyncio.sleep(min(llm_retry_policy.max_delay,
+                                    max(llm_retry_policy.backoff(retry), retry_after(e) or 0.0)))
+            retry += 1
+            continue
+        except BaseException:
+            # Client went away mid-stream; give up a half-open probe without a verdict.
+            llm_breaker.release()
+            raise
+        record_attempt("llm", "stream", "success", time.perf_counter() - start)
+        llm_breaker.record_success()
+        break
+
+    totals: Dict[str, int] = {}
+    if message is not None:
+        totals = usage_report(message.usage)
+        record_tokens(totals)
+
+    for _ in range(LLM_TOPUP_ROUNDS):
+        missing = num_exercises - len(recommendations["exercises"])
+        if missing <= 0:
+            break
+        record_repair("topup")
+        existing = [exercise["name"] for exercise in recommendations["exercises"]]
+        try:
+            text = await _call_model(client, build_request(patient_data, missing, existing=existing), totals)
+        except Exception as e:
+            print(f"Anthropic API error: {e}")
+            break
+        sent = len(recommendations["exercises"])
+        recommendations = merge_recommendations(recommendations, parse_recommendations(text), num_exercises)
+        for exercise in recommendations["exercises"][sent:]:
+            yield {"type": "exercise", "exercise": exercise}
+
+    if not recommendations["exercises"]:
+        yield {"type": "error", "detail": "Failed to generate exercises"}
+        return
+    if len(recommendations["exercises"]) >= num_exercises:
+        await run_in_threadpool(recommendation_cache.put, cache_key, patient_data, recommendations)
+    yield {"type": "done", "recommendations": recommendations, "usage": dict(totals, response_cached=False)}
@@ -0,0 +1,196 @@
+# similarity.py
+import math
+import re
+import threading
+from collections import Counter
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+from cache import normalize
+
+# Free-text fields compared by TF-IDF; tokens are prefixed with the field so
+# "knee" in goals does not match "knee" in medical_history.
+TEXT_FIELDS = ["mobility_status", "medical_history", "goals"]
+
+# A past plan is only a candidate for the same injury location and activity
+# level and a pain level within this distance.
+MAX_PAIN_DIFFERENCE = 2
+
+# Document norms are kept per document as it is added; they use the IDF of
+# that moment, so all of them are recomputed once the documents added or
+# removed since the last full pass exceed this fraction of the index.
+NORM_REFRESH_FRACTION = 0.1
+
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have i in is it its my of on or so the to was were with".split()
+)
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(patient_data: Dict) -> Counter:
+    terms = Counter()
+    for field in TEXT_FIELDS:
+        words = [word for word in _TOKEN.findall(normalize(patient_data.get(field, ""))) if word not in STOPWORDS]
+        terms.update(f"{field}:{word}" for word in words)
+        # Bigrams keep some word order ("no surgery" vs "surgery").
+        terms.update(f"{field}:{a}_{b}" for a, b in zip(words, words[1:]))
+    return terms
+
+
+def _bucket(patient_data: Dict) -> Tuple[str, str]:
+    return normalize(patient_data.get("injury_location", "")), normalize(patient_data.get("activity_level", ""))
+
+
+class Match(NamedTuple):
+    score: float
+    patient_name: str
+    recommendations: Dict
+
+
+class _Doc(NamedTuple):
+    terms: Counter
+    bucket: Tuple[str, str]
+    pain_level: Optional[int]
+    recommendations: Dict
+
+
+class SimilarityIndex:
+    """
+    In-memory TF-IDF index over past recommendations, one document per
+    patient (the profile its current plan was generated for). query()
+    returns the closest plan by cosine similarity among patients with the
+    same injury location and activity level and a similar pain level.
+
+    An inverted index limits scoring to documents sharing a term with the
+    query. A write computes only the changed document's norm; every norm
+    is refreshed after NORM_REFRESH_FRACTION of the index has changed, so
+    the IDF drift in the norms stays bounded while a write costs O(1)
+    documents amortized.
+    """
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._docs: Dict[str, _Doc] = {}
+        self._postings: Dict[str, Dict[str, int]] = {}
+        self._norms: Dict[str, float] = {}
+        self._norm_changes = 0
+        self.built = False
+
+    def build(self, patients: Iterable[Tuple[str, Dict]]):
+        """(Re)builds the index from (name, record) pairs that have recommendations."""
+        with self._lock:
+            self._docs.clear()
+            self._postings.clear()
+            for name, data in patients:
+                if data.get("recommendations", {}).get("exercises"):
+                    self._add(name, data, data["recommendations"])
+            self._refresh_norms()
+            self.built = True
+
+    def add(self, patient_name: str, patient_data: Dict, recommendations: Dict):
+        with self._lock:
+            self._remove(patient_name)
+            if recommendations.get("exercises"):
+                self._add(patient_name, patient_data, recommendations)
+                self._norms[patient_name] = self._doc_norm(self._docs[patient_name])
+
+    def remove(self, patient_name: str):
+        with self._lock:
+            self._remove(patient_name)
+
+    def rename(self, old_name: str, new_name: str):
+        """Moves a patient's document to its new name; the profile and plan stay as indexed."""
+        with self._lock:
+            doc = self._docs.get(old_name)
+            if doc is None or old_name == new_name:
+                return
+            norm = self._norms.get(old_name)
+            self._remove(old_name)
+            self._remove(new_name)
+            self._docs[new_name] = doc
+            for term, count in doc.terms.items():
+                self._postings.setdefault(term, {})[new_name] = count
+            self._norms[new_name] = norm if norm is not None else self._doc_norm(doc)
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def _add(self, name: str, patient_data: Dict, recommendations: Dict):
+        terms = tokenize(patient_data)
+        self._docs[name] = _Doc(terms, _bucket(patient_data), _pain_level(patient_data), recommendations)
+        for term, count in terms.items():
+            self._postings.setdefault(term, {})[name] = count
+        self._norm_changes += 1
+
+    def _remove(self, name: str):
+        doc = self._docs.pop(name, None)
+        if doc is None:
+            return
+        self._norms.pop(name, None)
+        self._norm_changes += 1
+        for term in doc.terms:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(name, None)
+                if not postings:
+                    del self._postings[term]
+
+    def _idf(self, term: str) -> float:
+        return math.log((1 + len(self._docs)) / (1 + len(self._postings.get(term, ())))) + 1
+
+    def _doc_norm(self, doc: _Doc) -> float:
+        return math.sqrt(sum((count * self._idf(term)) ** 2 for term, count in doc.terms.items()))
+
+    def _refresh_norms(self):
+        self._norms = {name: self._doc_norm(doc) for name, doc in self._docs.items()}
+        self._norm_changes = 0
+
+    def _doc_norms(self) -> Dict[str, float]:
+        if self._norm_changes > len(self._docs) * NORM_REFRESH_FRACTION:
+            self._refresh_norms()
+        return self._norms
+
+    def query(self, patient_data: Dict, num_exercises: int, exclude: Optional[str] = None) -> Optional[Match]:
+        """
+        Best past plan with at least `num_exercises` exercises and a
+        similarity of at least `threshold`, trimmed to `num_exercises`.
+        """
+        terms = tokenize(patient_data)
+        bucket = _bucket(patient_data)
+        pain_level = _pain_level(patient_data)
+        with self._lock:
+            if not terms or not self._docs:
+                return None
+            norms = self._doc_norms()
+            weights = {term: count * self._idf(term) for term, count in terms.items()}
+            query_norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+            dots: Dict[str, float] = {}
+            for term, weight in weights.items():
+                idf = self._idf(term)
+                for name, count in self._postings.get(term, {}).items():
+                    dots[name] = dots.get(name, 0.0) + weight * count * idf
+
+            best: Optional[Match] = None
+            for name, dot in dots.items():
+                doc = self._docs[name]
+                if name == exclude or doc.bucket != bucket:
+                    continue
+                if len(doc.recommendations["exercises"]) < num_exercises:
+                    continue
+                if pain_level is not None and doc.pain_level is not None and abs(pain_level - doc.pain_level) > MAX_PAIN_DIFFERENCE:
+                    continue
+                score = dot / (query_norm * norms[name]) if norms[name] else 0.0
+                if score >= self.threshold and (best is None or score > best.score):
+                    best = Match(score, name, doc.recommendations)
+        if best is None:
+            return None
+        recommendations = dict(best.recommendations, exercises=best.recommendations["exercises"][:num_exercises])
+        return best._replace(recommendations=recommendations)
+
+
+def _pain_level(patient_data: Dict) -> Optional[int]:
+    try:
+        return int(patient_data.get("pain_level"))
+    except (TypeError, ValueError):
+        return None
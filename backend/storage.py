@@ -0,0 +1,451 @@
+# storage.py
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Dict, List, Optional
+
+from metrics import record_compaction_failure, record_flush, span
+from patientfile import encode_patients, iter_patients, write_patients
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class PatientStore:
+    """
+    Snapshot + append-only write-ahead log for the patients database.
+
+    Every mutation appends one small JSON record to the log, so the cost of a
+    write depends on the size of the change rather than the size of the
+    database. On startup the snapshot is loaded and the log is replayed on
+    top of it. Once the log grows past `compact_threshold` records, a
+    background thread folds it into a fresh snapshot.
+
+    Log records are idempotent when replayed in order, which means a crash in
+    the middle of a compaction can simply replay the rotated segment again.
+    If writing the snapshot fails, the next compaction (after
+    COMPACTION_RETRY_DELAY) folds the rotated segment back into the log and
+    tries again; status() reports the last failure.
+
+    Snapshots are read and written patient by patient (see patientfile),
+    as JSON or, with snapshot_format="msgpack", as msgpack; loading accepts
+    either.
+
+    With `flush_interval` > 0 the log is written behind (group commit):
+    a mutation is applied in memory and queued, and a flusher thread writes
+    everything queued in one write (and one fsync) every `flush_interval`
+    seconds, or sooner once `flush_max_records` are waiting. A crash can
+    lose up to one interval of acknowledged writes; callers that need a
+    write on disk before answering call sync(). close() flushes the rest.
+
+    The store is single-process: load() takes an exclusive lock on
+    `<snapshot>.lock` so a second worker fails fast instead of diverging.
+    Use the SQLite repository to run several workers.
+    """
+
+    COMPACTION_RETRY_DELAY = 30.0
+
+    def __init__(self, snapshot_path: str, compact_threshold: int = 1000, fsync: bool = False,
+                 snapshot_format: str = "json", flush_interval: float = 0.0, flush_max_records: int = 256):
+        self.snapshot_path = snapshot_path
+        self.snapshot_format = snapshot_format
+        self.log_path = snapshot_path + ".wal"
+        self.rotated_log_path = snapshot_path + ".wal.compacting"
+        self.compact_threshold = compact_threshold
+        self.fsync = fsync
+        self.patients: Dict = {}
+        self._lock = threading.RLock()
+        self._log = None
+        self._log_records = 0
+        self._compaction: Optional[threading.Thread] = None
+        self._compaction_retry_at = 0.0
+        self.compaction_error: Optional[str] = None
+        self.compaction_failures = 0
+        self._process_lock = None
+        # Group commit: serialized records waiting for the flusher, and
+        # sequence numbers of the last queued and last written mutation.
+        self.flush_interval = flush_interval
+        self.flush_max_records = max(1, flush_max_records)
+        self._pending: List[str] = []
+        self._pending_records = 0
+        self._queued_seq = 0
+        self._flushed_seq = 0
+        self._flush_error: Optional[OSError] = None
+        self._flushed = threading.Condition(self._lock)
+        self._flush_now = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        self._closing = False
+
+    # ------------------------------------------------------------------
+    # Loading / replay
+    # ------------------------------------------------------------------
+    def load(self) -> Dict:
+        """
+        Loads the snapshot, replays any pending log segments and opens the
+        log for appending. Returns the live patients dict.
+        """
+        with self._lock, span("storage.load"):
+            self._acquire_process_lock()
+            self.patients.clear()
+            for name, data in iter_patients(self.snapshot_path):
+                self.patients[name] = data
+
+            # A leftover rotated segment means a compaction was interrupted.
+            if os.path.exists(self.rotated_log_path):
+                self._replay(self.rotated_log_path)
+            self._log_records = self._replay(self.log_path)
+
+            os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+            self._log = open(self.log_path, "a", encoding="utf-8")
+
+            if os.path.exists(self.rotated_log_path):
+                self._stream_snapshot()
+                os.remove(self.rotated_log_path)
+
+            if self.flush_interval > 0 and self._flusher is None:
+                self._closing = False
+                self._flusher = threading.Thread(target=self._run_flusher, name="patient-store-flush", daemon=True)
+                self._flusher.start()
+        return self.patients
+
+    def _acquire_process_lock(self):
+        if fcntl is None or self._process_lock is not None:
+            return
+        os.makedirs(os.path.dirname(self.snapshot_path) or ".", exist_ok=True)
+        lock_file = open(self.snapshot_path + ".lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise RuntimeError(
+                f"{self.snapshot_path} is already open in another process; "
+                "set PATIENT_REPOSITORY=sqlite to run multiple workers"
+            )
+        self._process_lock = lock_file
+
+    def _replay(self, path: str) -> int:
+        """Applies every record in a log file; drops a torn trailing record."""
+        if not os.path.exists(path):
+            return 0
+        count = 0
+        good_offset = 0
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                self._apply(record)
+                count += 1
+                good_offset += len(line)
+        if good_offset != os.path.getsize(path):
+            with open(path, "r+b") as f:
+                f.truncate(good_offset)
+        return count
+
+    def _apply(self, record: Dict):
+        """Applies a single log record to the in-memory state."""
+        op = record["op"]
+        name = record["name"]
+        patients = self.patients
+
+        if op == "put":
+            patients[name] = record["data"]
+        elif op == "update":
+            if name in patients:
+                patients[name].update(record["fields"])
+        elif op == "rename":
+            if name in patients:
+                patients[record["new_name"]] = patients.pop(name)
+        elif op == "delete":
+            patients.pop(name, None)
+        elif op == "append":
+            if name in patients:
+                exercises = patients[name]["weekly_schedule"].setdefault(record["day"], [])
+                # Only append if this record has not already been applied.
+                if len(exercises) == record["index"]:
+                    exercises.append(record["exercise"])
+        else:
+            raise ValueError(f"Unknown log operation: {op}")
+
+    # ------------------------------------------------------------------
+    # Mutations
+    # ------------------------------------------------------------------
+    def put(self, name: str, data: Dict):
+        """Creates or replaces a whole patient record."""
+        self._commit({"op": "put", "name": name, "data": data})
+
+    def put_many(self, patients: Dict[str, Dict]):
+        """Creates or replaces several patient records with a single log write."""
+        if patients:
+            self._commit(*({"op": "put", "name": name, "data": data} for name, data in patients.items()))
+
+    def update(self, name: str, fields: Dict, new_name: Optional[str] = None):
+        """Sets top-level fields on an existing patient, optionally renaming it first."""
+        records = []
+        if new_name is not None and new_name != name:
+            records.append({"op": "rename", "name": name, "new_name": new_name})
+            name = new_name
+        if fields:
+            records.append({"op": "update", "name": name, "fields": fields})
+        if records:
+            self._commit(*records)
+
+    def update_many(self, updates: Dict[str, Dict]):
+        """Sets fields on many patients with a single log write."""
+        records = [{"op": "update", "name": name, "fields": fields} for name, fields in updates.items() if fields]
+        if records:
+            self._commit(*records)
+
+    def delete(self, name: str):
+        """Removes a patient record."""
+        self._commit({"op": "delete", "name": name})
+
+    def append_exercise(self, name: str, day: str, exercise: Dict):
+        """Appends one exercise to a day of the patient's weekly schedule."""
+        with self._lock:
+            index = len(self.patients[name]["weekly_schedule"].get(day, []))
+            self._commit({"op": "append", "name": name, "day": day, "index": index, "exercise": exercise})
+
+    def _commit(self, *records: Dict):
+        """
+        Appends records to the log in one write, then applies them in memory.
+        In write-behind mode the write is queued for the flusher instead.
+        """
+        with span("storage.serialize"):
+            lines = "".join(json.dumps(record) + "\n" for record in records)
+        with self._lock:
+            if self._log is None:
+                raise RuntimeError("PatientStore.load() must be called before writing")
+            if self._flusher is None:
+                start = time.perf_counter()
+                with span("storage.log_write"):
+                    self._log.write(lines)
+                    self._log.flush()
+                    if self.fsync:
+                        os.fsync(self._log.fileno())
+                record_flush(len(records), time.perf_counter() - start)
+            else:
+                self._pending.append(lines)
+                self._pending_records += len(records)
+                self._queued_seq += 1
+                if self._pending_records >= self.flush_max_records:
+                    self._flush_now.set()
+            for record in records:
+                self._apply(record)
+            self._log_records += len(records)
+            if self._log_records >= self.compact_threshold:
+                self._start_compaction()
+
+    # ------------------------------------------------------------------
+    # Group commit
+    # ------------------------------------------------------------------
+    def _run_flusher(self):
+        while not self._closing:
+            self._flush_now.wait(self.flush_interval)
+            self._flush_now.clear()
+            with self._lock:
+                self._flush_pending()
+
+    def _flush_pending(self):
+        """Writes every queued record to the log in one write. Needs the lock."""
+        if not self._pending or self._log is None:
+            return
+        lines = "".join(self._pending)
+        records = self._pending_records
+        start = time.perf_counter()
+        try:
+            with span("storage.log_write"):
+                self._log.write(lines)
+                self._log.flush()
+                if self.fsync:
+                    os.fsync(self._log.fileno())
+        except OSError as e:
+            # Keep the records queued; the next flush retries them.
+            print(f"Patient store flush failed: {e}")
+            self._flush_error = e
+            self._flushed.notify_all()
+            return
+        record_flush(records, time.perf_counter() - start)
+        self._pending = []
+        self._pending_records = 0
+        self._flush_error = None
+        self._flushed_seq = self._queued_seq
+        self._flushed.notify_all()
+
+    def _discard_pending(self):
+        """Drops queued records that a snapshot being written already contains. Needs the lock."""
+        self._pending = []
+        self._pending_records = 0
+        self._flushed_seq = self._queued_seq
+        self._flushed.notify_all()
+
+    def sync(self):
+        """
+        Blocks until every mutation made so far is in the log (fsynced if
+        `fsync` is set). Returns at once in write-through mode.
+        """
+        with self._lock:
+            target = self._queued_seq
+            while self._flusher is not None and self._flushed_seq < target:
+                self._flush_now.set()
+                self._flushed.wait()
+                if self._flush_error is not None and self._flushed_seq < target:
+                    raise self._flush_error
+
+    # ------------------------------------------------------------------
+    # Compaction
+    # ------------------------------------------------------------------
+    def _start_compaction(self):
+        """Rotates the log and writes the new snapshot on a background thread."""
+        if self._compaction is not None and self._compaction.is_alive():
+            return
+        if time.monotonic() < self._compaction_retry_at:
+            return
+        # Queued records belong to the segment being rotated out.
+        self._flush_pending()
+        try:
+            if os.path.exists(self.rotated_log_path):
+                # No compaction is running, so an earlier one failed: fold
+                # its segment back so this snapshot replaces both.
+                self._fold_rotated_log()
+            # Serializing with the C encoder while holding the lock gives a
+            # consistent image cheaply; the slow disk write happens off-thread.
+            with span("storage.snapshot_serialize"):
+                payload = encode_patients(self.patients, self.snapshot_format)
+            self._log.close()
+            os.replace(self.log_path, self.rotated_log_path)
+        except OSError as e:
+            self._compaction_failed(e)
+            return
+        finally:
+            if self._log.closed:
+                self._log = open(self.log_path, "a", encoding="utf-8")
+        self._log_records = 0
+
+        self._compaction = threading.Thread(
+            target=self._finish_compaction, args=(payload,), name="patient-store-compaction", daemon=True
+        )
+        self._compaction.start()
+
+    def _finish_compaction(self, payload: bytes):
+        try:
+            self._write_snapshot(payload)
+            os.remove(self.rotated_log_path)
+        except OSError as e:
+            with self._lock:
+                self._compaction_failed(e)
+            return
+        with self._lock:
+            self.compaction_error = None
+
+    def _compaction_failed(self, error: OSError):
+        """Needs the lock."""
+        print(f"Patient store compaction failed: {error}")
+        record_compaction_failure()
+        self.compaction_error = str(error)
+        self.compaction_failures += 1
+        self._compaction_retry_at = time.monotonic() + self.COMPACTION_RETRY_DELAY
+
+    def _fold_rotated_log(self):
+        """
+        Puts a failed compaction's segment back in front of the live log,
+        restoring a single log. Needs the lock; raises OSError on failure.
+        """
+        tmp_path = self.log_path + ".tmp"
+        self._log.close()
+        with open(tmp_path, "wb") as out:
+            for path in (self.rotated_log_path, self.log_path):
+                with open(path, "rb") as f:
+                    shutil.copyfileobj(f, out)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, self.log_path)
+        os.remove(self.rotated_log_path)
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {
+                "log_records": self._log_records,
+                "compaction_failures": self.compaction_failures,
+                "compaction_error": self.compaction_error,
+            }
+
+    def _write_snapshot(self, payload: bytes):
+        """Atomically replaces the snapshot file."""
+        tmp_path = self.snapshot_path + ".tmp"
+        with span("storage.snapshot_write"):
+            with open(tmp_path, "wb") as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+
+    def _stream_snapshot(self):
+        """Writes the snapshot straight from the live dict, one patient at a time. Needs the lock."""
+        with span("storage.snapshot_write"):
+            write_patients(self.snapshot_path, self.patients, fmt=self.snapshot_format)
+
+    def compact(self):
+        """Synchronously folds the log into the snapshot."""
+        self._compact_now()
+
+    def save_all(self, patients: Dict):
+        """
+        Replaces the whole database with `patients` and writes a snapshot.
+        Kept for callers that still hand over the full dict.
+        """
+        self._compact_now(patients)
+
+    def _compact_now(self, replacement: Optional[Dict] = None):
+        """
+        Writes the snapshot synchronously without building it in memory
+        first; writers wait for it, as the caller does.
+        """
+        while True:
+            running = self._compaction
+            if running is not None:
+                running.join()
+            with self._lock:
+                if self._compaction is not None and self._compaction.is_alive():
+                    continue
+                if replacement is not None and replacement is not self.patients:
+                    self.patients.clear()
+                    self.patients.update(replacement)
+                self._stream_snapshot()
+                # Everything logged or queued so far is now in the snapshot.
+                self._discard_pending()
+                if os.path.exists(self.rotated_log_path):
+                    os.remove(self.rotated_log_path)
+                if self._log is not None:
+                    self._log.truncate(0)
+                    if self.fsync:
+                        os.fsync(self._log.fileno())
+                self._log_records = 0
+                self.compaction_error = None
+                self._compaction_retry_at = 0.0
+                return
+
+    def close(self):
+        """Flushes queued writes, waits for a running compaction and closes the log."""
+        flusher = self._flusher
+        if flusher is not None:
+            self._closing = True
+            self._flush_now.set()
+            flusher.join()
+        thread = self._compaction
+        if thread is not None:
+            thread.join()
+        with self._lock:
+            self._flush_pending()
+            self._flusher = None
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+            if self._process_lock is not None:
+                self._process_lock.close()
+                self._process_lock = None
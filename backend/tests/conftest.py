@@ -0,0 +1,88 @@
+# conftest.py
+import os
+import sys
+import threading
+
+import pytest
+
+# The backend modules are imported flat (`from similarity import ...`), as main.py does.
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+PATIENT = {
+    "age": 45,
+    "injury_location": "Knee",
+    "pain_level": 4,
+    "mobility_status": "Limited flexion",
+    "medical_history": "ACL reconstruction last year",
+    "activity_level": "Moderate",
+    "goals": "Return to running without knee pain",
+}
+
+
+@pytest.fixture
+def mock_llm():
+    """Starts bench/mock_llm.py in-process: mock_llm("--fail-first", "2", ...) -> server."""
+    from bench.mock_llm import build_parser, make_server
+
+    servers = []
+
+    def start(*args: str):
+        config = build_parser().parse_args(["--latency", "0", "--tokens-per-second", "1000000", *args])
+        server = make_server("127.0.0.1", 0, config)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def llm(mock_llm, monkeypatch, tmp_path):
+    """
+    Points services at a fresh mock server with a fast retry policy, a
+    fresh breaker and an empty recommendation cache; llm("--fail-first", "1")
+    -> server. Tests adjust services.llm_retry_policy / llm_breaker as needed.
+    """
+    import services
+    from cache import RecommendationCache
+    from resilience import CircuitBreaker, RetryPolicy
+
+    def start(*args: str):
+        server = mock_llm(*args)
+        monkeypatch.setenv("ANTHROPIC_API_KEY", "test")
+        monkeypatch.setenv("ANTHROPIC_BASE_URL", f"http://127.0.0.1:{server.server_address[1]}")
+        return server
+
+    monkeypatch.setattr(services, "_client", None)
+    monkeypatch.setattr(services, "llm_retry_policy", RetryPolicy(max_attempts=3, base_delay=0.01, max_delay=0.05))
+    monkeypatch.setattr(services, "llm_breaker", CircuitBreaker("llm", failure_threshold=5, reset_timeout=30))
+    cache = RecommendationCache(str(tmp_path / "recommendation_cache.db"), ttl=3600, max_entries=100)
+    monkeypatch.setattr(services, "recommendation_cache", cache)
+    yield start
+    cache.close()
+
+
+@pytest.fixture
+def api(llm, monkeypatch, tmp_path):
+    """A TestClient over main.app with its repository, job store and caches in tmp_path (see llm)."""
+    from fastapi.testclient import TestClient
+
+    import main
+    import services
+    from catalog import ExerciseCatalog
+    from jobs import GenerationJobStore
+    from repository import JsonPatientRepository, LazyRepository
+    from storage import PatientStore
+
+    store = PatientStore(str(tmp_path / "patients.json"))
+    repo = LazyRepository(lambda: JsonPatientRepository(store, ExerciseCatalog(str(tmp_path / "exercise_catalog.jsonl"))))
+    monkeypatch.setattr(main, "repo", repo)
+    monkeypatch.setattr(main.generation_queue, "repo", repo)
+    monkeypatch.setattr(main.generation_queue, "store", GenerationJobStore(str(tmp_path / "generation_jobs.db")))
+    monkeypatch.setattr(main, "recommendation_cache", services.recommendation_cache)
+    with TestClient(main.app) as client:
+        yield client
@@ -0,0 +1,28 @@
+# test_bulk.py
+"""Splitting import bodies into rows, whatever the chunk boundaries."""
+import asyncio
+
+import pytest
+
+from bulk import iter_rows
+
+
+def rows(body: bytes, chunk_size: int, fmt: str) -> list:
+    async def chunks():
+        for start in range(0, len(body), chunk_size):
+            yield body[start:start + chunk_size]
+
+    async def collect():
+        return [row async for row in iter_rows(chunks(), fmt)]
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 1024])
+def test_rows_do_not_depend_on_chunking(chunk_size):
+    ndjson = '{"name": "A"}\r\n\n{"name": "Bé"}\n{"name": "C"}'.encode("utf-8")
+    assert rows(ndjson, chunk_size, "ndjson") == [(1, '{"name": "A"}'), (2, '{"name": "Bé"}'), (3, '{"name": "C"}')]
+    csv_body = b'name,goals\nA,"two\nlines, ""quoted"""\nB,plain\n'
+    assert rows(csv_body, chunk_size, "csv") == [
+        (1, {"name": "A", "goals": 'two\nlines, "quoted"'}),
+        (2, {"name": "B", "goals": "plain"}),
+    ]
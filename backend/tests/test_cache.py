@@ -0,0 +1,55 @@
+# test_cache.py
+from cache import RecommendationCache
+
+PATIENT = {"age": 40, "injury_location": "Knee", "goals": "Walk"}
+PLAN = {"exercises": [{"name": "Quad sets"}]}
+
+
+def _cache(tmp_path, **kwargs) -> RecommendationCache:
+    return RecommendationCache(str(tmp_path / "cache.db"), ttl=kwargs.pop("ttl", 3600), max_entries=kwargs.pop("max_entries", 10))
+
+
+def _accessed_at(cache: RecommendationCache, key: str) -> float:
+    with cache._lock:
+        return cache._connect().execute("SELECT accessed_at FROM recommendation_cache WHERE key = ?", (key,)).fetchone()[0]
+
+
+def test_hit_does_not_write_until_next_put(tmp_path):
+    cache = _cache(tmp_path)
+    cache.put("a", PATIENT, PLAN)
+    with cache._lock, cache._connect() as conn:
+        conn.execute("UPDATE recommendation_cache SET accessed_at = 0")
+    assert cache.get("a") == PLAN
+    assert _accessed_at(cache, "a") == 0
+    cache.put("b", dict(PATIENT, age=41), PLAN)
+    assert _accessed_at(cache, "a") > 0
+
+
+def test_evicts_least_recently_used_with_tracked_count(tmp_path):
+    cache = _cache(tmp_path, max_entries=2)
+    cache.put("a", PATIENT, PLAN)
+    cache.put("b", PATIENT, PLAN)
+    cache.put("a", PATIENT, PLAN)  # replacing does not grow the cache
+    assert cache.stats()["entries"] == 2
+    cache.get("a")
+    cache.put("c", PATIENT, PLAN)
+    assert cache.stats()["entries"] == 2 and cache.evictions == 1
+    assert cache.get("b") is None and cache.get("a") == PLAN
+
+
+def test_count_survives_reopen_and_clear(tmp_path):
+    cache = _cache(tmp_path)
+    cache.put("a", PATIENT, PLAN)
+    cache.put("b", dict(PATIENT, age=41), PLAN)
+    assert cache.invalidate_profile(PATIENT) == 1
+    cache.close()
+    cache = _cache(tmp_path)
+    assert cache.stats()["entries"] == 1
+    assert cache.clear() == 1 and cache.stats()["entries"] == 0
+
+
+def test_expired_entry_is_only_served_stale(tmp_path):
+    cache = _cache(tmp_path, ttl=-1)
+    cache.put("a", PATIENT, PLAN)
+    assert cache.get("a") is None
+    assert cache.get_stale("a") == PLAN
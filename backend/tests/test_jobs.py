@@ -0,0 +1,33 @@
+# test_jobs.py
+"""Batch generation: per-group failures and the results that survive them."""
+import asyncio
+
+import jobs
+from catalog import ExerciseCatalog
+from conftest import PATIENT
+from jobs import BatchJob, run_batch_generation
+from repository import JsonPatientRepository
+from storage import PatientStore
+
+
+def test_failing_group_keeps_the_other_results(monkeypatch, tmp_path):
+    repo = JsonPatientRepository(PatientStore(str(tmp_path / "patients.json")),
+                                 ExerciseCatalog(str(tmp_path / "exercise_catalog.jsonl")))
+    repo.create("Good", dict(PATIENT, weekly_schedule={}))
+    repo.create("Bad", dict(PATIENT, injury_location="Shoulder", weekly_schedule={}))
+
+    async def generate_exercises(patient_data, num_exercises, use_cache=True, usage=None):
+        if patient_data["injury_location"] == "Shoulder":
+            raise ValueError("unexpected model output")
+        return {"exercises": [{"name": "Bridge"}], "notes": ""}
+
+    monkeypatch.setattr(jobs, "generate_exercises", generate_exercises)
+    job = BatchJob(["Good", "Bad"], 1)
+    asyncio.run(run_batch_generation(job, repo, concurrency=2, use_cache=False))
+
+    assert job.status == "completed"
+    assert job.results["Good"] == {"status": "completed", "exercises": 1}
+    assert job.results["Bad"]["status"] == "failed"
+    assert repo.get("Good")["recommendations"]["exercises"] == [{"name": "Bridge"}]
+    assert not repo.get("Bad").get("recommendations")
+    repo.close()
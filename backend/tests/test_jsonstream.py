@@ -0,0 +1,54 @@
+# test_jsonstream.py
+"""Incremental parsing and repair of model output."""
+import json
+
+from jsonstream import ExerciseStreamParser, merge_recommendations, parse_recommendations
+
+
+def _exercise(i: int, **fields) -> dict:
+    return dict({"id": f"ex{i}", "name": f"Exercise {i}", "description": "Say \"hi\" {not a brace}"}, **fields)
+
+
+PAYLOAD = json.dumps({"exercises": [_exercise(1), _exercise(2), _exercise(3)], "notes": "n"})
+
+
+def test_feed_yields_each_exercise_once_complete():
+    parser = ExerciseStreamParser()
+    seen = []
+    for start in range(0, len(PAYLOAD), 7):
+        seen.extend(exercise["name"] for exercise in parser.feed(PAYLOAD[start:start + 7]))
+    assert seen == ["Exercise 1", "Exercise 2", "Exercise 3"]
+    assert parser.result()["notes"] == "n"
+
+
+def test_prose_and_code_fence_are_skipped():
+    text = f"Here is the plan:\n```json\n{PAYLOAD}\n```\nLet me know."
+    result = parse_recommendations(text)
+    assert [exercise["name"] for exercise in result["exercises"]] == ["Exercise 1", "Exercise 2", "Exercise 3"]
+    assert result["notes"] == "n"
+
+
+def test_truncated_response_keeps_complete_exercises():
+    cut = PAYLOAD[:PAYLOAD.index('"Exercise 3"')]
+    result = parse_recommendations(cut)
+    assert [exercise["name"] for exercise in result["exercises"]] == ["Exercise 1", "Exercise 2"]
+
+
+def test_unparseable_response_is_empty():
+    assert parse_recommendations("Sorry, I can't help with that.") == {"exercises": [], "notes": ""}
+
+
+def test_invalid_exercises_are_dropped_and_ids_made_unique():
+    text = json.dumps({"exercises": [_exercise(1), {"description": "no name"}, _exercise(1, name="Again"), "x"]})
+    result = parse_recommendations(text)
+    assert [exercise["name"] for exercise in result["exercises"]] == ["Exercise 1", "Again"]
+    assert len({exercise["id"] for exercise in result["exercises"]}) == 2
+
+
+def test_merge_stops_at_num_exercises():
+    current = parse_recommendations(json.dumps({"exercises": [_exercise(1)], "notes": ""}))
+    extra = parse_recommendations(json.dumps({"exercises": [_exercise(1), _exercise(2)], "notes": "later"}))
+    merged = merge_recommendations(current, extra, 2)
+    assert [exercise["name"] for exercise in merged["exercises"]] == ["Exercise 1", "Exercise 1"]
+    assert len({exercise["id"] for exercise in merged["exercises"]}) == 2
+    assert merged["notes"] == "later"
@@ -0,0 +1,151 @@
+# test_llm_resilience.py
+"""Retries, hedging, the circuit breaker and fallbacks against bench/mock_llm.py with injected faults."""
+import asyncio
+import time
+
+import pytest
+
+import resilience
+import services
+from conftest import PATIENT
+from resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, RetryPolicy
+
+
+def run(coro):
+    async def main():
+        try:
+            return await coro
+        finally:
+            await services.close_client()
+    return asyncio.run(main())
+
+
+def generate(num_exercises: int = 2, **kwargs):
+    return run(services.generate_exercises(PATIENT, num_exercises, use_cache=False, **kwargs))
+
+
+def test_retries_overloaded_responses_until_one_succeeds(llm):
+    server = llm("--fail-first", "2", "--error-status", "529")
+    recommendations = generate()
+    assert len(recommendations["exercises"]) == 2
+    assert server.stats["requests"] == 3
+    assert services.llm_breaker.state == CLOSED and services.llm_breaker.failures == 0
+
+
+def test_gives_up_after_max_attempts(llm):
+    server = llm("--fail-first", "100", "--error-status", "529")
+    with pytest.raises(services.LLMUnavailable):
+        generate()
+    assert server.stats["requests"] == 3
+    assert services.llm_breaker.failures == 3
+
+
+def test_bad_request_is_not_retried(llm):
+    server = llm("--fail-first", "1", "--error-status", "400")
+    assert generate() == {}
+    assert server.stats["requests"] == 1
+    assert services.llm_breaker.failures == 0
+
+
+def test_waits_for_retry_after(llm, monkeypatch):
+    server = llm("--fail-first", "1", "--error-status", "429", "--retry-after", "0.4")
+    monkeypatch.setattr(services, "llm_retry_policy", RetryPolicy(max_attempts=2, base_delay=0.001, max_delay=1))
+    start = time.monotonic()
+    generate()
+    assert time.monotonic() - start >= 0.4
+    assert server.stats["requests"] == 2
+
+
+def test_timed_out_attempt_is_retried(llm, monkeypatch):
+    server = llm("--slow-first", "1", "--slow-latency", "3")
+    monkeypatch.setattr(services, "LLM_TIMEOUT", 0.3)
+    start = time.monotonic()
+    assert len(generate()["exercises"]) == 2
+    assert time.monotonic() - start < 2
+    assert server.stats["requests"] == 2
+
+
+def test_hedge_wins_and_slow_primary_is_cancelled(llm, monkeypatch):
+    server = llm("--slow-first", "1", "--slow-latency", "3")
+    monkeypatch.setattr(services, "llm_retry_policy", RetryPolicy(max_attempts=1, hedge_after=0.2))
+    attempts = []
+    monkeypatch.setattr(resilience, "record_attempt", lambda upstream, kind, outcome, seconds: attempts.append((kind, outcome)))
+    start = time.monotonic()
+    assert len(generate()["exercises"]) == 2
+    assert time.monotonic() - start < 2
+    assert server.stats["requests"] == 2
+    assert sorted(attempts) == [("hedge", "success"), ("primary", "cancelled")]
+
+
+def test_breaker_opens_then_half_open_probe_closes_it(llm, monkeypatch):
+    server = llm("--fail-first", "2", "--error-status", "529")
+    breaker = CircuitBreaker("llm", failure_threshold=2, reset_timeout=0.3)
+    monkeypatch.setattr(services, "llm_breaker", breaker)
+    monkeypatch.setattr(services, "llm_retry_policy", RetryPolicy(max_attempts=1))
+    for _ in range(2):
+        with pytest.raises(services.LLMUnavailable):
+            generate()
+    assert breaker.state == OPEN
+
+    # Open: fails fast without reaching the model.
+    with pytest.raises(services.LLMUnavailable) as excinfo:
+        generate()
+    assert server.stats["requests"] == 2
+    assert 0 < excinfo.value.retry_after <= 0.3
+
+    time.sleep(0.35)
+    assert breaker.state == HALF_OPEN
+    assert len(generate()["exercises"]) == 2
+    assert server.stats["requests"] == 3
+    assert breaker.state == CLOSED
+
+
+def test_failed_half_open_probe_reopens_the_breaker(llm, monkeypatch):
+    server = llm("--fail-first", "100", "--error-status", "503")
+    breaker = CircuitBreaker("llm", failure_threshold=1, reset_timeout=0.2)
+    monkeypatch.setattr(services, "llm_breaker", breaker)
+    monkeypatch.setattr(services, "llm_retry_policy", RetryPolicy(max_attempts=1))
+    with pytest.raises(services.LLMUnavailable):
+        generate()
+    time.sleep(0.25)
+    with pytest.raises(services.LLMUnavailable):
+        generate()
+    assert server.stats["requests"] == 2
+    assert breaker.state == OPEN
+
+
+def test_serves_stale_cache_while_unavailable(llm, monkeypatch):
+    llm("--fail-first", "100", "--error-status", "529")
+    cached = {"exercises": [{"id": "ex1", "name": "Cached"}], "notes": ""}
+    key = services.RecommendationCache.key(PATIENT, 1, services.MODEL)
+    services.recommendation_cache.put(key, PATIENT, cached)
+    monkeypatch.setattr(services.recommendation_cache, "ttl", -1)  # expired
+    usage = {}
+    assert run(services.generate_exercises(PATIENT, 1, usage=usage)) == cached
+    assert usage["response_stale"] is True
+
+
+def _create_patient(api, name: str = "Pat"):
+    response = api.post("/patients", json=dict(PATIENT, name=name))
+    assert response.status_code == 201
+
+
+def test_endpoint_answers_503_with_retry_after_when_unavailable(api, llm, monkeypatch):
+    llm("--fail-first", "100", "--error-status", "529")
+    monkeypatch.setattr(services, "llm_breaker", CircuitBreaker("llm", failure_threshold=1, reset_timeout=30))
+    _create_patient(api)
+    response = api.post("/generate_exercises?wait=10",
+                        json={"patient_name": "Pat", "num_exercises": 2, "mode": "fresh"})
+    assert response.status_code == 503
+    assert 0 < float(response.headers["Retry-After"]) <= 30
+
+
+def test_endpoint_reports_model_source_after_retries(api, llm):
+    server = llm("--fail-first", "1", "--error-status", "529")
+    _create_patient(api)
+    response = api.post("/generate_exercises?wait=10",
+                        json={"patient_name": "Pat", "num_exercises": 2, "mode": "fresh"})
+    assert response.status_code == 200
+    assert response.headers["X-Recommendation-Source"] == "model"
+    assert len(response.json()["exercises"]) == 2
+    assert server.stats["requests"] == 2
@@ -0,0 +1,89 @@
+# test_repository.py
+"""Versions and If-Match checks, for both repositories and through the API."""
+import pytest
+
+from catalog import ExerciseCatalog
+from repository import JsonPatientRepository, PatientExists, SqlitePatientRepository, VersionConflict
+from storage import PatientStore
+
+def record() -> dict:
+    return {"age": 30, "injury_location": "Knee", "weekly_schedule": {"Monday": []}}
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def repo(request, tmp_path):
+    if request.param == "json":
+        store = PatientStore(str(tmp_path / "patients.json"))
+        repo = JsonPatientRepository(store, ExerciseCatalog(str(tmp_path / "exercise_catalog.jsonl")))
+    else:
+        repo = SqlitePatientRepository(str(tmp_path / "patients.db"))
+    yield repo
+    repo.close()
+
+
+def test_stale_version_is_rejected(repo):
+    v1 = repo.create("A", record())
+    v2 = repo.update("A", {"age": 31}, expected_version=v1)
+    assert v2 != v1 and repo.get_version("A") == v2
+    with pytest.raises(VersionConflict):
+        repo.update("A", {"age": 32}, expected_version=v1)
+    with pytest.raises(VersionConflict):
+        repo.append_exercise("A", "Monday", {"name": "Bridge"}, expected_version=v1)
+    with pytest.raises(VersionConflict):
+        repo.delete("A", expected_version=v1)
+    assert repo.get("A")["age"] == 31
+
+
+def test_every_write_changes_the_version(repo):
+    versions = [repo.create("A", record())]
+    versions.append(repo.append_exercise("A", "Monday", {"name": "Bridge"}, expected_version=versions[-1]))
+    versions.append(repo.set_recommendations("A", {"exercises": [{"name": "Bridge"}], "notes": ""}))
+    versions.append(repo.update("A", {}, new_name="B", expected_version=versions[-1]))
+    assert len(set(versions)) == len(versions)
+    assert repo.get_version("B") == versions[-1] and repo.get_version("A") is None
+
+
+def test_recreated_patient_never_matches_an_old_version(repo):
+    old = repo.create("A", record())
+    repo.delete("A", expected_version=old)
+    new = repo.create("A", record())
+    assert new != old
+    with pytest.raises(VersionConflict):
+        repo.update("A", {"age": 1}, expected_version=old)
+    repo.update("A", {}, new_name="B")
+    assert repo.create("A", record()) not in (old, new)
+
+
+def test_create_many_skips_taken_names(repo):
+    repo.create("A", record())
+    versions = repo.create_many([("B", record()), ("A", record()), ("B", record())])
+    assert versions[0] is not None and versions[1:] == [None, None]
+    with pytest.raises(PatientExists):
+        repo.create("B", record())
+
+
+PATIENT = {
+    "name": "Pat", "age": 45, "injury_location": "Knee", "pain_level": 4, "mobility_status": "Limited",
+    "medical_history": "None", "activity_level": "Moderate", "goals": "Run",
+}
+
+
+def test_api_if_match(api):
+    created = api.post("/patients", json=PATIENT)
+    etag = created.headers["ETag"]
+    updated = api.put("/patients/Pat", json={"age": 46}, headers={"If-Match": etag})
+    assert updated.status_code == 200 and updated.headers["ETag"] != etag
+    assert api.put("/patients/Pat", json={"age": 47}, headers={"If-Match": etag}).status_code == 412
+    assert api.delete("/patients/Pat", headers={"If-Match": etag}).status_code == 412
+    assert api.delete("/patients/Pat", headers={"If-Match": updated.headers["ETag"]}).status_code == 200
+
+    recreated = api.post("/patients", json=PATIENT)
+    assert recreated.headers["ETag"] not in (etag, updated.headers["ETag"])
+    assert api.put("/patients/Pat", json={"age": 50}, headers={"If-Match": updated.headers["ETag"]}).status_code == 412
+
+
+def test_returned_exercises_are_copies(repo):
+    repo.create("A", record())
+    repo.append_exercise("A", "Monday", {"name": "Bridge", "parameters": "3x10"})
+    repo.get("A")["weekly_schedule"]["Monday"][0]["parameters"] = "edited"
+    assert repo.get("A")["weekly_schedule"]["Monday"][0]["parameters"] == "3x10"
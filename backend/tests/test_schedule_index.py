@@ -0,0 +1,52 @@
+# test_schedule_index.py
+"""The PT schedule index's in-place updates against a rebuild from scratch."""
+from catalog import ExerciseCatalog
+from repository import JsonPatientRepository
+from schedule_index import PTScheduleIndex
+from storage import PatientStore
+
+
+def rebuilt(schedules: dict) -> dict:
+    index = PTScheduleIndex()
+    index.rebuild(schedules.items())
+    return index.schedule()
+
+
+def test_writes_after_a_read_match_a_rebuild():
+    index = PTScheduleIndex()
+    schedules = {
+        "A": {"Monday": [{"name": "Squat"}], "Tuesday": [{"name": "Bridge"}]},
+        "B": {"Monday": [{"name": "Plank"}, {"name": "Lunge"}]},
+        "C": {"Monday": [{"name": "Row"}]},
+    }
+    for name, schedule in schedules.items():
+        index.add_patient(name, schedule)
+    assert index.schedule("Monday")["Monday"] == ["A: Squat", "B: Plank", "B: Lunge", "C: Row"]
+
+    index.add_exercise("A", "Monday", "Curl")
+    schedules["A"]["Monday"].append({"name": "Curl"})
+    index.add_exercise("C", "Tuesday", "Press")
+    schedules["C"]["Tuesday"] = [{"name": "Press"}]
+    assert index.schedule() == rebuilt(schedules)
+
+    index.rename_patient("A", "D")
+    schedules["D"] = schedules.pop("A")
+    index.remove_patient("B")
+    del schedules["B"]
+    assert index.schedule() == rebuilt(schedules)
+    assert index.schedule("Monday", offset=1, limit=2)["Monday"] == ["D: Squat", "D: Curl"]
+
+
+def test_failed_index_update_is_rebuilt_on_read(monkeypatch, tmp_path):
+    repo = JsonPatientRepository(PatientStore(str(tmp_path / "patients.json")),
+                                 ExerciseCatalog(str(tmp_path / "exercise_catalog.jsonl")))
+    repo.create("A", {"weekly_schedule": {"Monday": [{"name": "Squat"}]}})
+    repo.pt_schedule()
+
+    def fail(*args):
+        raise KeyError("Monday")
+
+    monkeypatch.setattr(repo.schedule_index, "add_exercise", fail)
+    repo.append_exercise("A", "Monday", {"name": "Bridge"})
+    assert repo.pt_schedule("Monday")["Monday"] == ["A: Squat", "A: Bridge"]
+    repo.close()
@@ -0,0 +1,64 @@
+# test_similarity.py
+from similarity import SimilarityIndex
+
+PROFILE = {
+    "injury_location": "Knee",
+    "activity_level": "Moderate",
+    "pain_level": 4,
+    "mobility_status": "Limited flexion",
+    "medical_history": "ACL reconstruction last year",
+    "goals": "Return to running without knee pain",
+}
+PLAN = {"exercises": [{"name": "Quad sets"}, {"name": "Heel slides"}]}
+
+
+def _index() -> SimilarityIndex:
+    index = SimilarityIndex(threshold=0.5)
+    index.build([("Old Name", dict(PROFILE, recommendations=PLAN))])
+    return index
+
+
+def test_query_finds_indexed_plan():
+    match = _index().query(PROFILE, num_exercises=2)
+    assert match is not None and match.patient_name == "Old Name"
+
+
+def test_rename_moves_the_document():
+    index = _index()
+    index.rename("Old Name", "New Name")
+    assert len(index) == 1
+    match = index.query(PROFILE, num_exercises=2)
+    assert match is not None and match.patient_name == "New Name"
+    assert index.query(PROFILE, num_exercises=2, exclude="New Name") is None
+
+
+def test_rename_then_remove_leaves_nothing_behind():
+    index = _index()
+    index.rename("Old Name", "New Name")
+    index.remove("New Name")
+    assert len(index) == 0
+    assert index.query(PROFILE, num_exercises=2) is None
+
+
+def test_rename_of_unindexed_patient_is_a_no_op():
+    index = _index()
+    index.rename("Someone Else", "Old Name")
+    match = index.query(PROFILE, num_exercises=2)
+    assert match is not None and match.patient_name == "Old Name"
+
+
+def test_norms_are_updated_per_document_and_refreshed_periodically():
+    index = SimilarityIndex(threshold=0.5)
+    index.build([(f"P{i}", dict(PROFILE, goals=f"goal {i}", recommendations=PLAN)) for i in range(20)])
+    before = dict(index._norms)
+
+    index.add("New", dict(PROFILE, goals="new goal"), PLAN)
+    index.query(PROFILE, num_exercises=2)
+    assert {name: index._norms[name] for name in before} == before
+    assert index._norms["New"] == index._doc_norm(index._docs["New"])
+
+    index.add("Newer", dict(PROFILE, goals="newer goal"), PLAN)
+    index.remove("P0")
+    index.query(PROFILE, num_exercises=2)
+    assert index._norm_changes == 0
+    assert index._norms == {name: index._doc_norm(doc) for name, doc in index._docs.items()}
@@ -0,0 +1,135 @@
+# test_storage.py
+"""PatientStore: write-ahead log replay after a crash, torn records, compaction and group commit."""
+import json
+import os
+
+from storage import PatientStore
+
+def record(**fields) -> dict:
+    return dict({"age": 30, "weekly_schedule": {"Monday": []}}, **fields)
+
+
+def _crash(store: PatientStore):
+    """Drops the store without flushing, snapshotting or closing it properly."""
+    store._log.close()
+    store._log = None
+    if store._process_lock is not None:
+        store._process_lock.close()
+        store._process_lock = None
+
+
+def _reload(path: str) -> PatientStore:
+    store = PatientStore(path)
+    store.load()
+    return store
+
+
+def test_log_is_replayed_after_a_crash(tmp_path):
+    path = str(tmp_path / "patients.json")
+    store = PatientStore(path)
+    store.load()
+    store.put("A", record())
+    store.put("B", record())
+    store.update("A", {"age": 31}, new_name="C")
+    store.append_exercise("C", "Monday", {"name": "Bridge"})
+    store.delete("B")
+    _crash(store)
+
+    store = _reload(path)
+    assert store.patients == {"C": {"age": 31, "weekly_schedule": {"Monday": [{"name": "Bridge"}]}}}
+    store.close()
+
+
+def test_torn_trailing_record_is_dropped(tmp_path):
+    path = str(tmp_path / "patients.json")
+    store = PatientStore(path)
+    store.load()
+    store.put("A", record())
+    _crash(store)
+    with open(path + ".wal", "a", encoding="utf-8") as f:
+        f.write('{"op": "put", "name": "B", "da')
+
+    store = _reload(path)
+    assert list(store.patients) == ["A"]
+    store.put("C", record())  # appends after the truncated tail
+    store.close()
+    assert sorted(_reload(path).patients) == ["A", "C"]
+
+
+def test_interrupted_compaction_is_finished_on_load(tmp_path):
+    path = str(tmp_path / "patients.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"A": record()}, f)
+    with open(path + ".wal.compacting", "w", encoding="utf-8") as f:
+        f.write(json.dumps({"op": "put", "name": "B", "data": record()}) + "\n")
+    with open(path + ".wal", "w", encoding="utf-8") as f:
+        f.write(json.dumps({"op": "update", "name": "B", "fields": {"age": 40}}) + "\n")
+
+    store = _reload(path)
+    assert store.patients["B"]["age"] == 40
+    assert not os.path.exists(path + ".wal.compacting")
+    store.close()
+    with open(path, encoding="utf-8") as f:
+        assert sorted(json.load(f)) == ["A", "B"]
+
+
+def test_background_compaction_folds_the_log_into_the_snapshot(tmp_path):
+    path = str(tmp_path / "patients.json")
+    store = PatientStore(path, compact_threshold=5)
+    store.load()
+    for i in range(9):
+        store.put(f"P{i}", record(age=i))
+    store._compaction.join()
+    with open(path + ".wal", encoding="utf-8") as f:
+        assert len(f.readlines()) == 4  # written after the rotation at 5
+    assert not os.path.exists(path + ".wal.compacting")
+    expected = {name: dict(data) for name, data in store.patients.items()}
+    _crash(store)
+    assert _reload(path).patients == expected
+
+
+def test_group_commit_reaches_disk_on_sync(tmp_path):
+    path = str(tmp_path / "patients.json")
+    store = PatientStore(path, flush_interval=60)
+    store.load()
+    store.put("A", record())
+    assert os.path.getsize(path + ".wal") == 0  # queued, not written yet
+    store.sync()
+    assert os.path.getsize(path + ".wal") > 0
+    store.put("B", record())
+    store.close()
+    assert sorted(_reload(path).patients) == ["A", "B"]
+
+
+def test_failed_compaction_is_retried_and_reported(tmp_path, monkeypatch):
+    path = str(tmp_path / "patients.json")
+    store = PatientStore(path, compact_threshold=3)
+    store.load()
+    real_write = store._write_snapshot
+
+    def failing_write(payload):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(store, "_write_snapshot", failing_write)
+    for i in range(3):
+        store.put(f"P{i}", record(age=i))
+    store._compaction.join()
+    assert store.status()["compaction_failures"] == 1
+    assert store.status()["compaction_error"] == "disk full"
+    assert os.path.exists(path + ".wal.compacting")
+
+    # Within the retry delay nothing is attempted; afterwards the leftover
+    # segment is folded back and compacted along with the new records.
+    store.put("P3", record())
+    assert store._compaction.is_alive() is False and store.status()["compaction_failures"] == 1
+    monkeypatch.setattr(store, "_write_snapshot", real_write)
+    store._compaction_retry_at = 0.0
+    store.put("P4", record())
+    store.put("P5", record())  # the third record since the rotation
+    store._compaction.join()
+    assert not os.path.exists(path + ".wal.compacting")
+    assert store.status()["compaction_error"] is None
+    assert os.path.getsize(path + ".wal") == 0
+    expected = {name: dict(data) for name, data in store.patients.items()}
+    _crash(store)
+    assert _reload(path).patients == expected
@@ -1,25 +1,40 @@
 # utils.py
-import json
 import os
 from typing import Dict
+from storage import PatientStore
 
 DATA_FILE = os.path.join("database", "patients.json")
+# Content-addressed exercises referenced from schedules and recommendations.
+EXERCISE_CATALOG_FILE = os.path.join("database", "exercise_catalog.jsonl")
+
+# Snapshot + write-ahead log behind load_patients/save_patients.
+patient_store = PatientStore(
+    DATA_FILE,
+    compact_threshold=int(os.environ.get("PATIENT_LOG_COMPACT_THRESHOLD", "1000")),
+    fsync=os.environ.get("PATIENT_LOG_FSYNC", "0") == "1",
+    snapshot_format=os.environ.get("PATIENT_SNAPSHOT_FORMAT", "json"),
+    # PATIENT_LOG_FLUSH_MS > 0 batches log writes (group commit); 0 writes each mutation before returning.
+    flush_interval=float(os.environ.get("PATIENT_LOG_FLUSH_MS", "0")) / 1000,
+    flush_max_records=int(os.environ.get("PATIENT_LOG_FLUSH_MAX_RECORDS", "256")),
+)
 
 def load_patients() -> Dict:
     """
-    Loads patient data from a JSON file or returns an empty dict if missing.
+    Loads patient data (snapshot plus replayed log) or returns an empty dict if missing.
     """
-    if not os.path.exists(DATA_FILE):
-        return {}
-    with open(DATA_FILE, "r") as f:
-        return json.load(f)
+    return patient_store.load()
 
 def save_patients(patients: Dict):
     """
-    Saves patient data to a JSON file.
+    Saves the full patient data as a new snapshot.
+    Endpoints should prefer the per-mutation methods on `patient_store`.
     """
-    with open(DATA_FILE, "w") as f:
-        json.dump(patients, f, indent=4)
+    patient_store.save_all(patients)
+
+def exercise_name(exercise: Dict) -> str:
+    """An exercise's display name; records saved without one get a placeholder instead of breaking reads."""
+    name = exercise.get("name") if isinstance(exercise, dict) else None
+    return name if isinstance(name, str) and name.strip() else "Unnamed exercise"
 
 def create_weekly_schedule():
     """Creates a weekly schedule template."""
@@ -33,5 +48,5 @@ def generate_pt_weekly_schedule(patients_db: Dict):
         if "weekly_schedule" in data:
             for day, exercises in data["weekly_schedule"].items():
                 for exercise in exercises:
-                    pt_schedule[day].append(f"{patient_name}: {exercise['name']}")
+                    pt_schedule[day].append(f"{patient_name}: {exercise_name(exercise)}")
     return pt_schedule
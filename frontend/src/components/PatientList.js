@@ -1,34 +1,49 @@
 import React, { useEffect, useState } from "react";
-import { listPatients, getPatient, deletePatient } from "../services/api";
+import { listPatientsPage, getPatient, deletePatient } from "../services/api";
 
 function PatientList({ onSelectPatient }) {
   const [patients, setPatients] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [search, setSearch] = useState("");
   const [selectedInfo, setSelectedInfo] = useState(null);
 
   useEffect(() => {
-    fetchPatients();
-  }, []);
+    fetchPatients(search);
+  }, [search]);
 
-  async function fetchPatients() {
-    const data = await listPatients();
-    setPatients(data);
+  async function fetchPatients(prefix) {
+    const page = await listPatientsPage({ prefix: prefix || undefined });
+    setPatients(page.names);
+    setNextCursor(page.nextCursor);
+  }
+
+  async function loadMore() {
+    const page = await listPatientsPage({ prefix: search || undefined, cursor: nextCursor });
+    setPatients((current) => [...current, ...page.names]);
+    setNextCursor(page.nextCursor);
   }
 
   async function handleSelect(name) {
-    const data = await getPatient(name);
+    // Summary view: profile plus exercise names, no recommendations
+    const data = await getPatient(name, { view: "summary" });
     setSelectedInfo(data);
     onSelectPatient(name);
   }
 
   async function handleDelete(name) {
     await deletePatient(name);
-    fetchPatients();
+    fetchPatients(search);
     setSelectedInfo(null);
   }
 
   return (
     <div>
       <h3>Patients</h3>
+      <input
+        placeholder="Search by name"
+        value={search}
+        onChange={(e) => setSearch(e.target.value)}
+      />
       <ul>
         {patients.map((p) => (
           <li key={p}>
@@ -39,6 +54,7 @@ function PatientList({ onSelectPatient }) {
           </li>
         ))}
       </ul>
+      {nextCursor && <button onClick={loadMore}>Load more</button>}
       {selectedInfo && (
         <div style={{ marginTop: "1rem" }}>
           <h4>Details for selected patient:</h4>
@@ -8,8 +8,17 @@ export async function listPatients() {
   return res.data; // array of patient names
 }
 
-export async function getPatient(name) {
-  const res = await axios.get(`${API_BASE}/patients/${name}`);
+export async function listPatientsPage({ prefix, cursor, limit = 50 } = {}) {
+  const res = await axios.get(`${API_BASE}/patients`, {
+    params: { prefix, cursor, limit },
+  });
+  // names in sorted order; nextCursor is null on the last page
+  return { names: res.data, nextCursor: res.headers["x-next-cursor"] || null };
+}
+
+export async function getPatient(name, params = {}) {
+  // params: { fields: "age,pain_level", view: "summary", include_recommendations: true }
+  const res = await axios.get(`${API_BASE}/patients/${name}`, { params });
   return res.data; // patient details
 }
 
@@ -30,12 +39,36 @@ export async function deletePatient(name) {
   return res.data;
 }
 
-export async function generateExercises(patientName, numExercises) {
-  const res = await axios.post(`${API_BASE}/generate_exercises`, {
-    patient_name: patientName,
-    num_exercises: numExercises,
-  });
-  return res.data; // the recommendations JSON
+const JOB_POLL_INTERVAL_MS = 1000;
+
+function newIdempotencyKey() {
+  return window.crypto && window.crypto.randomUUID
+    ? window.crypto.randomUUID()
+    : `${Date.now()}-${Math.random().toString(16).slice(2)}`;
+}
+
+export async function getJob(jobId) {
+  const res = await axios.get(`${API_BASE}/jobs/${jobId}`);
+  return res.data; // { job_id, status, recommendations?, error?, ... }
+}
+
+export async function generateExercises(patientName, numExercises, { idempotencyKey = newIdempotencyKey() } = {}) {
+  // Generation runs as a background job: queue it, then poll until it finishes.
+  // Retrying with the same idempotencyKey returns the same job.
+  const res = await axios.post(
+    `${API_BASE}/generate_exercises`,
+    { patient_name: patientName, num_exercises: numExercises },
+    { headers: { "Idempotency-Key": idempotencyKey } }
+  );
+  let job = res.data;
+  while (job.status === "queued" || job.status === "running") {
+    await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+    job = await getJob(job.job_id);
+  }
+  if (job.status === "failed") {
+    throw new Error(job.error ? job.error.detail : "Failed to generate exercises");
+  }
+  return job.recommendations; // the recommendations JSON
 }
 
 export async function getWeeklySchedule(patientName) {
@@ -55,3 +88,20 @@ export async function getOverallPTSchedule() {
   const res = await axios.get(`${API_BASE}/pt_schedule`);
   return res.data;
 }
+
+// Download links; format is "txt", "csv" or "pdf".
+export function treatmentPlanUrl(patientName, format = "txt") {
+  return `${API_BASE}/patients/${encodeURIComponent(patientName)}/plan?format=${format}`;
+}
+
+export function allTreatmentPlansUrl(format = "txt") {
+  return `${API_BASE}/plans/export?format=${format}`; // zip, one document per patient
+}
+
+export async function detectInjuryLocation(file) {
+  // file: a File/Blob from an <input type="file">; downscaled and cached server-side
+  const form = new FormData();
+  form.append("image", file);
+  const res = await axios.post(`${API_BASE}/detect_injury_location`, form);
+  return res.data; // { location, cached, image_hash, original_bytes, sent_bytes, ... }
+}